@@ -0,0 +1,310 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client for the adb server's host protocol.
+
+Rather than spawning an adb process for every device interaction, this module
+speaks the protocol the adb binary itself uses to talk to the adb server on
+localhost:5037.
+
+Each request is its length as 4 hex digits followed by the request string. The
+server answers OKAY, or FAIL followed by a length-prefixed message. Device
+services are reached by first switching the connection to a device with
+host:transport:<serial>; shell: then streams the command's output until the
+server closes the connection. File transfer uses the sync: service, whose
+packets are a 4-byte id followed by a little-endian 32-bit length.
+
+The server closes the connection after each device service, so each call opens
+its own connection. Connecting to a local socket is still orders of magnitude
+cheaper than a fork/exec of adb.
+
+Connections time out, so a wedged server or device raises socket.timeout (a
+socket.error) instead of hanging the caller forever.
+"""
+
+import logging
+import os
+import posixpath
+import socket
+import struct
+import time
+
+# How long to wait for the server to accept a connection.
+DEFAULT_CONNECT_TIMEOUT_SEC = 5
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5037
+# How long any one read or write on a connection may block. Commands that are
+# silent for longer, such as long-running tests, pass their own to shell().
+DEFAULT_TIMEOUT_SEC = 60
+DEVICE_TMP = '/data/local/tmp'
+
+_FAIL = 'FAIL'
+_LOG = logging.getLogger('android.adb')
+_OKAY = 'OKAY'
+_SYNC_DATA = 'DATA'
+_SYNC_DONE = 'DONE'
+_SYNC_FAIL = 'FAIL'
+_SYNC_MAX_CHUNK = 64 * 1024
+_SYNC_OKAY = 'OKAY'
+_SYNC_QUIT = 'QUIT'
+_SYNC_RECV = 'RECV'
+_SYNC_SEND = 'SEND'
+
+
+class Error(Exception):
+    """Base error class."""
+
+
+class ProtocolError(Error):
+    """Raised when the adb server fails a request or breaks protocol."""
+
+
+class Client(object):
+    """Issues requests to an adb server.
+
+    If start_server_fn is given, it is called once to start the server when a
+    connection is refused, and the connection is retried. Connecting is bounded
+    by connect_timeout_sec and every read or write after by timeout_sec; either
+    running out raises socket.timeout.
+    """
+
+    def __init__(
+            self, host=DEFAULT_HOST, port=DEFAULT_PORT, start_server_fn=None,
+            connect_timeout_sec=DEFAULT_CONNECT_TIMEOUT_SEC,
+            timeout_sec=DEFAULT_TIMEOUT_SEC):
+        self.connect_timeout_sec = connect_timeout_sec
+        self.host = host
+        self.port = port
+        self.timeout_sec = timeout_sec
+        self._start_server_fn = start_server_fn
+
+    def devices(self):
+        """Gets [(serial, state)] for the devices the server knows about."""
+
+        conn = self._connect()
+
+        try:
+            self._request(conn, 'host:devices')
+            data = _read_length_prefixed(conn)
+        finally:
+            conn.close()
+
+        devices = []
+        for line in data.splitlines():
+            if line.strip():
+                serial, state = line.split('\t', 1)
+                devices.append((serial, state.strip()))
+
+        return devices
+
+    def install(self, serial, local_path):
+        """Installs (replacing) an APK; returns pm's output lines."""
+
+        remote_path = posixpath.join(
+            DEVICE_TMP, os.path.basename(local_path))
+        self.push(serial, local_path, remote_path)
+
+        try:
+            return self.shell(serial, 'pm install -r %s' % remote_path)
+        finally:
+            # Raising here would mask any error from the install itself.
+            try:
+                self.shell(serial, 'rm %s' % remote_path)
+            except (Error, socket.error):
+                _LOG.warning(
+                    'Unable to remove %s from %s', remote_path, serial,
+                    exc_info=True)
+
+    def pull(self, serial, remote_path, local_path):
+        with open(local_path, 'wb') as f:
+            for chunk in self.read(serial, remote_path):
+                f.write(chunk)
+
+    def push(self, serial, local_path, remote_path, mode=0644):
+        conn = self._connect_sync(serial)
+
+        try:
+            target = '%s,%d' % (remote_path, mode)
+            _send_sync_packet(conn, _SYNC_SEND, len(target))
+            conn.sendall(target)
+
+            with open(local_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(_SYNC_MAX_CHUNK), ''):
+                    _send_sync_packet(conn, _SYNC_DATA, len(chunk))
+                    conn.sendall(chunk)
+
+            _send_sync_packet(conn, _SYNC_DONE, int(time.time()))
+            packet_id, length = _read_sync_packet(conn)
+
+            if packet_id == _SYNC_FAIL:
+                raise ProtocolError(
+                    'Push of %s to %s failed: %s' % (
+                        local_path, remote_path, _read_exactly(conn, length)))
+            elif packet_id != _SYNC_OKAY:
+                raise ProtocolError('Unexpected sync packet ' + packet_id)
+
+            _send_sync_packet(conn, _SYNC_QUIT, 0)
+        finally:
+            conn.close()
+
+    def read(self, serial, remote_path):
+        """Yields the contents of a device file in chunks."""
+
+        conn = self._connect_sync(serial)
+
+        try:
+            _send_sync_packet(conn, _SYNC_RECV, len(remote_path))
+            conn.sendall(remote_path)
+
+            while True:
+                packet_id, length = _read_sync_packet(conn)
+
+                if packet_id == _SYNC_DONE:
+                    break
+                elif packet_id == _SYNC_FAIL:
+                    raise ProtocolError(
+                        'Pull of %s failed: %s' % (
+                            remote_path, _read_exactly(conn, length)))
+                elif packet_id != _SYNC_DATA:
+                    raise ProtocolError('Unexpected sync packet ' + packet_id)
+
+                yield _read_exactly(conn, length)
+
+            _send_sync_packet(conn, _SYNC_QUIT, 0)
+        finally:
+            conn.close()
+
+    def shell(
+            self, serial, command, line_fn=None, stop_fn=None,
+            timeout_sec=None):
+        """Runs a shell command on a device; returns its output lines.
+
+        Lines keep any trailing '\\r' but not '\\n', like worker._run(). Each
+        line is passed to line_fn as it arrives. If stop_fn returns True for a
+        line, the connection is closed, which hangs up the remote command. If
+        given, timeout_sec replaces self.timeout_sec for this command.
+        """
+
+        conn = self._connect_device(serial, timeout_sec=timeout_sec)
+        lines = []
+        pending = ''
+
+        try:
+            self._request(conn, 'shell:' + command)
+
+            for data in iter(lambda: conn.recv(_SYNC_MAX_CHUNK), ''):
+                pending += data
+                complete = pending.split('\n')
+                pending = complete.pop()
+
+                for line in complete:
+                    lines.append(line)
+
+                    if line_fn:
+                        line_fn(line)
+
+                    if stop_fn and stop_fn(line):
+                        return lines
+
+            if pending:
+                lines.append(pending)
+
+                if line_fn:
+                    line_fn(pending)
+
+            return lines
+        finally:
+            conn.close()
+
+    def _connect(self, timeout_sec=None):
+        address = (self.host, self.port)
+
+        try:
+            conn = socket.create_connection(address, self.connect_timeout_sec)
+        except socket.timeout:
+            # A server that is up but wedged; starting another will not help.
+            raise
+        except socket.error:
+            if self._start_server_fn is None:
+                raise
+
+            self._start_server_fn()
+            conn = socket.create_connection(address, self.connect_timeout_sec)
+
+        conn.settimeout(timeout_sec or self.timeout_sec)
+        return conn
+
+    def _connect_device(self, serial, timeout_sec=None):
+        conn = self._connect(timeout_sec=timeout_sec)
+
+        try:
+            self._request(conn, 'host:transport:' + serial)
+        except:  # Close on any error. pylint: disable=bare-except
+            conn.close()
+            raise
+
+        return conn
+
+    def _connect_sync(self, serial):
+        conn = self._connect_device(serial)
+
+        try:
+            self._request(conn, 'sync:')
+        except:  # Close on any error. pylint: disable=bare-except
+            conn.close()
+            raise
+
+        return conn
+
+    def _request(self, conn, request):
+        conn.sendall('%04x%s' % (len(request), request))
+        status = _read_exactly(conn, 4)
+
+        if status == _FAIL:
+            raise ProtocolError(
+                'Request %s failed: %s' % (
+                    request, _read_length_prefixed(conn)))
+        elif status != _OKAY:
+            raise ProtocolError(
+                'Request %s got unexpected status %s' % (request, status))
+
+
+def _read_exactly(conn, length):
+    chunks = []
+    remaining = length
+
+    while remaining:
+        chunk = conn.recv(remaining)
+        if not chunk:
+            raise ProtocolError(
+                'Connection closed with %s of %s bytes unread' % (
+                    remaining, length))
+
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return ''.join(chunks)
+
+
+def _read_length_prefixed(conn):
+    return _read_exactly(conn, int(_read_exactly(conn, 4), 16))
+
+
+def _read_sync_packet(conn):
+    packet_id, length = struct.unpack('<4sI', _read_exactly(conn, 8))
+    return packet_id, length
+
+
+def _send_sync_packet(conn, packet_id, length):
+    conn.sendall(struct.pack('<4sI', packet_id, length))
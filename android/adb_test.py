@@ -0,0 +1,138 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for adb.py's host protocol client, against fakes.FakeAdbServer.
+
+Run from this directory with python -m unittest discover -p '*_test.py'.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+import adb
+import fakes
+
+_SERIAL = 'emulator-5554'
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = fakes.FakeAdbServer()
+        self.fake.add_device(_SERIAL)
+        self.fake.start()
+        self.client = self.fake.get_client()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_devices(self):
+        self.fake.devices['emulator-5556'] = 'offline'
+
+        self.assertEqual(
+            [(_SERIAL, 'device'), ('emulator-5556', 'offline')],
+            self.client.devices())
+
+    def test_install_error_is_not_masked_by_cleanup_error(self):
+        apk = self._write('app.apk', 'apk')
+        shell = self.client.shell
+
+        def failing_shell(serial, command, **kwargs):
+            if command.startswith('pm install'):
+                raise adb.ProtocolError('install failed')
+            elif command.startswith('rm '):
+                raise socket.error('connection reset')
+
+            return shell(serial, command, **kwargs)
+
+        self.client.shell = failing_shell
+
+        with self.assertRaisesRegexp(adb.ProtocolError, 'install failed'):
+            self.client.install(_SERIAL, apk)
+
+    def test_install_pushes_installs_and_removes(self):
+        apk = self._write('app.apk', 'apk')
+        remote_path = '/data/local/tmp/app.apk'
+
+        result = self.client.install(_SERIAL, apk)
+
+        self.assertIn('Success\r', result)
+        self.assertEqual('apk', self.fake.files[(_SERIAL, remote_path)])
+        self.assertIn('shell:pm install -r ' + remote_path, self.fake.requests)
+        self.assertIn('shell:rm ' + remote_path, self.fake.requests)
+
+    def test_push_and_pull_span_sync_chunks(self):
+        contents = os.urandom(adb._SYNC_MAX_CHUNK * 2 + 1)
+        local_path = self._write('big', contents)
+        pulled_path = os.path.join(self.tmp, 'pulled')
+
+        self.client.push(_SERIAL, local_path, '/sdcard/big')
+        self.client.pull(_SERIAL, '/sdcard/big', pulled_path)
+
+        self.assertEqual(contents, self.fake.files[(_SERIAL, '/sdcard/big')])
+        with open(pulled_path, 'rb') as f:
+            self.assertEqual(contents, f.read())
+
+    def test_read_of_missing_file_raises_with_fail_payload(self):
+        with self.assertRaisesRegexp(
+                adb.ProtocolError, 'No such file or directory'):
+            list(self.client.read(_SERIAL, '/sdcard/missing'))
+
+    def test_shell_keeps_carriage_returns_and_streams_lines(self):
+        self.fake.shell_responses['echo'] = 'a\r\nb\r\nc'
+        streamed = []
+
+        lines = self.client.shell(_SERIAL, 'echo', line_fn=streamed.append)
+
+        self.assertEqual(['a\r', 'b\r', 'c'], lines)
+        self.assertEqual(lines, streamed)
+
+    def test_shell_times_out_when_command_is_silent(self):
+        self.fake.shell_delays['sleep'] = 1
+        self.client.timeout_sec = 0.1
+
+        with self.assertRaises(socket.timeout):
+            self.client.shell(_SERIAL, 'sleep')
+
+        self.assertEqual(
+            [], self.client.shell(_SERIAL, 'sleep', timeout_sec=2))
+
+    def test_shell_stop_fn_hangs_up_early(self):
+        self.fake.shell_responses['echo'] = 'a\nstop\nb\n'
+
+        lines = self.client.shell(
+            _SERIAL, 'echo', stop_fn=lambda line: line == 'stop')
+
+        self.assertEqual(['a', 'stop'], lines)
+
+    def test_transport_to_unknown_device_raises(self):
+        with self.assertRaisesRegexp(adb.ProtocolError, 'not found'):
+            self.client.shell('emulator-9999', 'echo')
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tmp, name)
+
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+        return path
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,519 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks test run orchestration against fake SDK tools.
+
+Builds a throwaway worker root in a temp dir with fakes.py's stand-ins for
+gradlew, aapt, jarsigner, zipalign and the adb server, which sleep for the
+given times and print output like the real tools. No SDK, emulator or network
+is needed, so this runs on any Linux box. Runs are then timed three ways:
+
+    run_test   in this process, as worker.py does
+    fork_test  in a forked process, as server.py does
+    http       end to end through server.py's REST routes, as the balancer
+               drives them
+
+Each run records timing spans (see worker._Spans). Tool time is the time spent
+in spans for tool invocations; the rest of a run's wall time is orchestration
+overhead: staging, output parsing, result I/O and, for http, the server. The
+http mode also reports client-side latency per route. Usage:
+
+    python bench.py --runs 20 --build_sec 0.5 --test_sec 0.5
+
+With --max_overhead_sec, exits non-zero if any mode's median overhead exceeds
+it, so CI can catch orchestration regressions. --json writes the raw numbers.
+
+With --serve, times nothing: it starts server.py on the fake root and serves
+until interrupted, for loadgen.py to drive:
+
+    python bench.py --serve --port 8080
+    python loadgen.py --url http://localhost:8080 --project Bench
+"""
+
+import argparse
+import httplib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+import adb
+import fakes
+import server
+import worker
+
+_HOST = 'localhost'
+_MODE_FORK_TEST = 'fork_test'
+_MODE_HTTP = 'http'
+_MODE_RUN_TEST = 'run_test'
+_MODES = [_MODE_RUN_TEST, _MODE_FORK_TEST, _MODE_HTTP]
+_PATCH_CODE = 'code'
+_PATCH_RESOURCE = 'resource'
+_PATCHES = [_PATCH_CODE, _PATCH_RESOURCE]
+_POLL_SEC = 0.01
+_PROJECT_NAME = 'Bench'
+_RUN_TIMEOUT_SEC = 60 * 5
+# Spans that time a tool rather than worker.py; spans inside them aren't
+# counted again.
+_TOOL_SPANS = frozenset([
+    'aapt', 'adb_install', 'gradle_assemble', 'instrument', 'jarsigner',
+    'pull_image', 'zipalign'])
+
+_PARSER = argparse.ArgumentParser()
+_PARSER.add_argument(
+    '--build_sec', type=float, default=0.2,
+    help='Seconds the fake gradlew takes to build')
+_PARSER.add_argument(
+    '--fail_build', action='store_true',
+    help='Make the fake gradlew fail every build')
+_PARSER.add_argument(
+    '--fail_tests', action='store_true',
+    help='Make the fake instrumentation report test failures')
+_PARSER.add_argument(
+    '--image_bytes', type=int, default=50 * 1024,
+    help='Size of the result image pulled off the fake device')
+_PARSER.add_argument(
+    '--install_sec', type=float, default=0.05,
+    help='Seconds the fake device takes to install each APK')
+_PARSER.add_argument(
+    '--json', type=str, default=None,
+    help='Path of a file to write the raw results to as JSON')
+_PARSER.add_argument(
+    '--keep_root', action='store_true',
+    help='Keep the temporary worker root for inspection')
+_PARSER.add_argument(
+    '--log_level', type=str, choices=worker.LOG_LEVEL_CHOICES,
+    default=worker.LOG_WARNING,
+    help='Display log messages at or above this level')
+_PARSER.add_argument(
+    '--max_overhead_sec', type=float, default=None,
+    help='Fail if any mode\'s median overhead exceeds this many seconds')
+_PARSER.add_argument(
+    '--modes', type=str, default=','.join(_MODES),
+    help='Comma-separated modes to run, from %s' % ', '.join(_MODES))
+_PARSER.add_argument(
+    '--patch', type=str, choices=_PATCHES, default=_PATCH_CODE,
+    help=('Patch code, so every run does a full gradle build, or a resource, '
+          'so runs after the first take the resource fast path'))
+_PARSER.add_argument(
+    '--port', type=int, default=0,
+    help='Port for the http mode\'s server; by default a free one')
+_PARSER.add_argument(
+    '--runs', type=int, default=10, help='Number of runs per mode')
+_PARSER.add_argument(
+    '--serve', action='store_true',
+    help=('Serve the fake root over http until interrupted instead of timing '
+          'runs'))
+_PARSER.add_argument(
+    '--test_sec', type=float, default=0.2,
+    help='Seconds the fake instrumentation takes to run tests')
+_PARSER.add_argument(
+    '--tool_sec', type=float, default=0.05,
+    help='Seconds each of aapt, jarsigner and zipalign take')
+
+
+class Bench(object):
+    """A worker root wired to fake tools, and the runs timed against it."""
+
+    def __init__(self, args, root_path):
+        self.results = {}
+        self._args = args
+        self._adb = None
+        self._root_path = root_path
+        self._runs = 0
+        self._server_thread = None
+
+    def run(self, mode):
+        runs = []
+
+        for _ in range(self._args.runs):
+            runs.append(getattr(self, '_run_' + mode)(self._get_ticket(mode)))
+
+        self.results[mode] = runs
+        return runs
+
+    def set_up(self):
+        """Points worker.py at the temp root, then fills it with fakes."""
+
+        worker.set_root_path(self._root_path)
+        bin_path = os.path.join(self._root_path, 'bin')
+        fakes.write_sdk(
+            worker._Sdk.PATH, bin_path, tool_sec=self._args.tool_sec)
+        os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+        os.environ.setdefault('DISPLAY', ':0')
+
+        # Treat as module-protected. pylint: disable=protected-access
+        project_path = os.path.join(worker._PROJECTS_PATH, _PROJECT_NAME)
+        worker._makedirs(worker._RUNTIMES_PATH)
+        _write_json(worker._PROJECTS_CONFIG, {
+            _PROJECT_NAME: fakes.write_project(
+                project_path, build_sec=self._args.build_sec,
+                fail_build=self._args.fail_build),
+        })
+        _write_json(worker._RUNTIMES_CONFIG, {
+            _PROJECT_NAME: {
+                'avd': 'bench_avd', 'port': 5554, 'sdcard': 'bench.iso',
+                'sdcardSize': 64},
+        })
+
+        self._adb = fakes.FakeAdbServer()
+        self._adb.add_device(
+            'emulator-5554', image=fakes.JPEG + '\0' * max(
+                0, self._args.image_bytes - len(fakes.JPEG)))
+        self._adb.shell_delays['am instrument'] = self._args.test_sec
+        self._adb.shell_delays['pm install'] = self._args.install_sec
+
+        if self._args.fail_tests:
+            self._adb.shell_responses['am instrument'] = (
+                fakes.INSTRUMENT_FAILURE_OUTPUT)
+
+        self._adb.start()
+        worker.set_adb_address(self._adb.host, self._adb.port)
+
+    def start_server(self):
+        """Starts server.py in this process; returns its port."""
+
+        port = self._args.port or _get_free_port()
+        server._Environment.set(_HOST, port)
+        self._server_thread = threading.Thread(
+            target=server._start, args=(_HOST, port),
+            kwargs={'staged_trees': 1})
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        deadline = time.time() + 30
+
+        while time.time() < deadline:
+            try:
+                code, _, _ = _request(port, 'GET', '/health')
+                if code == 200:
+                    return port
+            except socket.error:
+                pass
+
+            time.sleep(0.1)
+
+        raise RuntimeError('Server did not start on port %s' % port)
+
+    def tear_down(self):
+        # Once serve_forever() returns, server._start() stops and joins what
+        # it started, so nothing is still working in the root as it goes.
+        if self._server_thread:
+            server._Environment.SERVER.shutdown()
+            self._server_thread.join()
+            self._server_thread = None
+
+        if self._adb:
+            self._adb.stop()
+            worker.set_adb_address(adb.DEFAULT_HOST, adb.DEFAULT_PORT)
+
+        if not self._args.keep_root:
+            shutil.rmtree(self._root_path, ignore_errors=True)
+
+    def _get_patches(self, ticket):
+        config = worker.Config.load()
+        project = config.get_project(_PROJECT_NAME)
+        return [worker.Patch(
+            *_get_patch(project.path, ticket, self._args.patch))]
+
+    def _get_ticket(self, mode):
+        self._runs += 1
+        return '%s-%s-%s' % (mode, os.getpid(), self._runs)
+
+    def _run_fork_test(self, ticket):
+        config = worker.Config.load()
+        patches = self._get_patches(ticket)
+        start = time.time()
+        pid = worker.fork_test(config, _PROJECT_NAME, ticket, patches=patches)
+        deadline = start + _RUN_TIMEOUT_SEC
+
+        # Treat as module-protected. pylint: disable=protected-access
+        while time.time() < deadline:
+            test_run = worker._TestEnvironment.get_test_run(ticket)
+            if test_run.get_stage() == worker.TestRun.STAGE_DONE:
+                break
+
+            time.sleep(_POLL_SEC)
+
+        elapsed_sec = time.time() - start
+
+        # active_children() joins children that have exited, so none is left
+        # a zombie.
+        while time.time() < deadline and pid in [
+                child.pid for child in multiprocessing.active_children()]:
+            time.sleep(_POLL_SEC)
+
+        return _get_run(
+            ticket, elapsed_sec, test_run.get_status(), test_run.get_spans())
+
+    def _run_http(self, ticket):
+        port = self._args.port
+        routes = {}
+        start = time.time()
+
+        def timed(route, method, path, body=None, headers=None):
+            route_start = time.time()
+            result = _request(port, method, path, body=body, headers=headers)
+            routes.setdefault(route, []).append(time.time() - route_start)
+            return result
+
+        code, _, body = timed(
+            '/rest/v1/project', 'GET', '/rest/v1/project?' + urllib.urlencode(
+                {'request': json.dumps({'payload': {
+                    'project': _PROJECT_NAME}})}))
+        _check(code == 200, 'Project request failed: %s %s' % (code, body))
+        # The editor file is app/src/main/res/values/strings.xml.
+        filename, contents = _get_patch(os.path.normpath(os.path.join(
+            json.loads(body)['payload']['filename'], *(['..'] * 6))),
+            ticket, self._args.patch)
+        code, _, body = timed(
+            '/rest/v1 (create)', 'POST', '/rest/v1', body=json.dumps({
+                'payload': {
+                    'patches': [{
+                        'contents': contents,
+                        'filename': filename,
+                    }],
+                    'project': _PROJECT_NAME,
+                },
+                'ticket': ticket,
+            }), headers={'Content-Type': 'application/json'})
+        _check(code == 200, 'Create request failed: %s %s' % (code, body))
+        worker_id = json.loads(body)['payload']['worker_id']
+        etag = None
+        payload = {}
+
+        while time.time() - start < _RUN_TIMEOUT_SEC:
+            headers = {'If-None-Match': etag} if etag else {}
+            code, response_headers, body = timed(
+                '/rest/v1/status', 'GET', '/rest/v1/status?' + urllib.urlencode(
+                    {'request': json.dumps({
+                        'ticket': ticket, 'wait_sec': 5,
+                        'worker_id': worker_id})}), headers=headers)
+
+            if code == 304:
+                continue
+
+            etag = response_headers.get('etag')
+            payload = json.loads(body)['payload']
+
+            if payload['stage'] == worker.TestRun.STAGE_DONE:
+                break
+
+        if payload.get('image'):
+            timed(
+                '/rest/v1/image', 'GET', '/rest/v1/image?' + urllib.urlencode(
+                    {'request': json.dumps({
+                        'ticket': ticket, 'worker_id': worker_id})}))
+
+        elapsed_sec = time.time() - start
+        # Status leaves spans out, so read them from the full run afterwards;
+        # this isn't part of what a client waits for.
+        _, _, body = _request(
+            port, 'GET', '/rest/v1?' + urllib.urlencode({'request': json.dumps(
+                {'ticket': ticket, 'worker_id': worker_id})}))
+        run = _get_run(
+            ticket, elapsed_sec, payload.get('status'),
+            json.loads(body)['payload'].get('spans') or [])
+        run['routes'] = routes
+        return run
+
+    def _run_run_test(self, ticket):
+        config = worker.Config.load()
+        patches = self._get_patches(ticket)
+        start = time.time()
+        worker.run_test(config, _PROJECT_NAME, ticket, patches=patches)
+        elapsed_sec = time.time() - start
+
+        # Treat as module-protected. pylint: disable=protected-access
+        test_run = worker._TestEnvironment.get_test_run(ticket)
+        return _get_run(
+            ticket, elapsed_sec, test_run.get_status(), test_run.get_spans())
+
+
+def main(args):
+    worker.configure_logger(args.log_level)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+
+    for mode in modes:
+        if mode not in _MODES:
+            _PARSER.error('Unknown mode %s; choices are %s' % (
+                mode, ', '.join(_MODES)))
+
+    bench = Bench(args, tempfile.mkdtemp(prefix='android-bench-'))
+    failed = False
+
+    try:
+        bench.set_up()
+
+        if args.serve:
+            _serve(bench)
+            return 0
+
+        if _MODE_HTTP in modes:
+            args.port = bench.start_server()
+
+        for mode in modes:
+            _print_summary(mode, bench.run(mode))
+    finally:
+        bench.tear_down()
+
+    if args.json:
+        _write_json(args.json, bench.results)
+
+    if args.max_overhead_sec is not None:
+        for mode, runs in sorted(bench.results.items()):
+            overhead_sec = _get_percentile(
+                [run['overhead_sec'] for run in runs], 50)
+
+            if overhead_sec > args.max_overhead_sec:
+                print 'FAIL: %s median overhead %.3fs exceeds %.3fs' % (
+                    mode, overhead_sec, args.max_overhead_sec)
+                failed = True
+
+    return 1 if failed else 0
+
+
+def _check(condition, message):
+    if not condition:
+        raise RuntimeError(message)
+
+
+def _get_free_port():
+    sock = socket.socket()
+
+    try:
+        sock.bind((_HOST, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def _get_patch(path, ticket, patch):
+    # Gets (filename, contents) of a patch unique to ticket, so no run's result
+    # is reused for another.
+    if patch == _PATCH_CODE:
+        return (
+            os.path.join(path, 'app', 'src', 'main', 'java', 'Main.java'),
+            'package com.example;\n\npublic class Main {\n  // %s\n}\n' % (
+                ticket))
+
+    return (
+        os.path.join(path, 'app', 'src', 'main', 'res', 'values',
+                     'strings.xml'),
+        '<resources><string name="greeting">%s</string></resources>\n' % (
+            ticket))
+
+
+def _get_percentile(values, percentile):
+    values = sorted(values)
+    if not values:
+        return 0
+
+    index = int(round((len(values) - 1) * percentile / 100.0))
+    return values[index]
+
+
+def _get_run(ticket, elapsed_sec, status, spans):
+    tool_sec = _get_tool_sec(spans)
+    return {
+        'elapsed_sec': elapsed_sec,
+        'overhead_sec': max(elapsed_sec - tool_sec, 0),
+        'status': status,
+        'ticket': ticket,
+        'tool_sec': tool_sec,
+    }
+
+
+def _get_tool_sec(spans):
+    total = 0
+
+    for span in spans:
+        if span['end_sec'] is None:
+            continue
+
+        if span['name'] in _TOOL_SPANS:
+            total += span['end_sec'] - span['start_sec']
+        else:
+            total += _get_tool_sec(span['children'])
+
+    return total
+
+
+def _print_summary(mode, runs):
+    def summarize(values):
+        return '%7.3f %7.3f %7.3f' % (
+            _get_percentile(values, 50), _get_percentile(values, 90),
+            max(values) if values else 0)
+
+    statuses = {}
+    for run in runs:
+        statuses[run['status']] = statuses.get(run['status'], 0) + 1
+
+    print '%s: %s runs (%s)' % (mode, len(runs), ', '.join(
+        '%s %s' % (count, status)
+        for status, count in sorted(statuses.items())))
+    print '  %-22s %7s %7s %7s' % ('seconds', 'p50', 'p90', 'max')
+
+    for key in ('elapsed_sec', 'tool_sec', 'overhead_sec'):
+        print '  %-22s %s' % (key, summarize([run[key] for run in runs]))
+
+    routes = {}
+    for run in runs:
+        for route, latencies in run.get('routes', {}).items():
+            routes.setdefault(route, []).extend(latencies)
+
+    for route, latencies in sorted(routes.items()):
+        print '  %-22s %s' % (route, summarize(latencies))
+
+
+def _request(port, method, path, body=None, headers=None):
+    connection = httplib.HTTPConnection(_HOST, port, timeout=_RUN_TIMEOUT_SEC)
+
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return (
+            response.status, dict(response.getheaders()), response.read())
+    finally:
+        connection.close()
+
+
+def _serve(bench):
+    port = bench.start_server()
+    print 'Serving project %s at http://%s:%s with pid %s; ^C stops' % (
+        _PROJECT_NAME, _HOST, port, os.getpid())
+    sys.stdout.flush()
+
+    try:
+        # sleep() rather than join() so KeyboardInterrupt gets through.
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+def _write_json(path, value):
+    with open(path, 'w') as f:
+        f.write(json.dumps(value, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    logging.getLogger('android').propagate = True
+    sys.exit(main(_PARSER.parse_args()))
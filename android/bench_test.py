@@ -0,0 +1,156 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for whole runs, against bench.py's worker root of fake SDK tools.
+
+Run from this directory with python -m unittest discover -p '*_test.py'.
+"""
+
+import os
+import tempfile
+import unittest
+
+import bench
+import fakes
+import server
+import worker
+
+
+class BenchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.environ = dict(os.environ)
+        cls.environment = dict(vars(server._Environment))
+        args = bench._PARSER.parse_args([
+            '--build_sec', '0', '--install_sec', '0', '--runs', '1',
+            '--test_sec', '0', '--tool_sec', '0'])
+        cls.bench = bench.Bench(
+            args, tempfile.mkdtemp(prefix='android-bench-test-'))
+
+        try:
+            cls.bench.set_up()
+            args.port = cls.bench.start_server()
+        except:  # Treat all errors the same. pylint: disable=bare-except
+            cls.tearDownClass()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.bench.tear_down()
+        worker.set_root_path(worker.ROOT_PATH)
+        os.environ.clear()
+        os.environ.update(cls.environ)
+
+        for name, value in cls.environment.items():
+            if name.isupper():
+                setattr(server._Environment, name, value)
+
+    def test_http_run_completes_through_rest_routes(self):
+        run, = self.bench.run(bench._MODE_HTTP)
+
+        self.assertEqual('complete', run['status'])
+        self.assertEqual(
+            ['/rest/v1 (create)', '/rest/v1/image', '/rest/v1/project',
+             '/rest/v1/status'],
+            sorted(run['routes']))
+        self.assertGreater(run['tool_sec'], 0)
+
+    def test_incremental_run_rebuilds_worktree_from_updated_golden(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        config = worker.Config.load()
+        src_path = config.get_project(bench._PROJECT_NAME).path
+        name = os.path.join('app', 'src', 'main', 'java', 'Added.java')
+        worker.run_test(
+            config, bench._PROJECT_NAME, 'incremental-1',
+            patches=self.bench._get_patches('incremental-1'), incremental=True)
+
+        with open(os.path.join(src_path, name), 'w') as f:
+            f.write('class Added {}\n')
+
+        try:
+            worker.run_test(
+                worker.Config.load(), bench._PROJECT_NAME, 'incremental-2',
+                patches=self.bench._get_patches('incremental-2'),
+                incremental=True)
+        finally:
+            os.remove(os.path.join(src_path, name))
+
+        self.assertTrue(os.path.exists(os.path.join(
+            worker._WORKTREES_PATH, bench._PROJECT_NAME, 'emulator-5554',
+            name)))
+
+    def test_claim_discards_trees_staged_from_another_revision(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        ready_path = worker._get_staging_ready_path('Claim')
+        os.makedirs(os.path.join(ready_path, 'old.1'))
+        path = os.path.join(worker._STAGING_PATH, 'Claim', 'claimed')
+
+        self.assertFalse(worker._claim_staged_tree('Claim', path, 'new'))
+        self.assertEqual([], os.listdir(ready_path))
+
+        os.makedirs(os.path.join(ready_path, 'new.1'))
+
+        self.assertTrue(worker._claim_staged_tree('Claim', path, 'new'))
+        self.assertTrue(os.path.isdir(path))
+
+    def test_run_test_device_fails_when_image_pull_fails(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        files = self.bench._adb.files
+        key = ('emulator-5554', fakes.RESULT_IMAGE_PATH)
+        image = files.pop(key)
+
+        try:
+            run, = self.bench.run(bench._MODE_RUN_TEST)
+        finally:
+            files[key] = image
+
+        self.assertEqual(worker.TestRun.DEVICE_FAILED, run['status'])
+
+    def test_run_test_device_fails_when_instrumentation_hangs(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        delays = self.bench._adb.shell_delays
+        timeout_sec = worker._ADB_INSTRUMENT_TIMEOUT_SEC
+        delays['am instrument'] = 1
+        worker._ADB_INSTRUMENT_TIMEOUT_SEC = 0.1
+
+        try:
+            run, = self.bench.run(bench._MODE_RUN_TEST)
+        finally:
+            worker._ADB_INSTRUMENT_TIMEOUT_SEC = timeout_sec
+            del delays['am instrument']
+
+        self.assertEqual(worker.TestRun.DEVICE_FAILED, run['status'])
+
+    def test_run_test_fails_when_instrumentation_fails(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        responses = self.bench._adb.shell_responses
+        responses['am instrument'] = fakes.INSTRUMENT_CRASH_OUTPUT
+
+        try:
+            run, = self.bench.run(bench._MODE_RUN_TEST)
+        finally:
+            responses['am instrument'] = fakes.INSTRUMENT_SUCCESS_OUTPUT
+
+        self.assertEqual(worker.TestRun.TESTS_FAILED, run['status'])
+
+    def test_run_test_succeeds(self):
+        run, = self.bench.run(bench._MODE_RUN_TEST)
+
+        self.assertEqual(worker.TestRun.TESTS_SUCCEEDED, run['status'])
+        self.assertGreater(run['tool_sec'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,379 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-ins for the external tools worker.py drives, for tests and benchmarks.
+
+FakeAdbServer speaks enough of the adb host protocol for adb.Client: device
+listing, shell commands and sync push/pull. Point a client at it with
+adb.Client(port=server.port).
+
+write_sdk() and write_project() lay out an SDK and a gradle project whose tools
+are scripts that sleep for a set time, print output like the real tools and
+write the files worker.py looks for afterwards.
+"""
+
+import os
+import SocketServer
+import stat
+import struct
+import sys
+import threading
+import time
+
+import adb
+
+INSTRUMENT_FAILURE_OUTPUT = (
+    '\r\n'
+    'com.example.test.ScreenshotTest:\r\n'
+    'Failure in testScreenshot:\r\n'
+    'junit.framework.AssertionFailedError\r\n'
+    '\tat com.example.test.ScreenshotTest.testScreenshot('
+    'ScreenshotTest.java:42)\r\n'
+    '\r\n'
+    'Test results for InstrumentationTestRunner=.F\r\n'
+    'Time: 1.234\r\n'
+    '\r\n'
+    'FAILURES!!!\r\n'
+    'Tests run: 1,  Failures: 1,  Errors: 0\r\n'
+    '\r\n')
+INSTRUMENT_CRASH_OUTPUT = (
+    'INSTRUMENTATION_RESULT: shortMsg=Process crashed.\r\n'
+    'INSTRUMENTATION_CODE: 0\r\n'
+    'INSTRUMENTATION_FAILED: com.example.test/'
+    'android.test.InstrumentationTestRunner\r\n')
+INSTRUMENT_SUCCESS_OUTPUT = (
+    '\r\n'
+    'com.example.test.ScreenshotTest:.\r\n'
+    'Test results for InstrumentationTestRunner=.\r\n'
+    'Time: 1.234\r\n'
+    '\r\n'
+    'OK (1 test)\r\n'
+    '\r\n')
+# Shell output by command prefix. Output is \r\n-terminated like a real device.
+DEFAULT_SHELL_RESPONSES = {
+    'am instrument': INSTRUMENT_SUCCESS_OUTPUT,
+    'getprop init.svc.bootanim': 'stopped\r\n',
+    'pm install': '\tpkg: /data/local/tmp/app-debug.apk\r\nSuccess\r\n',
+    'rm ': '',
+}
+# Smallest file with JPEG's start and end markers and a JFIF header.
+JPEG = (
+    '\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00'
+    '\x00\xff\xd9')
+RESULT_IMAGE_PATH = '/sdcard/Robotium-screenshots/result.jpg'
+
+_AAPT = r"""#!%(python)s
+import os, re, sys, time, zipfile
+time.sleep(%(sleep_sec)r)
+args = sys.argv
+resources = args[args.index('-S') + 1]
+names = []
+for root, _, filenames in os.walk(resources):
+    for filename in sorted(filenames):
+        with open(os.path.join(root, filename)) as f:
+            names.extend(re.findall(r'<string name="([^"]+)"', f.read()))
+package = zipfile.ZipFile(args[args.index('-F') + 1], 'w')
+package.writestr('resources.arsc', '\n'.join(names))
+package.writestr('res/values/strings.xml', '')
+package.close()
+symbols = os.path.join(args[args.index('--output-text-symbols') + 1], 'R.txt')
+with open(symbols, 'w') as f:
+    for i, name in enumerate(sorted(set(names))):
+        f.write('int string %%s 0x7f05%%04x\n' %% (name, i))
+"""
+_GRADLEW = r"""#!%(python)s
+import os, sys, time, zipfile
+for task in ('preBuild', 'compileDebugJava', 'dexDebug', 'packageDebug'):
+    print(':app:' + task)
+    sys.stdout.flush()
+    time.sleep(%(sleep_sec)r / 4.0)
+if %(fail)r:
+    print('Main.java:3: error: cannot find symbol')
+    print(':app:compileDebugTestJava FAILED')
+    print('')
+    print('BUILD FAILED')
+    sys.exit(1)
+apks = os.path.join('app', 'build', 'outputs', 'apk')
+if not os.path.isdir(apks):
+    os.makedirs(apks)
+for name in (
+        'app-debug.apk', 'app-debug-unaligned.apk',
+        'app-debug-test-unaligned.apk'):
+    path = os.path.join(apks, name)
+    if os.path.exists(path):
+        os.remove(path)  # Never write through a hardlink to the golden tree.
+    apk = zipfile.ZipFile(path, 'w')
+    apk.writestr('AndroidManifest.xml', '<manifest/>')
+    apk.writestr('META-INF/CERT.RSA', 'signature')
+    apk.writestr('classes.dex', 'dex')
+    apk.writestr('res/values/strings.xml', '')
+    apk.writestr('resources.arsc', '')
+    apk.close()
+print(':app:assembleDebug')
+print(':app:assembleDebugTest')
+print('')
+print('BUILD SUCCESSFUL')
+print('')
+print('Total time: %%.3f secs' %% %(sleep_sec)r)
+"""
+_TOOL = r"""#!%(python)s
+import shutil, sys, time
+time.sleep(%(sleep_sec)r)
+sys.stdout.write(%(output)r)
+if %(copy)r and len(sys.argv) > 2:
+    shutil.copy(sys.argv[-2], sys.argv[-1])
+"""
+
+
+class FakeAdbServer(object):
+    """Threaded fake of the adb server listening on localhost.
+
+    devices maps serial to state ('device', 'offline', ...). files maps
+    (serial, path) to contents; pushes land there and pulls read from it.
+    shell_responses maps command prefixes to output; the longest matching
+    prefix wins and unmatched commands produce no output. shell_delays maps
+    command prefixes to seconds to wait before answering, the same way.
+    requests records every request received, in order.
+    """
+
+    def __init__(self, host=adb.DEFAULT_HOST, port=0):
+        self.devices = {}
+        self.files = {}
+        self.requests = []
+        self.shell_delays = {}
+        self.shell_responses = dict(DEFAULT_SHELL_RESPONSES)
+        self._server = _FakeAdbSocketServer((host, port), _FakeAdbHandler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def get_client(self):
+        return adb.Client(host=self.host, port=self.port)
+
+    def add_device(self, serial, image=JPEG):
+        """Adds a booted device whose tests leave image as their result."""
+
+        self.devices[serial] = 'device'
+        self.files[(serial, RESULT_IMAGE_PATH)] = image
+
+    def get_shell_delay_sec(self, command):
+        return _get_longest_match(self.shell_delays, command, 0)
+
+    def get_shell_response(self, command):
+        return _get_longest_match(self.shell_responses, command, '')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def write_project(
+        path, package='com.example', build_sec=0, fail_build=False):
+    """Writes a gradle project whose gradlew fakes assembling debug APKs.
+
+    Returns the project's projects/config.json entry. Its editor file is the
+    resource file app/src/main/res/values/strings.xml; code patches can target
+    app/src/main/java/Main.java.
+    """
+
+    src = os.path.join(path, 'app', 'src', 'main')
+    _write(os.path.join(path, 'app', 'build.gradle'), '')
+    _write(
+        os.path.join(src, 'AndroidManifest.xml'),
+        '<manifest package="%s"/>\n' % package)
+    _write(
+        os.path.join(src, 'java', 'Main.java'),
+        'package %s;\n\npublic class Main {}\n' % package)
+    _write(
+        os.path.join(src, 'res', 'values', 'strings.xml'),
+        '<resources><string name="greeting">Hello</string></resources>\n')
+    _write_script(
+        os.path.join(path, 'gradlew'), _GRADLEW % {
+            'fail': fail_build, 'python': sys.executable,
+            'sleep_sec': build_sec})
+    return {
+        'editorFile': 'app/src/main/res/values/strings.xml',
+        'package': package,
+        'testClass': package + '.test.ScreenshotTest',
+        'testPackage': package + '.test',
+    }
+
+
+def write_sdk(path, bin_path, tool_sec=0):
+    """Writes an SDK under path, and jarsigner into bin_path for PATH.
+
+    aapt, jarsigner and zipalign each take tool_sec seconds. aapt writes an
+    R.txt listing the resources' string names, so adding a string forces a
+    full build as it would for real.
+    """
+
+    build_tools = os.path.join(path, 'build-tools', '21.0.2')
+    _write_script(
+        os.path.join(build_tools, 'aapt'), _AAPT % {
+            'python': sys.executable, 'sleep_sec': tool_sec})
+    _write_script(
+        os.path.join(build_tools, 'zipalign'), _TOOL % {
+            'copy': True, 'output': '', 'python': sys.executable,
+            'sleep_sec': tool_sec})
+    _write_script(
+        os.path.join(path, 'platform-tools', 'adb'), _TOOL % {
+            'copy': False, 'output': '', 'python': sys.executable,
+            'sleep_sec': 0})
+    _write(os.path.join(path, 'platforms', 'android-21', 'android.jar'), '')
+    _write_script(
+        os.path.join(bin_path, 'jarsigner'), _TOOL % {
+            'copy': False, 'output': 'jar signed.\n',
+            'python': sys.executable, 'sleep_sec': tool_sec})
+
+
+def _get_longest_match(values, command, default):
+    matches = [prefix for prefix in values if command.startswith(prefix)]
+
+    if not matches:
+        return default
+
+    return values[max(matches, key=len)]
+
+
+def _write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def _write_script(path, contents):
+    _write(path, contents)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+
+
+class _FakeAdbHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        fake = self.server.fake
+        request = self._read_request()
+
+        if request == 'host:devices':
+            self._okay(''.join(
+                '%s\t%s\n' % item for item in sorted(fake.devices.items())))
+        elif request.startswith('host:transport:'):
+            serial = request[len('host:transport:'):]
+
+            if fake.devices.get(serial) != 'device':
+                self._fail('device \'%s\' not found' % serial)
+                return
+
+            self.request.sendall('OKAY')
+            self._handle_device(serial, self._read_request())
+        else:
+            self._fail('unknown host service')
+
+    def _fail(self, message):
+        self.request.sendall('FAIL%04x%s' % (len(message), message))
+
+    def _handle_device(self, serial, request):
+        fake = self.server.fake
+
+        if request.startswith('shell:'):
+            self.request.sendall('OKAY')
+            time.sleep(fake.get_shell_delay_sec(request[6:]))
+            self.request.sendall(fake.get_shell_response(request[6:]))
+        elif request == 'sync:':
+            self.request.sendall('OKAY')
+            self._handle_sync(serial)
+        else:
+            self._fail('unknown device service')
+
+    def _handle_sync(self, serial):
+        fake = self.server.fake
+
+        while True:
+            packet_id, length = self._read_sync_packet()
+
+            if packet_id == 'QUIT':
+                return
+            elif packet_id == 'RECV':
+                path = self._read_exactly(length)
+                contents = fake.files.get((serial, path))
+
+                if contents is None:
+                    message = 'No such file or directory'
+                    self._send_sync_packet('FAIL', len(message))
+                    self.request.sendall(message)
+                    return
+
+                self._send_sync_packet('DATA', len(contents))
+                self.request.sendall(contents)
+                self._send_sync_packet('DONE', 0)
+            elif packet_id == 'SEND':
+                path = self._read_exactly(length).rsplit(',', 1)[0]
+                chunks = []
+
+                while True:
+                    packet_id, length = self._read_sync_packet()
+                    if packet_id == 'DONE':
+                        break
+
+                    chunks.append(self._read_exactly(length))
+
+                fake.files[(serial, path)] = ''.join(chunks)
+                self._send_sync_packet('OKAY', 0)
+            else:
+                return
+
+    def _okay(self, data):
+        self.request.sendall('OKAY%04x%s' % (len(data), data))
+
+    def _read_exactly(self, length):
+        data = ''
+
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                raise adb.ProtocolError('Client closed connection')
+
+            data += chunk
+
+        return data
+
+    def _read_request(self):
+        request = self._read_exactly(int(self._read_exactly(4), 16))
+        self.server.fake.requests.append(request)
+        return request
+
+    def _read_sync_packet(self):
+        return struct.unpack('<4sI', self._read_exactly(8))
+
+    def _send_sync_packet(self, packet_id, length):
+        self.request.sendall(struct.pack('<4sI', packet_id, length))
+
+
+class _FakeAdbSocketServer(SocketServer.ThreadingTCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
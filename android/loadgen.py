@@ -0,0 +1,446 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generates load against a worker's server.py the way the balancer does.
+
+Each session replays what client.js and the balancer send for one click of
+Run: GET /rest/v1/project, POST /rest/v1 with a patch of the editor file, then
+polling until the run is done. By default polling is GET /rest/v1 every 3
+seconds for up to 90, as client.js does through the balancer; --poll status
+long-polls /rest/v1/status instead and then fetches /rest/v1/image.
+
+Sessions arrive at --rate per second (Poisson arrivals, run by up to --clients
+threads at once), or with --rate 0 each client starts its next session as soon
+as its last one ends. Every patch is distinct unless --distinct_patches caps
+how many there are, so runs aren't answered from the result cache.
+
+Every --sample_sec a line reports sessions, throughput and, given --pid, the
+server's RSS and thread count from /proc. At the end it reports outcomes
+(including the 'Worker locked' rate) and latency percentiles per route. Point
+it at a server on fake SDK tools, from python bench.py --serve, to find where
+a worker breaks before a live lab does. Usage:
+
+    python loadgen.py --url http://localhost:8080 --project Example \\
+        --rate 2 --clients 50 --duration_sec 120 --pid 1234
+"""
+
+import argparse
+import httplib
+import json
+import logging
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+_LOG = logging.getLogger('android.loadgen')
+_OUTCOME_COMPLETE = 'complete'
+_OUTCOME_ERROR = 'error'
+_OUTCOME_LOCKED = 'locked'
+_OUTCOME_REJECTED = 'rejected'
+_OUTCOME_TIMEOUT = 'timeout'
+_POLL_RUN = 'run'
+_POLL_STATUS = 'status'
+_POLLS = [_POLL_RUN, _POLL_STATUS]
+_PROC_STATUS_TEMPLATE = '/proc/%s/status'
+_ROUTE_CREATE = '/rest/v1 (create)'
+_ROUTE_IMAGE = '/rest/v1/image'
+_ROUTE_PROJECT = '/rest/v1/project'
+_ROUTE_RUN = '/rest/v1'
+_ROUTE_STATUS = '/rest/v1/status'
+_STATUS_RUNNING = 'running'
+_WORKER_LOCKED = 'Worker locked'
+
+_PARSER = argparse.ArgumentParser()
+_PARSER.add_argument(
+    '--clients', type=int, default=10,
+    help='Most sessions in flight at once')
+_PARSER.add_argument(
+    '--distinct_patches', type=int, default=0,
+    help=('Cycle through this many distinct patches so repeats hit the result '
+          'cache; 0 makes every patch distinct'))
+_PARSER.add_argument(
+    '--duration_sec', type=float, default=60,
+    help='Seconds to start new sessions for')
+_PARSER.add_argument(
+    '--json', type=str, default=None,
+    help='Path of a file to write the raw results to as JSON')
+_PARSER.add_argument(
+    '--pid', type=int, default=None,
+    help='PID of the server, to sample its RSS and threads')
+_PARSER.add_argument(
+    '--poll', type=str, choices=_POLLS, default=_POLL_RUN,
+    help=('Poll GET /rest/v1 at --poll_interval_sec as the balancer does, or '
+          'long-poll /rest/v1/status'))
+_PARSER.add_argument(
+    '--poll_interval_sec', type=float, default=3,
+    help='Seconds between polls of GET /rest/v1')
+_PARSER.add_argument(
+    '--poll_timeout_sec', type=float, default=90,
+    help='Seconds after which a session gives up on its run')
+_PARSER.add_argument(
+    '--project', type=str, required=True, help='Name of the project to run')
+_PARSER.add_argument(
+    '--rate', type=float, default=1,
+    help='Sessions started per second; 0 runs clients back to back')
+_PARSER.add_argument(
+    '--sample_sec', type=float, default=5,
+    help='Seconds between progress lines')
+_PARSER.add_argument(
+    '--url', type=str, default='http://localhost:8080',
+    help='Base URL of the server')
+_PARSER.add_argument(
+    '--wait_sec', type=float, default=30,
+    help='wait_sec of each long poll of /rest/v1/status')
+
+
+class LoadGenerator(object):
+    """Runs sessions against a server and records what they saw."""
+
+    def __init__(self, args):
+        self.outcomes = {}
+        self.routes = {}
+        self.samples = []
+        self.sessions = []
+        self._args = args
+        self._done = threading.Event()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._pending = Queue.Queue()
+        self._started = 0
+        self._start_sec = None
+        url = urlparse.urlparse(args.url)
+        self._host = url.hostname
+        self._port = url.port or 80
+
+    def run(self):
+        self._start_sec = time.time()
+        sampler = threading.Thread(target=self._sample)
+        sampler.daemon = True
+        sampler.start()
+        clients = []
+
+        for _ in range(self._args.clients):
+            client = threading.Thread(target=self._run_client)
+            client.daemon = True
+            client.start()
+            clients.append(client)
+
+        if self._args.rate > 0:
+            self._arrive()
+
+            for _ in clients:
+                self._pending.put(None)
+
+        for client in clients:
+            # join() with a timeout so KeyboardInterrupt gets through.
+            while client.is_alive():
+                client.join(1)
+
+        self._done.set()
+        sampler.join()
+        self._record_sample()
+
+    def _arrive(self):
+        # Poisson arrivals; sessions wait here while every client is busy.
+        deadline = self._start_sec + self._args.duration_sec
+        arrival_sec = self._start_sec
+
+        while True:
+            arrival_sec += random.expovariate(self._args.rate)
+            if arrival_sec >= deadline:
+                break
+
+            time.sleep(max(arrival_sec - time.time(), 0))
+            self._pending.put(arrival_sec)
+
+    def _get(self, route, path, request, headers=None):
+        return self._request(
+            route, 'GET', '%s?%s' % (path, urllib.urlencode(
+                {'request': json.dumps(request)})), headers=headers)
+
+    def _get_contents(self, contents, number):
+        if self._args.distinct_patches:
+            number %= self._args.distinct_patches
+
+        return '%s\n<!-- loadgen %s %s -->\n' % (contents, os.getpid(), number)
+
+    def _poll_run(self, ticket, worker_id, deadline):
+        while time.time() < deadline:
+            code, _, payload = self._get(
+                _ROUTE_RUN, '/rest/v1', {
+                    'ticket': ticket, 'worker_id': worker_id})
+
+            # client.js gives up on any response but a 200.
+            if code != 200:
+                return _OUTCOME_ERROR
+            elif payload.get('status') != _STATUS_RUNNING:
+                return payload.get('status')
+
+            time.sleep(self._args.poll_interval_sec)
+
+        return _OUTCOME_TIMEOUT
+
+    def _poll_status(self, ticket, worker_id, deadline):
+        etag = None
+
+        while time.time() < deadline:
+            request = {'ticket': ticket, 'worker_id': worker_id}
+            request['wait_sec'] = min(
+                self._args.wait_sec, max(deadline - time.time(), 0))
+            code, headers, payload = self._get(
+                _ROUTE_STATUS, '/rest/v1/status', request,
+                headers={'If-None-Match': etag} if etag else None)
+
+            if code == 304:
+                continue
+            elif code != 200:
+                return _OUTCOME_ERROR
+
+            etag = headers.get('etag')
+
+            if payload.get('status') != _STATUS_RUNNING:
+                if payload.get('image'):
+                    self._get(
+                        _ROUTE_IMAGE, '/rest/v1/image', {
+                            'ticket': ticket, 'worker_id': worker_id})
+
+                return payload.get('status')
+
+        return _OUTCOME_TIMEOUT
+
+    def _record(self, route, code, latency_sec):
+        with self._lock:
+            stats = self.routes.setdefault(
+                route, {'codes': {}, 'latencies_sec': []})
+            stats['codes'][code] = stats['codes'].get(code, 0) + 1
+            stats['latencies_sec'].append(latency_sec)
+
+    def _record_sample(self):
+        rss_kb, threads = _get_proc_status(self._args.pid)
+
+        with self._lock:
+            sample = {
+                'completed': len(self.sessions),
+                'elapsed_sec': time.time() - self._start_sec,
+                'in_flight': self._in_flight,
+                'locked': self.outcomes.get(_OUTCOME_LOCKED, 0),
+                'rss_kb': rss_kb,
+                'started': self._started,
+                'threads': threads,
+                'waiting': self._pending.qsize(),
+            }
+            self.samples.append(sample)
+
+        _LOG.info(
+            '%(elapsed_sec)6.1fs started %(started)s completed %(completed)s '
+            'in flight %(in_flight)s waiting %(waiting)s locked %(locked)s '
+            'server rss %(rss_kb)s kB threads %(threads)s', sample)
+
+    def _request(self, route, method, path, body=None, headers=None):
+        """Returns (code, headers, payload); code is None on socket errors."""
+
+        connection = httplib.HTTPConnection(
+            self._host, self._port, timeout=self._args.wait_sec + 30)
+        start_sec = time.time()
+        code = None
+        response_headers = {}
+        payload = None
+
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            code = response.status
+            response_headers = dict(response.getheaders())
+            data = response.read()
+
+            if response_headers.get('content-type', '').startswith(
+                    'text/javascript'):
+                payload = json.loads(data).get('payload')
+        except:  # Treat all errors the same. pylint: disable=bare-except
+            _LOG.debug('%s %s failed', method, path, exc_info=True)
+        finally:
+            connection.close()
+
+        self._record(route, code, time.time() - start_sec)
+        return code, response_headers, payload
+
+    def _run_client(self):
+        if self._args.rate > 0:
+            for arrival_sec in iter(self._pending.get, None):
+                self._run_session(arrival_sec)
+        else:
+            deadline = self._start_sec + self._args.duration_sec
+
+            while time.time() < deadline:
+                self._run_session(time.time())
+
+    def _run_session(self, arrival_sec):
+        with self._lock:
+            self._in_flight += 1
+            self._started += 1
+            number = self._started
+
+        start_sec = time.time()
+
+        try:
+            outcome = self._run_session_steps(number, start_sec)
+        except:  # Treat all errors the same. pylint: disable=bare-except
+            _LOG.debug('Session %s failed', number, exc_info=True)
+            outcome = _OUTCOME_ERROR
+
+        end_sec = time.time()
+
+        with self._lock:
+            self._in_flight -= 1
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.sessions.append({
+                'elapsed_sec': end_sec - start_sec,
+                'outcome': outcome,
+                'wait_sec': start_sec - arrival_sec,
+            })
+
+    def _run_session_steps(self, number, start_sec):
+        code, _, payload = self._get(
+            _ROUTE_PROJECT, '/rest/v1/project',
+            {'payload': {'project': self._args.project}})
+
+        if code != 200:
+            return _OUTCOME_ERROR
+
+        ticket = uuid.uuid4().hex
+        code, _, response = self._request(
+            _ROUTE_CREATE, 'POST', '/rest/v1', body=json.dumps({
+                'payload': {
+                    'patches': [{
+                        'contents': self._get_contents(
+                            payload['contents'], number),
+                        'filename': payload['filename'],
+                    }],
+                    'project': self._args.project,
+                },
+                'ticket': ticket,
+            }), headers={'Content-Type': 'application/json'})
+
+        if code != 200:
+            return _OUTCOME_LOCKED if response == _WORKER_LOCKED else (
+                _OUTCOME_REJECTED)
+
+        deadline = start_sec + self._args.poll_timeout_sec
+        poll_fn = self._poll_status
+        if self._args.poll == _POLL_RUN:
+            poll_fn = self._poll_run
+
+        return poll_fn(ticket, response['worker_id'], deadline)
+
+    def _sample(self):
+        while not self._done.wait(self._args.sample_sec):
+            self._record_sample()
+
+
+def main(args):
+    logging.basicConfig(
+        format='%(asctime)s %(message)s', level=logging.INFO,
+        stream=sys.stdout)
+    generator = LoadGenerator(args)
+    generator.run()
+    _print_summary(generator)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps({
+                'outcomes': generator.outcomes,
+                'routes': generator.routes,
+                'samples': generator.samples,
+                'sessions': generator.sessions,
+            }, indent=2, sort_keys=True))
+
+
+def _get_percentile(values, percentile):
+    values = sorted(values)
+    if not values:
+        return 0
+
+    index = int(round((len(values) - 1) * percentile / 100.0))
+    return values[index]
+
+
+def _get_proc_status(pid):
+    """Gets (VmRSS in kB, thread count) of a local process, or Nones."""
+
+    rss_kb = threads = None
+    if pid is None:
+        return rss_kb, threads
+
+    try:
+        with open(_PROC_STATUS_TEMPLATE % pid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+
+                if key == 'VmRSS':
+                    rss_kb = int(value.split()[0])
+                elif key == 'Threads':
+                    threads = int(value)
+    except IOError:
+        pass
+
+    return rss_kb, threads
+
+
+def _print_summary(generator):
+    sessions = generator.sessions
+    elapsed_sec = generator.samples[-1]['elapsed_sec']
+    total = len(sessions) or 1
+    print '%s sessions in %.1fs; %.2f completed runs/s' % (
+        len(sessions), elapsed_sec,
+        generator.outcomes.get(_OUTCOME_COMPLETE, 0) / elapsed_sec)
+
+    for outcome, count in sorted(generator.outcomes.items()):
+        print '  %-22s %6s %6.1f%%' % (outcome, count, 100.0 * count / total)
+
+    print '  %-22s %7s %7s %7s %7s %7s %s' % (
+        'seconds', 'count', 'p50', 'p90', 'p99', 'max', 'codes')
+    rows = [
+        ('session', [session['elapsed_sec'] for session in sessions], {}),
+        ('session wait', [session['wait_sec'] for session in sessions], {}),
+    ]
+    rows.extend(
+        (route, stats['latencies_sec'], stats['codes'])
+        for route, stats in sorted(generator.routes.items()))
+
+    for name, values, codes in rows:
+        print '  %-22s %7s %7.3f %7.3f %7.3f %7.3f %s' % (
+            name, len(values), _get_percentile(values, 50),
+            _get_percentile(values, 90), _get_percentile(values, 99),
+            max(values) if values else 0, ' '.join(
+                '%s:%s' % item for item in sorted(codes.items())))
+
+    rss = [s['rss_kb'] for s in generator.samples if s['rss_kb'] is not None]
+    threads = [
+        s['threads'] for s in generator.samples if s['threads'] is not None]
+
+    if rss:
+        print 'server rss kB: start %s max %s end %s' % (
+            rss[0], max(rss), rss[-1])
+        print 'server threads: start %s max %s end %s' % (
+            threads[0], max(threads), threads[-1])
+
+
+if __name__ == '__main__':
+    main(_PARSER.parse_args())
@@ -16,17 +16,26 @@
 
 import argparse
 import BaseHTTPServer
+import bisect
 import collections
+import fcntl
 import json
 import logging
+import math
+import md5
 import os
+import Queue
 import re
-import SocketServer
+import select
+import socket
 import subprocess
 import sys
+import threading
+import time
 import traceback
 import urllib
 import urlparse
+import zlib
 
 import worker
 
@@ -35,25 +44,71 @@ _CHOICES = [
     _CHOICE_START
 ]
 _CLIENT_JS_PATH = os.path.join(worker.ROOT_PATH, 'client.js')
+# Smaller bodies aren't worth the CPU; JPEGs are already compressed.
+_COMPRESS_MIN_BYTES = 1024
+_METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+_COMPRESSIBLE_TYPES = frozenset([
+    _METRICS_CONTENT_TYPE, 'text/html', 'text/javascript'])
+_DEFAULT_BACKLOG = 128
+_DEFAULT_CONNECTION_TIMEOUT_SEC = 30
 _DEFAULT_HOST = subprocess.check_output(['hostname']).strip()
-_DEFAULT_PORT = 8080
 _DEFAULT_LOG_PATH = os.path.join(worker.ROOT_PATH, 'server.log')
+_DEFAULT_PORT = 8080
+_DEFAULT_SERVER_THREADS = 64
+_DEFAULT_STAGED_TREES = 2
+_ENCODED_ETAG = re.compile(r'-(deflate|gzip)"$')
+_ENCODING_DEFLATE = 'deflate'
+_ENCODING_GZIP = 'gzip'
+_EVENT_STREAM_KEEPALIVE_SEC = 15
+_EVENT_STREAM_MAX_SEC = 60 * 15
+_EVENTS_POLL_SEC = 1
+# How often idle connections are checked for expiry.
+_IDLE_POLL_MSEC = 1000
+_IMAGE = 'image'
+# A ticket's image never changes once written, so clients may keep it.
+_IMAGE_CACHE_CONTROL = 'public, max-age=31536000'
+_INDEX_EXPIRE_INTERVAL_SEC = 60
 _INDEX_HTML_PATH = os.path.join(worker.ROOT_PATH, 'index.html')
+# Upper bounds of the request latency histogram buckets.
+_LATENCY_BUCKETS_SEC = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 _LOG = logging.getLogger('android.server')
+_LONG_POLL_MAX_SEC = 60
+# Routes as labelled in metrics, matched by prefix in order.
+_METRICS_ROUTES = (
+    '/health', '/metrics', '/rest/v1/events', '/rest/v1/image',
+    '/rest/v1/project', '/rest/v1/status', '/rest/v1')
+_PROJECT = 'project'
+# Starter contents rarely change; caches revalidate with the ETag after this.
+_PROJECT_CACHE_CONTROL = 'public, max-age=60'
+_RESPONSE_CACHE_ENTRIES = 256
+# Sent with 503s for long polls and event streams over the waiting limit.
+_RETRY_AFTER_SEC = 1
+# How often emulator readiness is checked for /metrics.
+_SLOT_MONITOR_INTERVAL_SEC = 15
+# Upper bounds of the run stage duration histogram buckets.
+_STAGE_BUCKETS_SEC = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
 _STATUS = 'status'
+# Statuses change until the run finishes; clients must revalidate each poll.
+_STATUS_CACHE_CONTROL = 'no-cache'
 # Keep _STATUS_* in sync with _ExternalTask.STATUSES.
 _STATUS_COMPLETE = 'complete'
 _STATUS_CREATED = 'created'
 _STATUS_DELETED = 'deleted'
 _STATUS_FAILED = 'failed'
 _STATUS_RUNNING = 'running'
+_TEST_RUN = 'test_run'
 # Translates from worker statuses to fe statuses.
 _STATUS_MAP = {
     worker.TestRun.BUILD_FAILED: _STATUS_FAILED,
     worker.TestRun.BUILD_SUCCEEDED: _STATUS_RUNNING,
     worker.TestRun.CONTENTS_MALFORMED: _STATUS_FAILED,
+    worker.TestRun.CRASHED: _STATUS_FAILED,
+    worker.TestRun.DEVICE_FAILED: _STATUS_FAILED,
     worker.TestRun.NOT_FOUND: _STATUS_FAILED,
     worker.TestRun.PROJECT_MISCONFIGURED: _STATUS_FAILED,
+    # Queued runs read as running so clients keep polling.
+    worker.TestRun.QUEUED: _STATUS_RUNNING,
     worker.TestRun.RUNTIME_MISCONFIGURED: _STATUS_FAILED,
     worker.TestRun.RUNTIME_NOT_RUNNING: _STATUS_FAILED,
     worker.TestRun.TESTS_FAILED: _STATUS_FAILED,
@@ -66,6 +121,17 @@ _TICKET = 'ticket'
 _WORKER_ID = 'worker_id'
 
 _PARSER = argparse.ArgumentParser()
+_PARSER.add_argument(
+    '--backlog', type=int, default=_DEFAULT_BACKLOG,
+    help='Maximum number of connections waiting to be accepted')
+_PARSER.add_argument(
+    '--connection_timeout_sec', type=float,
+    default=_DEFAULT_CONNECTION_TIMEOUT_SEC,
+    help='Seconds an idle or stalled connection is kept open')
+_PARSER.add_argument(
+    '--incremental_builds', action='store_true',
+    help=('Build in persistent per-project working trees so gradle only reruns '
+          'tasks affected by each patch'))
 _PARSER.add_argument(
     '--log_file', type=str, default=_DEFAULT_LOG_PATH,
     help='Absolute path of the file used for logging')
@@ -77,8 +143,29 @@ _PARSER.add_argument(
     '--host', type=str, default=_DEFAULT_HOST, help='Host to run on')
 _PARSER.add_argument(
     '--port', type=int, default=_DEFAULT_PORT, help='Port to run on')
+_PARSER.add_argument(
+    '--queue_size', type=int, default=worker.AdmissionQueue.DEFAULT_MAX_SIZE,
+    help='Maximum number of submissions waiting for a free slot')
+_PARSER.add_argument(
+    '--result_cache_size', type=int,
+    default=worker.ResultCache.DEFAULT_MAX_ENTRIES,
+    help='Maximum number of submissions whose results are reused')
+_PARSER.add_argument(
+    '--results_quota_bytes', type=int, default=None,
+    help=('Maximum bytes of results kept; the oldest are removed first. '
+          'Unlimited by default'))
+_PARSER.add_argument(
+    '--server_threads', type=int, default=_DEFAULT_SERVER_THREADS,
+    help=('Number of threads handling requests; idle connections wait without '
+          'one, and at most three quarters hold one for a long poll or event '
+          'stream'))
+_PARSER.add_argument(
+    '--staged_trees', type=int, default=_DEFAULT_STAGED_TREES,
+    help='Number of ready-staged trees to keep per project')
 
 
+_RunIndexEntry = collections.namedtuple(
+    '_RunIndexEntry', ['version', 'test_run', 'updated_sec'])
 _SystemState = collections.namedtuple(
     '_SystemState',
     ['success', 'project_name', 'request_args', 'config', 'project', 'runtime'])
@@ -86,8 +173,20 @@ _SystemState = collections.namedtuple(
 
 class _Environment(object):
 
+    ADMISSION_QUEUE = None
+    CATALOG = worker.Catalog()
+    EVENTS = worker.RunEvents()
     HOST = None
+    INCREMENTAL_BUILDS = False
+    METRICS = None
     PORT = None
+    PROJECT_CONTENTS = None
+    RESPONSE_BODIES = None
+    RESULT_CACHE = worker.ResultCache()
+    RESULT_REAPER = None
+    RUN_INDEX = None
+    SERVER = None
+    SLOT_MONITOR = None
 
     @classmethod
     def get_worker_id(cls):
@@ -95,14 +194,21 @@ class _Environment(object):
         return 'http://%s:%s' % (cls.HOST, cls.PORT)
 
     @classmethod
-    def set(cls, host, port):
+    def set(
+            cls, host, port, incremental_builds=False,
+            result_cache_size=worker.ResultCache.DEFAULT_MAX_ENTRIES):
         cls.HOST = host
+        cls.INCREMENTAL_BUILDS = incremental_builds
         cls.PORT = port
+        cls.RESULT_CACHE = worker.ResultCache(max_entries=result_cache_size)
 
 
 class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     _POST_DELETE = re.compile('^/.*/delete$')
+    # Keep connections open between requests, so every response must either
+    # send Content-Length or close the connection.
+    protocol_version = 'HTTP/1.1'
 
     def _dispatch_rest_post(self):
         if self._POST_DELETE.match(self.path):
@@ -110,6 +216,13 @@ class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             self._do_rest_POST_create()
 
+    def _do_304_response(self, etag, cache_control):
+        self.send_response(304)
+        self._set_headers({
+            'Cache-Control': cache_control,
+            'ETag': etag,
+        })
+
     def _do_404_response(self):
         self.send_response(404)
         self._set_headers({
@@ -117,18 +230,105 @@ class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
             'Content-Type': 'text/html',
         })
 
+    def _do_503_response(self):
+        self.send_response(503)
+        self._set_headers({
+            'Content-Length': 0,
+            'Content-Type': 'text/html',
+            'Retry-After': _RETRY_AFTER_SEC,
+        })
+
     def _do_GET_health(self):
         # 'Healthy' means 'can work on new tasks'. 'Unhealthy' workers can still
         # answer get requests for projects or task results -- probably. This
-        # health check could be made more robust.
-        self.send_response(500 if worker.Lock.active() else 200)
-        self._set_headers({'Content-Type': 'text/html'})
+        # health check could be made more robust. Busy workers still take
+        # submissions until their admission queue fills.
+        self.send_response(
+            500 if _Environment.ADMISSION_QUEUE.full() else 200)
+        self._set_headers({
+            'Content-Length': 0,
+            'Content-Type': 'text/html',
+        })
 
-    def _do_json_response(self, response, code=200):
-        full_response = {'payload': response}
+    def _do_GET_metrics(self):
+        slot_pool, ready = _Environment.SLOT_MONITOR.get()
+        results, result_bytes = _Environment.RESULT_REAPER.get_usage()
+        gauges = [
+            ('android_admission_queue_depth', {},
+             _Environment.ADMISSION_QUEUE.size()),
+            ('android_result_store_bytes', {}, result_bytes),
+            ('android_result_store_results', {}, results),
+        ]
+
+        # Nothing is known about slots until the monitor's first refresh.
+        if slot_pool is not None:
+            gauges.extend([
+                ('android_slots_busy', {}, slot_pool.busy_count()),
+                ('android_slots_total', {}, slot_pool.size()),
+            ])
+
+        for serial, value in sorted(ready.iteritems()):
+            gauges.append((
+                'android_emulator_ready', {'serial': serial}, int(value)))
+
+        self._do_body_response(
+            _Environment.METRICS.render(gauges), {
+                'Cache-Control': 'no-cache',
+                'Content-Type': _METRICS_CONTENT_TYPE,
+            })
+
+    def _do_body_response(self, body, headers, code=200, cache_key=None):
+        """Sends body, compressed if it's large and the client accepts that.
+
+        If cache_key is given, the compressed form is cached under it, so
+        repeated requests for an unchanging body compress it only once.
+        """
+
+        encoding = self._get_body_encoding(body, headers['Content-Type'])
+
+        if encoding:
+            if cache_key is None:
+                body = _compress(body, encoding)
+            else:
+                body = _Environment.RESPONSE_BODIES.get(
+                    cache_key + (encoding,),
+                    lambda: _compress(body, encoding))
+
+            headers['Content-Encoding'] = encoding
+
+            if 'ETag' in headers:
+                headers['ETag'] = _get_encoded_etag(headers['ETag'], encoding)
+
+        headers['Content-Length'] = len(body)
+        headers['Vary'] = 'Accept-Encoding'
         self.send_response(code)
-        self._set_headers({'Content-Type': 'text/javascript'})
-        self.wfile.write(json.dumps(full_response))
+        self._set_headers(headers)
+        self.wfile.write(body)
+
+    def _do_cacheable_response(
+            self, body, content_type, cache_control, code=200, etag=None,
+            cache_key=None):
+        """Sends body with a strong ETag, or 304 if the client has it."""
+
+        if etag is None:
+            etag = _get_etag(body)
+
+        if code == 200 and self._etag_matches(etag):
+            encoding = self._get_body_encoding(body, content_type)
+            self._do_304_response(
+                _get_encoded_etag(etag, encoding), cache_control)
+            return
+
+        self._do_body_response(body, {
+            'Cache-Control': cache_control,
+            'Content-Type': content_type,
+            'ETag': etag,
+        }, code=code, cache_key=cache_key)
+
+    def _do_json_response(self, response, code=200):
+        self._do_body_response(
+            json.dumps({'payload': response}),
+            {'Content-Type': 'text/javascript'}, code=code)
 
     def _do_rest_GET_project(self):
         state = self._get_system_state_or_record_error(
@@ -136,42 +336,172 @@ class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
         if not state.success:
             return
 
-        contents = None
-        with open(state.project.editor_file) as f:
-            contents = f.read()
+        body = _Environment.PROJECT_CONTENTS.get(state.project)
+        etag = _get_etag(body)
+        self._do_cacheable_response(
+            body, 'text/javascript', _PROJECT_CACHE_CONTROL, etag=etag,
+            cache_key=(_PROJECT, etag))
 
-        self._do_json_response({
-            'contents': contents,
-            'filename': state.project.editor_file,
-            'projectName': state.project_name,
-        })
+    def _do_rest_GET_events(self):
+        """Streams a run's updates as Server-Sent Events until it is done.
 
-    def _do_rest_GET_test_run(self):
-        request_args = self._get_get_args()
-        ticket = request_args.get(_TICKET)
-        worker_id = request_args.get(_WORKER_ID)
+        Each event is named for the run's stage and carries the same document
+        as _do_rest_GET_status.
+        """
 
-        if worker_id != _Environment.get_worker_id():
-            self._do_json_response('Request sent to wrong worker', code=500)
+        ticket = self._get_ticket_or_record_error()
+        if ticket is None:
+            return
+
+        waiting_slots = self.server.waiting_slots
+        if not waiting_slots.acquire(False):
+            self._do_503_response()
             return
 
+        run_index = _Environment.RUN_INDEX
+        # Subscribe before reading the run so no update is missed between.
+        updates = run_index.subscribe(ticket)
+
+        try:
+            # The stream's length isn't known, so it ends with the connection.
+            self.close_connection = 1
+            self.send_response(200)
+            self._set_headers({
+                'Cache-Control': 'no-cache',
+                'Connection': 'close',
+                'Content-Type': 'text/event-stream',
+            })
+
+            test_run = run_index.get_test_run(ticket)
+            deadline = time.time() + _EVENT_STREAM_MAX_SEC
+            last_event = None
+
+            if test_run.get_status() != worker.TestRun.NOT_FOUND:
+                last_event = self._write_event(test_run)
+
+            while not _is_done(test_run) and time.time() < deadline:
+                try:
+                    test_run = updates.get(timeout=_EVENT_STREAM_KEEPALIVE_SEC)
+                except Queue.Empty:
+                    self.wfile.write(': keepalive\n\n')
+                    continue
+
+                # The run read above may also arrive on the queue.
+                if _get_event(test_run) != last_event:
+                    last_event = self._write_event(test_run)
+        except socket.error:
+            _LOG.info('Event stream for ticket %s closed by client', ticket)
+        finally:
+            run_index.unsubscribe(ticket, updates)
+            waiting_slots.release()
+
+    def _do_rest_GET_image(self):
+        ticket = self._get_ticket_or_record_error()
+        if ticket is None:
+            return
+
+        test_run = _Environment.RUN_INDEX.get_test_run(ticket)
+        path = test_run.get_image_path()
         # Treat as module-protected. pylint: disable=protected-access
-        test_run = worker._TestEnvironment.get_test_run(ticket)
-        code = 200
+        stat_key = path and worker._get_stat_key(path)
+        image = []
+
+        def get_etag():
+            image.append(test_run.get_image())
+            return image[0] and _get_etag(image[0])
+
+        # Revalidations are answered from the ETag alone, without reading the
+        # image; it is hashed once per ticket and image file.
+        etag = stat_key and _Environment.RESPONSE_BODIES.get(
+            (_IMAGE, ticket, stat_key), get_etag)
+        if not etag:
+            self._do_404_response()
+            return
+
+        if self._etag_matches(etag):
+            self._do_304_response(etag, _IMAGE_CACHE_CONTROL)
+            return
+
+        image = image[0] if image else test_run.get_image()
+        if image is None:
+            self._do_404_response()
+            return
+
+        self._do_cacheable_response(
+            image, 'image/jpeg', _IMAGE_CACHE_CONTROL, etag=etag)
+
+    def _do_rest_GET_status(self):
+        """Like _do_rest_GET_test_run, but without the large parts of a run.
+
+        The result image, the payload (such as a failed build's log) and the
+        spans are left out, so frequent polls stay small. Fetch the image, if
+        any, from /rest/v1/image and the rest from /rest/v1. If the request has
+        wait_sec and If-None-Match matches the current status, the response is
+        held until the status changes or wait_sec passes (long polling), or
+        answered 503 if the server already holds as many as it allows.
+        """
+
+        ticket = self._get_ticket_or_record_error()
+        if ticket is None:
+            return
+
+        wait_sec = self._get_wait_sec_or_record_error()
+        if wait_sec is None:
+            return
 
-        status = test_run.get_status()
-        if status == worker.TestRun.NOT_FOUND:
+        run_index = _Environment.RUN_INDEX
+        deadline = time.time() + wait_sec
+        waiting_slots = self.server.waiting_slots
+        waiting = False
+
+        try:
+            while True:
+                version = run_index.get_version(ticket)
+                test_run = run_index.get_test_run(ticket)
+                body, etag, cache_key = _get_run_body(
+                    _STATUS, ticket, version, test_run, _get_status_dict)
+                remaining_sec = deadline - time.time()
+
+                if remaining_sec <= 0 or not self._etag_matches(etag):
+                    break
+
+                if not (waiting or waiting_slots.acquire(False)):
+                    self._do_503_response()
+                    return
+
+                waiting = True
+                run_index.wait(ticket, version, remaining_sec)
+        finally:
+            if waiting:
+                waiting_slots.release()
+
+        code = 200
+        if test_run.get_status() == worker.TestRun.NOT_FOUND:
             code = 404
 
-        result = test_run.to_dict()
-        result[_STATUS] = _STATUS_MAP.get(status)
-        self._do_json_response(result, code=code)
+        self._do_cacheable_response(
+            body, 'text/javascript', _STATUS_CACHE_CONTROL, code=code,
+            etag=etag, cache_key=cache_key)
 
-    def _do_rest_POST_create(self):
-        if worker.Lock.active():
-            self._do_json_response('Worker locked', code=500)
+    def _do_rest_GET_test_run(self):
+        ticket = self._get_ticket_or_record_error()
+        if ticket is None:
             return
 
+        run_index = _Environment.RUN_INDEX
+        version = run_index.get_version(ticket)
+        test_run = run_index.get_test_run(ticket)
+        code = 200
+        if test_run.get_status() == worker.TestRun.NOT_FOUND:
+            code = 404
+
+        body, _, cache_key = _get_run_body(
+            _TEST_RUN, ticket, version, test_run, _get_test_run_dict)
+        self._do_body_response(
+            body, {'Content-Type': 'text/javascript'}, code=code,
+            cache_key=cache_key)
+
+    def _do_rest_POST_create(self):
         state = self._get_system_state_or_record_error(
             get_request_args_fn=self._get_post_args)
         if not state.success:
@@ -182,19 +512,94 @@ class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
             patches.append(worker.Patch(patch['filename'], patch['contents']))
 
         ticket = state.request_args.get('ticket')
-        pid = worker.fork_test(
-            state.config, state.project_name, ticket, patches=patches)
+        cache_key = worker.ResultCache.get_key(state.project, patches)
+        source_ticket = _Environment.RESULT_CACHE.lookup(
+            cache_key, get_test_run_fn=_Environment.RUN_INDEX.get_test_run)
+
+        if source_ticket is None:
+            source_ticket = _Environment.RESULT_CACHE.reserve(
+                cache_key, ticket)
 
-        if pid is None:
-            self._do_json_response('Unable to start worker process', code=500)
+        if source_ticket is not None:
+            _LOG.info(
+                'Ticket %s matches run of ticket %s; reusing its result',
+                ticket, source_ticket)
+            _Environment.RESULT_CACHE.alias(ticket, source_ticket)
+            self._do_json_response({
+                _TICKET: ticket,
+                _WORKER_ID: _Environment.get_worker_id(),
+            })
+            return
+
+        try:
+            position = _Environment.ADMISSION_QUEUE.submit(
+                state.project_name, ticket, patches)
+        except worker.QueueFullError:
+            _Environment.RESULT_CACHE.discard(ticket)
+            self._do_json_response('Worker locked', code=500)
+            return
 
         self._do_json_response({
+            'queue_position': position,
             _TICKET: ticket,
             _WORKER_ID: _Environment.get_worker_id(),
         })
 
     def _do_rest_POST_delete(self):
         _LOG.info('TODO: implement rest POST delete')
+        # No response is sent, so the client sees the connection close.
+        self.close_connection = 1
+
+    def _etag_matches(self, etag):
+        header = self.headers.getheader('if-none-match')
+        if not header:
+            return False
+
+        # Match ETags sent with compressed bodies to the uncompressed ETag.
+        candidates = [
+            _ENCODED_ETAG.sub('"', candidate.strip())
+            for candidate in header.split(',')]
+        return etag in candidates or '*' in candidates
+
+    def _get_body_encoding(self, body, content_type):
+        """Gets the encoding to send body with, or None to send it as is."""
+
+        if (len(body) < _COMPRESS_MIN_BYTES or
+                content_type not in _COMPRESSIBLE_TYPES):
+            return None
+
+        return self._get_accepted_encoding()
+
+    def _get_accepted_encoding(self):
+        """Gets the preferred encoding the client accepts, or None."""
+
+        accepted = set()
+        refused = set()
+        header = self.headers.getheader('accept-encoding') or ''
+
+        for part in header.split(','):
+            params = part.strip().split(';')
+            coding = params[0].strip().lower()
+            quality = 1.0
+
+            for param in params[1:]:
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+
+            if coding:
+                (accepted if quality > 0 else refused).add(coding)
+
+        # '*' stands only for codings not listed on their own.
+        for encoding in (_ENCODING_GZIP, _ENCODING_DEFLATE):
+            if encoding in accepted or (
+                    '*' in accepted and encoding not in refused):
+                return encoding
+
+        return None
 
     def _get_get_args(self):
         encoded = urlparse.urlparse(self.path).query.lstrip('request=')
@@ -208,7 +613,7 @@ class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
         return path.split('=')[1]
 
     def _get_system_state_or_record_error(self, get_request_args_fn=None):
-        config = worker.Config.load()
+        config = _Environment.CATALOG.get()
         request_args = get_request_args_fn()
         payload = request_args.get('payload', {})
         project_name = payload.get('project', None)
@@ -231,28 +636,118 @@ class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
         return _SystemState(
             True, project_name, request_args, config, project, runtime)
 
+    def _get_ticket_or_record_error(self):
+        """Gets the ticket whose run answers the request's ticket."""
+
+        request_args = self._get_get_args()
+        ticket = request_args.get(_TICKET)
+        worker_id = request_args.get(_WORKER_ID)
+
+        if worker_id != _Environment.get_worker_id():
+            self._do_json_response('Request sent to wrong worker', code=500)
+            return None
+
+        return _Environment.RESULT_CACHE.resolve(ticket)
+
+    def _get_wait_sec_or_record_error(self):
+        """Gets the request's wait_sec, at most _LONG_POLL_MAX_SEC."""
+
+        try:
+            wait_sec = float(self._get_get_args().get('wait_sec', 0))
+        except (TypeError, ValueError):
+            wait_sec = None
+
+        # json.loads accepts NaN and Infinity; NaN would never time out.
+        if wait_sec is None or math.isnan(wait_sec) or math.isinf(
+                wait_sec) or wait_sec < 0:
+            self._do_json_response(
+                'wait_sec must be a non-negative number', code=400)
+            return None
+
+        return min(wait_sec, _LONG_POLL_MAX_SEC)
+
+    def _has_buffered_input(self):
+        # Pipelined requests already read from the socket wait in rfile.
+        # Treat as module-protected. pylint: disable=protected-access
+        return self.rfile._rbuf.tell() > 0
+
     def _set_headers(self, headers):
         for key, value in headers.iteritems():
             self.send_header(key, value)
 
         self.end_headers()
 
-    def do_GET(self):
+    def _write_event(self, test_run):
+        event = _get_event(test_run)
+        self.wfile.write(event)
+        self.wfile.flush()
+        return event
+
+    def _dispatch_get(self):
         if self.path == '/health':
             self._do_GET_health()
+        elif self.path == '/metrics':
+            self._do_GET_metrics()
+        elif self.path.startswith('/rest/v1/events'):
+            self._do_rest_GET_events()
+        elif self.path.startswith('/rest/v1/image'):
+            self._do_rest_GET_image()
         elif self.path.startswith('/rest/v1/project'):
             self._do_rest_GET_project()
+        elif self.path.startswith('/rest/v1/status'):
+            self._do_rest_GET_status()
         elif self.path.startswith('/rest/v1'):
             self._do_rest_GET_test_run()
         else:
             self._do_404_response()
 
-    def do_POST(self):
+    def _dispatch_post(self):
         if self.path.startswith('/rest/v1'):
             self._dispatch_rest_post()
         else:
             self._do_404_response()
 
+    def _do_observed(self, dispatch_fn):
+        start_sec = time.time()
+        self._code = None
+
+        try:
+            dispatch_fn()
+        finally:
+            _Environment.METRICS.observe_request(
+                self.command, _get_route(self.path), self._code,
+                time.time() - start_sec)
+
+    def do_GET(self):
+        self._do_observed(self._dispatch_get)
+
+    def do_POST(self):
+        self._do_observed(self._dispatch_post)
+
+    def send_response(self, code, message=None):
+        self._code = code
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(
+            self, code, message=message)
+
+    def handle(self):
+        """Handles requests until the connection closes or goes idle.
+
+        An idle keep-alive connection is left open with close_connection unset
+        for _HttpServer to wait on without holding this thread.
+        """
+
+        self.close_connection = 1
+        self.handle_one_request()
+
+        while not self.close_connection and self._has_buffered_input():
+            self.handle_one_request()
+
+    def setup(self):
+        # Applies to each read and write, so a stalled client can't hold a
+        # thread mid-request.
+        self.timeout = self.server.connection_timeout_sec
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
     def log_message(self, format_template, *args):
         _LOG.info('%(address)s - - [%(timestamp)s] %(rest)s', {
             'address': self.address_string(),
@@ -261,28 +756,747 @@ class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
         })
 
 
-class _HttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+class _HttpServer(BaseHTTPServer.HTTPServer):
+    """HTTP server that handles requests on a fixed pool of threads.
+
+    A thread holds a connection only while it has a request to handle. New
+    and idle keep-alive connections wait in _IdleConnections, which polls
+    them all on one thread and queues each for the pool when it has input,
+    so accepting never blocks on the pool. Long polls and event streams hold
+    their thread while they wait, so at most max_waiting of them run at once
+    and the rest get a 503 to retry, leaving threads for everything else.
+    """
+
     # Allow address reuse immediately after a server has stopped so we don't get
     # spurious errors during dev.
     allow_reuse_address = True
 
+    def __init__(
+            self, server_address, handler_class,
+            threads=_DEFAULT_SERVER_THREADS, backlog=_DEFAULT_BACKLOG,
+            connection_timeout_sec=_DEFAULT_CONNECTION_TIMEOUT_SEC,
+            max_waiting=None):
+        # Read by server_activate(), which the base constructor calls.
+        self.request_queue_size = backlog
+        self.connection_timeout_sec = connection_timeout_sec
+
+        if max_waiting is None:
+            max_waiting = max(threads - threads // 4, 1)
+
+        self.waiting_slots = threading.BoundedSemaphore(max_waiting)
+        self._requests = Queue.Queue()
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, handler_class)
+        self._idle = _IdleConnections(
+            self._queue_request, self.shutdown_request,
+            connection_timeout_sec)
+        self._idle.start()
+
+        for _ in range(threads):
+            thread = threading.Thread(target=self._serve_requests)
+            thread.daemon = True
+            thread.start()
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def process_request(self, request, client_address):
+        self._idle.add(request, client_address)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self._idle.stop()
+
+    def _queue_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _serve_requests(self):
+        while True:
+            request, client_address = self._requests.get()
+            keep_alive = False
+
+            try:
+                handler = self.finish_request(request, client_address)
+                keep_alive = not handler.close_connection
+            except socket.error:
+                _LOG.info('Connection from %s closed by client', client_address)
+            except:  # Treat all errors the same. pylint: disable=bare-except
+                self.handle_error(request, client_address)
+            finally:
+                if keep_alive:
+                    self._idle.add(request, client_address)
+                else:
+                    self.shutdown_request(request)
+
+
+class _IdleConnections(object):
+    """Connections waiting for their next request, polled on one thread.
+
+    ready_fn(request, client_address) is called for each connection once it
+    has input or is closed by its client, and close_fn(request) for each
+    idle for timeout_sec.
+    """
+
+    def __init__(self, ready_fn, close_fn, timeout_sec):
+        self._added = []
+        self._close_fn = close_fn
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._poll = select.poll()
+        self._ready_fn = ready_fn
+        self._running = False
+        self._thread = None
+        self._timeout_sec = timeout_sec
+        self._wake_read, self._wake_write = os.pipe()
+        # Many adds may wake the loop at once; one pending byte is enough.
+        fcntl.fcntl(self._wake_write, fcntl.F_SETFL, os.O_NONBLOCK)
+
+    def add(self, request, client_address):
+        with self._lock:
+            self._added.append((request, client_address))
+
+        self._wake()
+
+    def start(self):
+        self._poll.register(self._wake_read, select.POLLIN)
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wake()
+        self._thread.join()
+
+        with self._lock:
+            added, self._added = self._added, []
+
+        for request, _ in added + self._connections.values():
+            self._close_fn(request)
+
+        self._connections.clear()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _expire(self, now_sec):
+        for fd, (request, _, since_sec) in self._connections.items():
+            if now_sec - since_sec >= self._timeout_sec:
+                self._unregister(fd)
+                self._close_fn(request)
+
+    def _register(self, request, client_address, now_sec):
+        try:
+            fd = request.fileno()
+            self._poll.register(fd, select.POLLIN)
+        except (select.error, socket.error):
+            self._close_fn(request)
+            return
+
+        self._connections[fd] = (request, client_address, now_sec)
+
+    def _run(self):
+        expired_sec = time.time()
+
+        while self._running:
+            try:
+                events = self._poll.poll(_IDLE_POLL_MSEC)
+            except select.error:  # Interrupted by a signal.
+                continue
+
+            now_sec = time.time()
+
+            for fd, _ in events:
+                if fd == self._wake_read:
+                    os.read(self._wake_read, 4096)
+                elif fd in self._connections:
+                    request, client_address, _ = self._unregister(fd)
+                    self._ready_fn(request, client_address)
+
+            with self._lock:
+                added, self._added = self._added, []
+
+            for request, client_address in added:
+                self._register(request, client_address, now_sec)
+
+            if now_sec - expired_sec >= _IDLE_POLL_MSEC / 1000.0:
+                self._expire(now_sec)
+                expired_sec = now_sec
+
+    def _unregister(self, fd):
+        self._poll.unregister(fd)
+        return self._connections.pop(fd)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_write, 'x')
+        except OSError:  # Already awake, or stopped.
+            pass
+
+
+class _Metrics(object):
+    """Counters and histograms served by /metrics in Prometheus text format.
+
+    Handlers observe each request. Runs are observed from their final TestRun
+    as the run index receives it over worker.RunEvents, so counts cover every
+    forked run process. Gauges are read at scrape time and passed to render().
+    """
+
+    _HELP = {
+        'android_admission_queue_depth': (
+            'gauge', 'Submissions waiting for a free slot.'),
+        'android_emulator_ready': (
+            'gauge', 'Whether the emulator in each slot was booted when last '
+            'checked.'),
+        'android_http_request_duration_seconds': (
+            'histogram', 'Time to handle a request, by route.'),
+        'android_http_requests_total': (
+            'counter', 'Requests handled, by route and response code.'),
+        'android_result_store_bytes': (
+            'gauge', 'Bytes of finished runs\' results kept.'),
+        'android_result_store_results': (
+            'gauge', 'Finished runs whose results are kept.'),
+        'android_run_stage_duration_seconds': (
+            'histogram', 'Time runs spent in each top-level span.'),
+        'android_runs_total': (
+            'counter', 'Finished runs, by status; crashed for runs whose '
+            'process exited with an error first.'),
+        'android_slots_busy': ('gauge', 'Emulator slots leased by runs.'),
+        'android_slots_total': ('gauge', 'Emulator slots.'),
+    }
+
+    def __init__(self):
+        self._counters = collections.defaultdict(int)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe_request(self, method, route, code, duration_sec):
+        labels = {'method': method, 'route': route}
+
+        with self._lock:
+            self._count(
+                'android_http_requests_total',
+                dict(labels, code=code or 'none'))
+            self._observe(
+                'android_http_request_duration_seconds', labels, duration_sec,
+                _LATENCY_BUCKETS_SEC)
+
+    def observe_run(self, test_run):
+        with self._lock:
+            self._count(
+                'android_runs_total', {'status': test_run.get_status()})
+
+            for span in test_run.get_spans():
+                if span['end_sec'] is not None and span['name'] != 'save':
+                    self._observe(
+                        'android_run_stage_duration_seconds',
+                        {'stage': span['name']},
+                        span['end_sec'] - span['start_sec'],
+                        _STAGE_BUCKETS_SEC)
+
+    def render(self, gauges):
+        """Gets the exposition text; gauges is [(name, labels, value)]."""
+
+        samples = collections.defaultdict(list)
+
+        for name, labels, value in gauges:
+            samples[name].append((name, labels, value))
+
+        with self._lock:
+            for (name, labels), value in self._counters.iteritems():
+                samples[name].append((name, dict(labels), value))
+
+            for (name, labels), (buckets, counts, total, count) in (
+                    self._histograms.iteritems()):
+                labels = dict(labels)
+                cumulative = 0
+
+                for bound, bucket_count in zip(buckets, counts):
+                    cumulative += bucket_count
+                    samples[name].append((
+                        name + '_bucket', dict(labels, le=repr(bound)),
+                        cumulative))
+
+                samples[name].extend([
+                    (name + '_bucket', dict(labels, le='+Inf'), count),
+                    (name + '_sum', labels, total),
+                    (name + '_count', labels, count),
+                ])
+
+        lines = []
+
+        for name in sorted(samples):
+            metric_type, description = self._HELP[name]
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+
+            for sample_name, labels, value in samples[name]:
+                lines.append('%s%s %s' % (
+                    sample_name, _get_metric_labels(labels), repr(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def _count(self, name, labels):
+        self._counters[(name, tuple(sorted(labels.items())))] += 1
+
+    def _observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        entry = self._histograms.setdefault(
+            key, [buckets, [0] * len(buckets), 0.0, 0])
+        index = bisect.bisect_left(buckets, value)
+
+        if index < len(buckets):
+            entry[1][index] += 1
+
+        entry[2] += value
+        entry[3] += 1
+
+
+class _ProjectContents(object):
+    """Caches each project's GET /rest/v1/project response body.
+
+    A body is rebuilt only when its project's editor file changes on disk.
+    """
+
+    def __init__(self):
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def get(self, project):
+        # Treat as module-protected. pylint: disable=protected-access
+        stat_key = worker._get_stat_key(project.editor_file)
+
+        with self._lock:
+            cached = self._bodies.get(project.name)
+
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+
+        with open(project.editor_file) as f:
+            contents = f.read()
+
+        body = json.dumps({'payload': {
+            'contents': contents,
+            'filename': project.editor_file,
+            'projectName': project.name,
+        }})
+
+        with self._lock:
+            self._bodies[project.name] = (stat_key, body)
+
+        return body
+
+
+class _ResponseBodies(object):
+    """Caches bodies, encodings and ETags of unchanging responses.
+
+    Callers key each entry by what identifies the resource's current state,
+    such as a finished run's ticket and run index version, so an entry is
+    never stale and is found without building or hashing the body. The least
+    recently used are evicted past max_entries.
+    """
+
+    def __init__(self, max_entries=_RESPONSE_CACHE_ENTRIES):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+
+    def get(self, key, build_fn):
+        """Gets the entry for key, first caching build_fn() if missing."""
+
+        with self._lock:
+            value = self._entries.pop(key, None)
+
+            if value is not None:
+                self._entries[key] = value
+                return value
+
+        value = build_fn()
+
+        with self._lock:
+            self._entries[key] = value
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+        return value
+
+
+class _RunIndex(object):
+    """Latest state of each run, kept current by worker.RunEvents.
+
+    A background thread drains the channel into a map of ticket to latest
+    TestRun, so polls are answered without reading the result store. Tickets
+    missing from the map, such as runs finished before a restart, are read from
+    the store once. Long-polling requests wait for a ticket's version to
+    change; event streams get each update on a queue. Entries expire with their
+    results.
+    Tickets still waiting in admission_queue are answered with their current
+    position instead. done_fn, if given, is called with (ticket, TestRun) when
+    a run finishes.
+    """
+
+    # Treat as module-protected. pylint: disable=protected-access
+    _TTL_SEC = worker._RESULTS_TTL_SEC
+
+    def __init__(
+            self, events, admission_queue=None, done_fn=None, ttl_sec=_TTL_SEC):
+        self._admission_queue = admission_queue
+        self._condition = threading.Condition()
+        self._done_fn = done_fn
+        self._events = events
+        self._expired_sec = time.time()
+        self._running = False
+        self._runs = {}
+        self._subscribers = collections.defaultdict(list)
+        self._thread = None
+        self._ttl_sec = ttl_sec
+
+    def get_test_run(self, ticket):
+        if self._admission_queue is not None:
+            test_run = self._admission_queue.get_test_run(ticket)
+
+            if test_run is not None:
+                return test_run
+
+        with self._condition:
+            entry = self._runs.get(ticket)
+
+        if entry is not None:
+            return entry.test_run
+
+        # Treat as module-protected. pylint: disable=protected-access
+        test_run = worker._TestEnvironment.get_test_run(ticket)
+
+        # Not-found tickets aren't remembered: their run may not have saved yet.
+        if test_run.get_status() == worker.TestRun.NOT_FOUND:
+            return test_run
+
+        with self._condition:
+            entry = self._runs.setdefault(
+                ticket, _RunIndexEntry(0, test_run, time.time()))
+
+        return entry.test_run
+
+    def get_version(self, ticket):
+        with self._condition:
+            entry = self._runs.get(ticket)
+            return entry.version if entry is not None else 0
+
+    def remove(self, ticket):
+        with self._condition:
+            self._runs.pop(ticket, None)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def subscribe(self, ticket):
+        updates = Queue.Queue()
+
+        with self._condition:
+            self._subscribers[ticket].append(updates)
+
+        return updates
+
+    def unsubscribe(self, ticket, updates):
+        with self._condition:
+            self._subscribers[ticket].remove(updates)
+
+            if not self._subscribers[ticket]:
+                del self._subscribers[ticket]
+
+    def wait(self, ticket, version, timeout_sec):
+        """Waits until ticket's version is not version; False on timeout."""
+
+        deadline = time.time() + timeout_sec
+
+        with self._condition:
+            while self.get_version(ticket) == version:
+                remaining_sec = deadline - time.time()
+                if remaining_sec <= 0:
+                    return False
+
+                self._condition.wait(remaining_sec)
+
+        return True
+
+    def _expire(self, now_sec):
+        with self._condition:
+            expired = [
+                ticket for ticket, entry in self._runs.iteritems()
+                if now_sec - entry.updated_sec >= self._ttl_sec]
+
+            for ticket in expired:
+                del self._runs[ticket]
+
+        self._expired_sec = now_sec
+
+    def _run(self):
+        while self._running:
+            # This is the only thread keeping the index current, so it must
+            # outlive any one bad update.
+            try:
+                self._run_once()
+            except:  # Treat all errors the same. pylint: disable=bare-except
+                _LOG.error(
+                    'Unable to update run index; error:\n%s',
+                    _get_last_exception_str())
+                time.sleep(_EVENTS_POLL_SEC)
+
+    def _run_once(self):
+        now_sec = time.time()
+        if now_sec - self._expired_sec >= _INDEX_EXPIRE_INTERVAL_SEC:
+            self._expire(now_sec)
+
+        try:
+            ticket, test_run = self._events.get(timeout_sec=_EVENTS_POLL_SEC)
+        except Queue.Empty:
+            return
+
+        with self._condition:
+            self._runs[ticket] = _RunIndexEntry(
+                self.get_version(ticket) + 1, test_run, time.time())
+
+            for updates in self._subscribers.get(ticket, []):
+                updates.put(test_run)
+
+            self._condition.notify_all()
+
+        if self._done_fn and _is_done(test_run):
+            self._done_fn(ticket, test_run)
+
+
+class _SlotMonitor(object):
+    """Keeps the slot pool and each emulator's readiness for /metrics.
+
+    Checking readiness takes adb round trips per emulator, so a background
+    thread refreshes it every interval_sec rather than each scrape doing so
+    on its request thread.
+    """
+
+    def __init__(self, catalog, interval_sec=_SLOT_MONITOR_INTERVAL_SEC):
+        self._catalog = catalog
+        self._interval_sec = interval_sec
+        self._lock = threading.Lock()
+        self._ready = {}
+        self._slot_pool = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get(self):
+        """Gets (SlotPool or None, {serial: ready}) as of the last refresh."""
+
+        with self._lock:
+            return self._slot_pool, self._ready
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh(self):
+        slot_pool = self._catalog.get().get_slot_pool()
+        ready = dict(
+            (runtime.serial, runtime.ready())
+            for runtime in slot_pool.get_runtimes())
+
+        with self._lock:
+            self._ready = ready
+            self._slot_pool = slot_pool
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._refresh()
+            except:  # Treat all errors the same. pylint: disable=bare-except
+                _LOG.error(
+                    'Unable to check emulator slots; error:\n%s',
+                    _get_last_exception_str())
+
+            self._stopped.wait(self._interval_sec)
+
+
+def _compress(body, encoding):
+    if encoding == _ENCODING_GZIP:
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    return zlib.compress(body)
+
+
+def _get_encoded_etag(etag, encoding):
+    # Each encoding is a distinct representation, so needs its own ETag.
+    if not encoding:
+        return etag
+
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+def _get_etag(body):
+    return '"%s"' % md5.new(body).hexdigest()
+
+
+def _get_event(test_run):
+    return 'event: %s\ndata: %s\n\n' % (
+        test_run.get_stage() or _STATUS,
+        json.dumps(_get_status_dict(test_run)))
+
 
 def _get_last_exception_str():
     return ''.join(traceback.format_exception(*sys.exc_info()))
 
 
-def _get_server(host, port):
-    return _HttpServer((host, port), _Handler)
+def _get_metric_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items()))
+
+
+def _get_route(path):
+    path = urlparse.urlparse(path).path
+
+    for route in _METRICS_ROUTES:
+        if path.startswith(route):
+            return route
+
+    return 'other'
+
+
+def _get_run_body(name, ticket, version, test_run, get_dict_fn):
+    """Gets (body, ETag, cache key) of response name for test_run.
+
+    A finished run's body never changes, so it is built once and then found
+    by ticket and run index version; the cache key is None for other runs.
+    """
+
+    def get_body_and_etag():
+        body = json.dumps({'payload': get_dict_fn(test_run)})
+        return body, _get_etag(body)
+
+    if not _is_done(test_run):
+        return get_body_and_etag() + (None,)
+
+    cache_key = (name, ticket, version)
+    body, etag = _Environment.RESPONSE_BODIES.get(
+        cache_key, get_body_and_etag)
+    return body, etag, cache_key
+
+
+def _get_server(
+        host, port, threads=_DEFAULT_SERVER_THREADS, backlog=_DEFAULT_BACKLOG,
+        connection_timeout_sec=_DEFAULT_CONNECTION_TIMEOUT_SEC):
+    return _HttpServer(
+        (host, port), _Handler, threads=threads, backlog=backlog,
+        connection_timeout_sec=connection_timeout_sec)
+
+
+def _get_status_dict(test_run):
+    image = test_run.get_image_path()
+    return {
+        'image': bool(image and os.path.exists(image)),
+        'progress': test_run.get_progress(),
+        'queue': test_run.get_queue(),
+        'stage': test_run.get_stage(),
+        _STATUS: _STATUS_MAP.get(test_run.get_status()),
+        'timings': test_run.get_timings(),
+    }
+
+
+def _get_test_run_dict(test_run):
+    result = test_run.to_dict()
+    result[_STATUS] = _STATUS_MAP.get(test_run.get_status())
+    return result
+
+
+def _is_done(test_run):
+    # Results saved before stages existed have a final status but no stage.
+    status = test_run.get_status()
+    return test_run.get_stage() == worker.TestRun.STAGE_DONE or (
+        status != worker.TestRun.NOT_FOUND and
+        _STATUS_MAP.get(status) in (_STATUS_COMPLETE, _STATUS_FAILED))
 
 
 def main(args):
     worker.configure_logger(args.log_level, log_file=args.log_file)
-    _start(args.host, args.port)
+    _start(
+        args.host, args.port, staged_trees=args.staged_trees,
+        threads=args.server_threads, backlog=args.backlog,
+        connection_timeout_sec=args.connection_timeout_sec,
+        queue_size=args.queue_size,
+        results_quota_bytes=args.results_quota_bytes)
+
+
+def _finish_run(ticket, test_run):
+    _Environment.METRICS.observe_run(test_run)
+    _Environment.RESULT_REAPER.add(ticket)
+
+
+def _remove_result(ticket):
+    _Environment.RESULT_CACHE.discard(ticket)
+    _Environment.RUN_INDEX.remove(ticket)
 
 
-def _start(host, port):
-    server = _get_server(host, port)
+def _start(
+        host, port, staged_trees=_DEFAULT_STAGED_TREES,
+        threads=_DEFAULT_SERVER_THREADS, backlog=_DEFAULT_BACKLOG,
+        connection_timeout_sec=_DEFAULT_CONNECTION_TIMEOUT_SEC,
+        queue_size=worker.AdmissionQueue.DEFAULT_MAX_SIZE,
+        results_quota_bytes=None):
+    projects = _Environment.CATALOG.get().projects
+    admission_queue = worker.AdmissionQueue(
+        _Environment.CATALOG, events=_Environment.EVENTS,
+        incremental=_Environment.INCREMENTAL_BUILDS, max_size=queue_size)
+    result_reaper = worker.ResultReaper(
+        quota_bytes=results_quota_bytes,
+        remove_fn=_remove_result)
+    run_index = _RunIndex(
+        _Environment.EVENTS, admission_queue=admission_queue,
+        done_fn=_finish_run)
+    slot_monitor = _SlotMonitor(_Environment.CATALOG)
+    staging_pool = worker.StagingPool(
+        _Environment.CATALOG, size=staged_trees)
+    server = _get_server(
+        host, port, threads=threads, backlog=backlog,
+        connection_timeout_sec=connection_timeout_sec)
+    _Environment.ADMISSION_QUEUE = admission_queue
+    _Environment.METRICS = _Metrics()
+    _Environment.PROJECT_CONTENTS = _ProjectContents()
+    _Environment.RESPONSE_BODIES = _ResponseBodies()
+    _Environment.RESULT_REAPER = result_reaper
+    _Environment.RUN_INDEX = run_index
+    _Environment.SERVER = server
+    _Environment.SLOT_MONITOR = slot_monitor
     try:
+        admission_queue.start()
+        warm_thread = threading.Thread(
+            target=worker.warm_gradle, args=(projects,))
+        warm_thread.daemon = True
+        warm_thread.start()
+        result_reaper.start()
+        run_index.start()
+        slot_monitor.start()
+        staging_pool.start()
         _LOG.info('Starting server at http://%(host)s:%(port)s', {
             'host': host,
             'port': port,
@@ -290,10 +1504,19 @@ def _start(host, port):
         server.serve_forever()
     except:  # Treat all errors the same. pylint: disable=bare-except
         _LOG.info('Stopping server; reason:\n' + _get_last_exception_str())
-        server.socket.close()
+    finally:
+        server.server_close()
+        admission_queue.stop()
+        result_reaper.stop()
+        run_index.stop()
+        slot_monitor.stop()
+        staging_pool.stop()
 
 
 if __name__ == '__main__':
     parsed_args = _PARSER.parse_args()
-    _Environment.set(parsed_args.host, parsed_args.port)
+    _Environment.set(
+        parsed_args.host, parsed_args.port,
+        incremental_builds=parsed_args.incremental_builds,
+        result_cache_size=parsed_args.result_cache_size)
     main(parsed_args)
@@ -0,0 +1,235 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for server.py's HTTP serving, without emulators or a result store.
+
+Run from this directory with python -m unittest discover -p '*_test.py'.
+"""
+
+import httplib
+import json
+import os
+import socket
+import threading
+import tempfile
+import time
+import unittest
+import urllib
+
+import fakes
+import server
+import worker
+
+_HEALTH_REQUEST = 'GET /health HTTP/1.1\r\nHost: localhost\r\n\r\n'
+_THREADS = 4
+_TICKET = 'ticket'
+
+
+class HttpServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environment = dict(vars(server._Environment))
+        self.sockets = []
+        self.server = server._get_server(
+            'localhost', 0, threads=_THREADS, connection_timeout_sec=5)
+        self.port = self.server.server_address[1]
+        server._Environment.set('localhost', self.port)
+        server._Environment.ADMISSION_QUEUE = worker.AdmissionQueue(
+            server._Environment.CATALOG)
+        server._Environment.METRICS = server._Metrics()
+        server._Environment.RESPONSE_BODIES = server._ResponseBodies()
+        server._Environment.RUN_INDEX = server._RunIndex(worker.RunEvents())
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+        for name, value in self.environment.items():
+            if name.isupper():
+                setattr(server._Environment, name, value)
+
+    def test_finished_run_body_is_built_once_per_version(self):
+        self._add_run(worker.TestRun.TESTS_SUCCEEDED, payload='x' * 2048)
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+        get_test_run_dict = server._get_test_run_dict
+        calls = []
+
+        def counting_get_test_run_dict(test_run):
+            calls.append(test_run)
+            return get_test_run_dict(test_run)
+
+        server._get_test_run_dict = counting_get_test_run_dict
+
+        try:
+            for _ in range(3):
+                connection.request(
+                    'GET', self._get_path('/rest/v1'),
+                    headers={'Accept-Encoding': 'gzip'})
+                response = connection.getresponse()
+                response.read()
+
+                self.assertEqual('gzip', response.getheader('Content-Encoding'))
+        finally:
+            server._get_test_run_dict = get_test_run_dict
+
+        self.assertEqual(1, len(calls))
+
+    def test_image_revalidation_does_not_read_image(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, fakes.JPEG)
+        os.close(fd)
+        self._add_run(worker.TestRun.TESTS_SUCCEEDED, image_path=path)
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+        get_image = worker.TestRun.get_image
+        calls = []
+
+        def counting_get_image(test_run):
+            calls.append(test_run)
+            return get_image(test_run)
+
+        worker.TestRun.get_image = counting_get_image
+
+        try:
+            connection.request('GET', self._get_path('/rest/v1/image'))
+            response = connection.getresponse()
+            self.assertEqual(fakes.JPEG, response.read())
+
+            for _ in range(3):
+                connection.request(
+                    'GET', self._get_path('/rest/v1/image'),
+                    headers={'If-None-Match': response.getheader('ETag')})
+                revalidated = connection.getresponse()
+                revalidated.read()
+
+                self.assertEqual(304, revalidated.status)
+        finally:
+            worker.TestRun.get_image = get_image
+            os.remove(path)
+
+        self.assertEqual(1, len(calls))
+
+    def test_status_leaves_out_payload_and_spans(self):
+        self._add_run(worker.TestRun.BUILD_FAILED, payload='x' * 2048)
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+
+        connection.request('GET', self._get_status_path())
+        status = json.loads(connection.getresponse().read())['payload']
+        connection.request('GET', self._get_path('/rest/v1'))
+        test_run = json.loads(connection.getresponse().read())['payload']
+
+        self.assertNotIn('payload', status)
+        self.assertNotIn('spans', status)
+        self.assertEqual(test_run['status'], status['status'])
+        self.assertEqual('x' * 2048, test_run['payload'])
+        self.assertEqual([], test_run['spans'])
+
+    def test_wildcard_does_not_accept_refused_encoding(self):
+        self._add_run(worker.TestRun.TESTS_SUCCEEDED, payload='x' * 2048)
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+
+        for header, expected in (
+                ('gzip;q=0, *', 'deflate'), ('*;q=0', None), ('*', 'gzip')):
+            connection.request(
+                'GET', self._get_path('/rest/v1'),
+                headers={'Accept-Encoding': header})
+            response = connection.getresponse()
+            response.read()
+
+            self.assertEqual(expected, response.getheader('Content-Encoding'))
+
+    def test_health_answers_while_every_thread_has_an_idle_connection(self):
+        for i in range(_THREADS * 2):
+            sock = self._connect()
+
+            # Half have been served and kept alive, half haven't sent yet.
+            if i % 2:
+                sock.sendall(_HEALTH_REQUEST)
+                self.assertIn('200 OK', sock.recv(4096))
+
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+        connection.request('GET', '/health')
+
+        self.assertEqual(200, connection.getresponse().status)
+
+    def test_keep_alive_connection_serves_several_requests(self):
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+
+        for _ in range(3):
+            connection.request('GET', '/health')
+            response = connection.getresponse()
+            response.read()
+
+            self.assertEqual(200, response.status)
+
+    def test_long_poll_over_waiting_limit_gets_503(self):
+        self._add_run(worker.TestRun.TESTS_RUNNING)
+        connection = httplib.HTTPConnection('localhost', self.port, timeout=2)
+        connection.request('GET', self._get_status_path())
+        response = connection.getresponse()
+        response.read()
+
+        while self.server.waiting_slots.acquire(False):
+            pass
+
+        connection.request(
+            'GET', self._get_status_path(wait_sec=5),
+            headers={'If-None-Match': response.getheader('ETag')})
+        response = connection.getresponse()
+        response.read()
+
+        self.assertEqual(503, response.status)
+        self.assertEqual('1', response.getheader('Retry-After'))
+
+    def test_pipelined_requests_are_all_answered(self):
+        sock = self._connect()
+        sock.sendall(_HEALTH_REQUEST * 3)
+        received = ''
+
+        while received.count('200 OK') < 3:
+            data = sock.recv(4096)
+            self.assertTrue(data)
+            received += data
+
+    def _add_run(self, status, payload=None, image_path=None):
+        test_run = worker.TestRun()
+        test_run.set_status(status)
+        test_run.set_payload(payload)
+        test_run.set_image_path(image_path)
+        server._Environment.RUN_INDEX._runs[_TICKET] = server._RunIndexEntry(
+            1, test_run, time.time())
+
+    def _connect(self):
+        sock = socket.create_connection(('localhost', self.port), timeout=2)
+        self.sockets.append(sock)
+        return sock
+
+    def _get_path(self, route, **args):
+        args.update({
+            'ticket': _TICKET,
+            'worker_id': server._Environment.get_worker_id(),
+        })
+        return route + '?' + urllib.urlencode({'request': json.dumps(args)})
+
+    def _get_status_path(self, **args):
+        return self._get_path('/rest/v1/status', **args)
+
+
+if __name__ == '__main__':
+    unittest.main()
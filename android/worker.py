@@ -23,15 +23,16 @@ Currently n > 1 workers is not supported.
 
 This is a proof-of-concept implementation and it has many shortcomings:
 
-1. Full support for multiple running emulators is not done yet, and attempting
-   to use different emulators will cause hangs. For now, the fix is to use the
-   same emulator settings for each entry in runtimes/config.json, which limits
-   max concurrent requests to 1, and we don't do any locking so requests running
-   at the same time will race. Long term fix is to delegate the emulator name
-   and port to all commands, including gradle, then to make the server
-   multithreaded and to dispatch concurrent requests to different emulators.
-2. Starting emulators happens serially, which is very slow, and we should
-   parallelize this.
+1. Each distinct emulator port in runtimes/config.json is an execution slot.
+   Slots are leased to test runs one at a time via per-slot lock files, and all
+   adb and gradle commands for a run are routed to the leased slot's emulator
+   serial, so a worker runs as many concurrent tests as it has slots. Entries
+   that share a port share a slot.
+2. Emulators are started concurrently and waited on together. The first boot
+   of each runtime is a cold boot, after which a snapshot of the booted
+   emulator is saved; later starts restore that snapshot instead. Booting is
+   still slow under ARM emulation, so the first start of a new runtime takes
+   minutes.
 3. Only 64-bit Linux is currently supported, and only running the 32-bit
    Android toolchain. This is weird; the reason is that the 64-bit toolchain
    requires x86 emulation, which in turn requires KVM support.
@@ -41,9 +42,16 @@ This is a proof-of-concept implementation and it has many shortcomings:
 5. Output in the success case is a screenshot. Ideally, it would be an
    interactive emulator session.
 6. We do a full compile, apk load, and test run on each test invocation. This
-   takes ~30s when running natively and ~45s under emulation. This could be
-   improved substantially by being more incremental, and the emulation penalty
-   could be decreased with KVM.
+   takes ~30s when running natively and ~45s under emulation. Builds run
+   against gradle daemons that server.py warms when it starts, which removes
+   JVM startup and most configuration time, but the build itself could
+   be improved substantially by being more incremental, and the emulation
+   penalty could be decreased with KVM. server.py --incremental_builds keeps a
+   persistent working tree per project and emulator slot so gradle only reruns
+   tasks affected by each patch; patched files are reverted after every run.
+   Runs whose patches only touch resources skip gradle entirely once a cached
+   build exists for the project: aapt repackages the resources into the cached
+   APK, which is re-signed with the debug key.
 7. The test patch implementation assumes only one file is being edited. It could
    be trivially extended to support n >= 0 patches.
 8. In headless mode we still rely on the shell having a DISPLAY var set and we
@@ -87,49 +95,105 @@ Your worker can now be reached by a FE for REST operations. If you want to put
 it behind a balancer like ELB, do an HTTP health check against /health and
 expect a 200 if the instance can accept requests to start running new jobs.
 Determining the number of workers you need is straightforward: each worker can
-handle many concurrent requests for past results, but only one request at a time
-for executing a new job.
+handle many concurrent requests for past results, but only one request per
+emulator slot at a time for executing a new job.
 """
 
 import argparse
 import base64
+import collections
+import ctypes
 import datetime
+from distutils import version
+import errno
+import glob
+import heapq
 import json
 import logging
 import md5
 import multiprocessing
 import os
+import Queue
 import re
 import shutil
+import signal
+import socket
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
+import uuid
+import zipfile
+
+import adb
 
 ROOT_PATH = os.path.abspath(os.path.dirname(__file__))
 
 _ACCEPT_LICENSE_NEEDLE = 'Do you accept the license'
+# Where _get_adb_client() finds the adb server; see set_adb_address().
+_ADB_ADDRESS = (adb.DEFAULT_HOST, adb.DEFAULT_PORT)
+_ADB_INSTALL_SUCCESS_NEEDLE = 'Success'
+# How long am instrument may go without printing before the device is deemed
+# wedged. Tests print a status line as each starts and ends.
+_ADB_INSTRUMENT_TIMEOUT_SEC = 60 * 5
+# How long emulator readiness probes wait on the adb server before answering
+# not ready.
+_ADB_PROBE_TIMEOUT_SEC = 5
+# Assumed seconds a run holds its slot until dispatches have been timed.
+_ADMISSION_DEFAULT_RUN_SEC = 60
+# Longest the dispatcher waits for a forked run to lease its slot.
+_ADMISSION_LEASE_WAIT_SEC = 5
+# How often an idle dispatcher checks for runs that exited without finishing.
+_ADMISSION_REAP_INTERVAL_SEC = 5
+# How long the dispatcher backs off after an error before trying again.
+_ADMISSION_RETRY_SEC = 1
 _ANDROID_HOME = 'ANDROID_HOME'
+_ANDROID_SERIAL = 'ANDROID_SERIAL'
 _ANDROID_SDK_HOME = 'ANDROID_SDK_HOME'
+_APK_CACHE_PATH = os.path.join(ROOT_PATH, 'builds')
 _BOOT_ANIMATION_STOPPED = 'stopped\r'
 _BOOT_ANIMATION_PROPERTY = 'init.svc.bootanim'
 _CLEAN_ALL = 'all'
+_CLEAN_BUILDS = 'builds'
 _CLEAN_EMULATORS = 'emulators'
 _CLEAN_LOCAL = 'local'
 _CLEAN_PYC = 'pyc'
 _CLEAN_RESOURCES = 'resources'
 _CLEAN_RESULTS = 'results'
 _CLEAN_RUNTIMES = 'runtimes'
+_CLEAN_WORKTREES = 'worktrees'
 _CLEAN_CHOICES = [
     _CLEAN_ALL,
+    _CLEAN_BUILDS,
     _CLEAN_EMULATORS,
     _CLEAN_LOCAL,  # All but resources.
     _CLEAN_PYC,
     _CLEAN_RESOURCES,
     _CLEAN_RESULTS,
     _CLEAN_RUNTIMES,
+    _CLEAN_WORKTREES,
 ]
+# The C library's clock_gettime(), or None; see _get_monotonic_sec().
+_CLOCK_GETTIME = getattr(ctypes.CDLL(None), 'clock_gettime', None)
+# Linux's clock id for CLOCK_MONOTONIC.
+_CLOCK_MONOTONIC = 1
+_DEBUG_KEY_ALIAS = 'androiddebugkey'
+_DEBUG_KEYSTORE_PASSWORD = 'android'
+_DEBUG_KEYSTORE_PATH = os.path.join(
+    os.path.expanduser('~'), '.android', 'debug.keystore')
 _DISPLAY = 'DISPLAY'
 _EMULATOR = 'emulator'
+_EMULATOR_CONSOLE_ERROR_PREFIX = 'KO'
+_GRADLE_BUILD_FILE = 'build.gradle'
+_GRADLEW_ASSEMBLE_TASKS = ['assembleDebug', 'assembleDebugTest']
+_GRADLEW_DAEMON_FLAG = '--daemon'
+# Output lines after which a gradle build is known to have failed. Gradle prints
+# every compiler error before the failed task line, and only a summary after.
+_GRADLEW_FAILURE_MATCHERS = [
+    re.compile(r'^:\S+ FAILED$'),
+    re.compile(r'^BUILD FAILED'),
+]
 _GRADLEW_INSTALL_SUCCESS_NEEDLE = 'BUILD SUCCESSFUL'
 LOG_DEBUG = 'DEBUG'
 LOG_ERROR = 'ERROR'
@@ -141,19 +205,79 @@ LOG_LEVEL_CHOICES = [
     LOG_INFO,
     LOG_WARNING,
 ]
+_LOCK_PATH_TEMPLATE = os.path.join(ROOT_PATH, '.lock-%s')
 _LOG = logging.getLogger('android.worker')
-_TEST_FAILURE_NEEDLE = 'FAILURES!!!\r'
+# Names of the spans whose durations are summed into each phase's timing.
+_PHASE_SPANS = {
+    'build': frozenset(['aapt', 'gradle_assemble', 'jarsigner', 'zipalign']),
+    'install': frozenset(['adb_install']),
+    'test': frozenset(['test']),
+}
+_PROGRESS_INTERVAL_SEC = 1
+# Instrumentation output lines after which a test run is known to have failed.
+# They both stop am instrument and fail the run.
+_TEST_FAILURE_MATCHERS = [
+    re.compile(r'^FAILURES!!!'),
+    re.compile(r'^INSTRUMENTATION_FAILED'),
+]
 
 _PROJECTS_PATH = os.path.join(ROOT_PATH, 'projects')
 _PROJECTS_CONFIG = os.path.join(_PROJECTS_PATH, 'config.json')
+# Suffix of journal entries whose run has been forked but not yet confirmed.
+_QUEUE_DISPATCHED_SUFFIX = '.dispatched'
+_QUEUE_PATH = os.path.join(ROOT_PATH, 'queue')
 _RESOURCES_PATH = os.path.join(ROOT_PATH, 'resources')
 _RESOURCES_TMP_PATH = os.path.join(_RESOURCES_PATH, 'tmp')
+_RESOURCE_BUILD_DIR = 'build-resources'
+_RESOURCE_DIR = 'res'
 _RESULT_IMAGE_NAME = 'result.jpg'
-_RESULT_JSON_NAME = 'result.json'
+_RESULTS_INDEX_NAME = 'index.db'
 _RESULTS_PATH = os.path.join(ROOT_PATH, 'results')
+# Long enough for a finished run to tear down its staged project.
+_RESULTS_SETTLE_SEC = 10
+_RESULTS_SWEEP_INTERVAL_SEC = 60 * 5
 _RESULTS_TTL_SEC = 60 * 30
 _RUNTIMES_PATH = os.path.join(ROOT_PATH, 'runtimes')
 _RUNTIMES_CONFIG = os.path.join(_RUNTIMES_PATH, 'config.json')
+_SDK_PATH = os.path.join(_RESOURCES_PATH, 'sdk')
+_SLOT_LEASE_TIMEOUT_SEC = 60
+_SNAPSHOT_NAME = 'booted'
+_STAGING_PATH = os.path.join(ROOT_PATH, 'staging')
+# Directories in golden projects that staging never links: VCS metadata and
+# gradle state at the project root, and build output directly under the root or
+# a module, which gradle rewrites in place and would corrupt the golden copy
+# through a hardlink. Deeper directories of these names are sources.
+_STAGING_PRUNE_MODULE_DIRS = frozenset(['build'])
+_STAGING_PRUNE_ROOT_DIRS = frozenset(['.git', '.gradle'])
+_STAGING_READY = 'ready'
+_STAGING_TRASH_PATH = os.path.join(_STAGING_PATH, '.trash')
+# The root of worker.py's state, and the module paths under it that
+# set_root_path() moves.
+_STATE_PATH = ROOT_PATH
+_STATE_PATH_NAMES = (
+    '_APK_CACHE_PATH',
+    '_LOCK_PATH_TEMPLATE',
+    '_PROJECTS_CONFIG',
+    '_PROJECTS_PATH',
+    '_QUEUE_PATH',
+    '_RESOURCES_PATH',
+    '_RESOURCES_TMP_PATH',
+    '_RESULTS_PATH',
+    '_RUNTIMES_CONFIG',
+    '_RUNTIMES_PATH',
+    '_SDK_PATH',
+    '_STAGING_PATH',
+    '_STAGING_TRASH_PATH',
+    '_WORKTREES_PATH',
+)
+# Held around ResultStore calls and forks. SQLite keeps per-process lock state,
+# so a child forked while another thread is inside SQLite inherits locks nobody
+# will release, and its writes time out. Reentrant because a forked run starts
+# on the thread that held it.
+_STORE_FORK_LOCK = threading.RLock()
+_WORKTREE_PATCHED_NAME = '.patched'
+_WORKTREE_REVISION_NAME = '.revision'
+_WORKTREES_PATH = os.path.join(ROOT_PATH, 'worktrees')
 
 _PARSER = argparse.ArgumentParser()
 _PARSER.add_argument(
@@ -195,22 +319,23 @@ def main(args):
         _build_all(config.projects)  # Warm the build.
         _ensure_emulators_running_and_ready(
             config.runtimes, headless=not args.show_emulator)
-        _install_packages(config.projects)
+        _install_packages(config.projects, config.runtimes)
 
 
-def fork_test(config, project_name, ticket, patches=None):
+def fork_test(
+        config, project_name, ticket, patches=None, incremental=False,
+        events=None):
     # Runs a test in a fork; returns PID if test starts else None.
-    child = multiprocessing.Process(
-        target=run_test, args=(config, project_name, ticket),
-        kwargs={'patches': patches})
-    child.daemon = True
-    child.start()
-    return child.pid
+    return _fork_test(
+        config, project_name, ticket, patches=patches, incremental=incremental,
+        events=events).pid
 
 
-def run_test(config, project_name, ticket, patches=None):
+def run_test(
+        config, project_name, ticket, patches=None, incremental=False,
+        events=None):
     patches = patches if patches else []
-    test_env = _TestEnvironment(ticket)
+    test_env = _TestEnvironment(ticket, events=events, incremental=incremental)
     test_env.set_up()  # All exit points from this fn must call tear_down().
     test_run = TestRun()
 
@@ -226,24 +351,34 @@ def run_test(config, project_name, ticket, patches=None):
             'Unable to find project named ' + project_name,
             TestRun.PROJECT_MISCONFIGURED)
 
-    runtime = config.get_runtime(project_name)
-    if not runtime:
+    preferred_runtime = config.get_runtime(project_name)
+    if not preferred_runtime:
         return _run_test_failure(
             test_env, test_run, ticket,
             'Unable to find runtime for project named ' + project_name,
             TestRun.RUNTIME_MISCONFIGURED)
 
+    slot_pool = config.get_slot_pool()
+    runtime = None
+
     try:
-        Lock.get(ticket)
-        test_env.set_up_projects(patches, src_project)
+        with test_env.spans.span('lease'):
+            runtime = slot_pool.lease(ticket, preferred=preferred_runtime)
+
+        with test_env.spans.span('set_up_projects'):
+            test_env.set_up_projects(patches, src_project, runtime.serial)
+
         _LOG.info('Begin test run of project ' + test_env.test_project.name)
         test_run = TestRun()
         test_run.set_status(TestRun.TESTS_RUNNING)
-        test_env.save(test_run)
+        progress = _Progress(test_env, test_run)
+        progress.set_stage(TestRun.STAGE_STAGED)
         test_run = _test(
             test_env.test_project.name, test_env.test_project, runtime,
-            strict=False)
+            strict=False, progress_fn=progress, stage_fn=progress.set_stage,
+            image_path=test_env.get_image_path(), spans=test_env.spans)
         _LOG.info('End test run of project ' + test_env.test_project.name)
+        test_run.set_stage(TestRun.STAGE_DONE)
         test_env.save(test_run)
         return ticket
     except LockError:
@@ -254,17 +389,413 @@ def run_test(config, project_name, ticket, patches=None):
         # Since we unlock after tear_down, which restores the logger, result dir
         # logs will not contain an entry for the lock release. However, the main
         # server log will.
-        Lock.release()
+        if runtime is not None:
+            slot_pool.release(runtime)
+
+
+def set_adb_address(host, port):
+    """Points worker.py at the adb server on host:port instead of the default.
+
+    For fake servers, such as bench.py's. Runs forked afterwards inherit it.
+    """
+
+    # The address is module state by design. pylint: disable=global-statement
+    global _ADB_ADDRESS
+    _ADB_ADDRESS = (host, port)
+
+
+def set_root_path(root_path):
+    """Keeps worker.py's state under root_path instead of ROOT_PATH.
+
+    Projects, runtimes, the SDK, builds, results and everything else worker.py
+    writes move; its code stays. For throwaway roots, such as bench.py's. Call
+    before anything else in this process uses worker.py.
+    """
+
+    # The paths are module state by design. pylint: disable=global-statement
+    global _STATE_PATH
+    module = sys.modules[__name__]
+
+    for name in _STATE_PATH_NAMES:
+        setattr(module, name, os.path.join(
+            root_path, os.path.relpath(getattr(module, name), _STATE_PATH)))
+
+    _Sdk.PATH = _SDK_PATH
+    _STATE_PATH = root_path
+
+
+def warm_gradle(projects):
+    """Starts a gradle daemon for each project so the first build is warm."""
+
+    for project in projects.values():
+        code, _ = _gradlew(project.path, ['help'])
+
+        if code:
+            _LOG.warning('Unable to warm gradle for project %s', project.name)
+        else:
+            _LOG.info('Warmed gradle for project %s', project.name)
 
 
 def _run_test_failure(test_env, test_run, ticket, payload, status):
     test_run.set_payload(payload)
+    test_run.set_stage(TestRun.STAGE_DONE)
     test_run.set_status(status)
     test_env.save(test_run)
     test_env.tear_down()
     return ticket
 
 
+class AdmissionQueue(object):
+    """Bounded FIFO of submissions waiting for a free slot.
+
+    Lives in server.py's process. submit() journals each submission to its own
+    file under queue/ and a dispatcher thread forks its run once the slot pool
+    has room, so queued work survives a restart. Each dispatch republishes
+    the position of every ticket still queued, so their long polls and event
+    streams see the queue move. Start estimates assume slots keep freeing up
+    at the average interval seen between backed-up dispatches. A run whose
+    process exits with an error before finishing is saved as crashed.
+    """
+
+    DEFAULT_MAX_SIZE = 100
+
+    def __init__(
+            self, catalog, events=None, incremental=False,
+            max_size=DEFAULT_MAX_SIZE, interval_sec=0.2):
+        self._catalog = catalog
+        self._children = {}
+        self._condition = threading.Condition()
+        self._dispatch_interval_sec = None
+        self._dispatched_sec = None
+        self._entries = collections.deque()
+        self._events = events
+        self._incremental = incremental
+        self._interval_sec = interval_sec
+        self._max_size = max_size
+        self._running = False
+        self._slot_count = 1
+        self._started_sec = None
+        self._thread = None
+
+    def full(self):
+        with self._condition:
+            return len(self._entries) >= self._max_size
+
+    def get_test_run(self, ticket):
+        """Gets a TestRun for ticket if it is queued, else None."""
+
+        with self._condition:
+            for index, entry in enumerate(self._entries):
+                if entry.ticket == ticket:
+                    return self._get_queued_test_run(index + 1)
+
+        return None
+
+    def size(self):
+        with self._condition:
+            return len(self._entries)
+
+    def start(self):
+        self._started_sec = time.time()
+        self._load()
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _LOG.info(
+            'Admission queue started with %s journaled submissions',
+            len(self._entries))
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, project_name, ticket, patches):
+        """Queues a run; returns its 1-based position.
+
+        Raises QueueFullError if max_size submissions are already waiting.
+        """
+
+        with self._condition:
+            if len(self._entries) >= self._max_size:
+                raise QueueFullError(
+                    'Unable to queue ticket %s; %s submissions waiting' % (
+                        ticket, len(self._entries)))
+
+            entry = self._write_entry(project_name, ticket, patches)
+            self._entries.append(entry)
+            self._condition.notify_all()
+            position = len(self._entries)
+
+        _LOG.info('Queued ticket %s at position %s', ticket, position)
+        return position
+
+    def _dispatch(self, entry, config):
+        now_sec = time.time()
+
+        # Only intervals where the queue was backed up measure slot turnover.
+        if self._dispatched_sec is not None and (
+                entry.submitted_sec < self._dispatched_sec):
+            interval_sec = now_sec - self._dispatched_sec
+            self._dispatch_interval_sec = interval_sec if (
+                self._dispatch_interval_sec is None) else (
+                    0.8 * self._dispatch_interval_sec + 0.2 * interval_sec)
+
+        self._dispatched_sec = now_sec
+        # Set aside first, so a crash before the removal below can't replay
+        # the run on restart; _load() reports it as interrupted instead. Until
+        # then the entry stays queued, so a failed rename is retried.
+        dispatched_path = entry.path + _QUEUE_DISPATCHED_SUFFIX
+        os.rename(entry.path, dispatched_path)
+
+        with self._condition:
+            self._entries.popleft()
+
+        try:
+            child = _fork_test(
+                config, entry.project_name, entry.ticket,
+                patches=entry.patches, incremental=self._incremental,
+                events=self._events)
+        except:  # Treat all errors the same. pylint: disable=bare-except
+            _LOG.exception(
+                'Unable to start worker process for %s', entry.ticket)
+            self._save_failure(
+                entry.ticket, TestRun.UNAVAILABLE,
+                'Unable to start worker process')
+            os.remove(dispatched_path)
+
+            if self._events is not None:
+                self._publish_positions()
+
+            return None
+
+        os.remove(dispatched_path)
+        self._children[entry.ticket] = child
+
+        if self._events is not None:
+            # Bridge the gap until the run saves its first result.
+            self._events.publish(entry.ticket, self._get_queued_test_run(0))
+            self._publish_positions()
+
+        _LOG.info('Dispatched queued ticket %s', entry.ticket)
+        return child.pid
+
+    def _get_queued_test_run(self, position):
+        interval_sec = self._dispatch_interval_sec or (
+            float(_ADMISSION_DEFAULT_RUN_SEC) / self._slot_count)
+        # Count from when the queue last moved, not now, so the estimate only
+        # changes when it moves; otherwise long polls of status never hold.
+        since_sec = max(self._dispatched_sec or 0, self._started_sec or 0)
+
+        if position and self._entries:
+            since_sec = max(since_sec, self._entries[0].submitted_sec)
+
+        test_run = TestRun()
+        test_run.set_payload(
+            'Queued at position %s' % position if position else 'Starting')
+        test_run.set_queue({
+            'estimated_start_sec': since_sec + position * interval_sec,
+            'position': position,
+        })
+        test_run.set_status(TestRun.QUEUED)
+        return test_run
+
+    def _load(self):
+        _makedirs(_QUEUE_PATH)
+        entries = []
+
+        for path in glob.glob(os.path.join(
+                _QUEUE_PATH, '*.json' + _QUEUE_DISPATCHED_SUFFIX)):
+            self._report_interrupted(path)
+
+        for path in sorted(glob.glob(os.path.join(_QUEUE_PATH, '*.json'))):
+            value = _read_json(path)
+
+            if value is None:
+                os.remove(path)
+                continue
+
+            entries.append(_QueueEntry(
+                value['ticket'], value['project'],
+                [Patch(patch['filename'], patch['contents'])
+                 for patch in value['patches']],
+                value['submitted_sec'], path))
+
+        with self._condition:
+            self._entries.extend(entries)
+
+    def _publish_positions(self):
+        with self._condition:
+            queued = [
+                (entry.ticket, self._get_queued_test_run(index + 1))
+                for index, entry in enumerate(self._entries)]
+
+        for ticket, test_run in queued:
+            self._events.publish(ticket, test_run)
+
+    def _report_interrupted(self, path):
+        """Fails a run forked just before a crash, unless it saved a result.
+
+        Its run may have started, so it is not run again.
+        """
+
+        value = _read_json(path)
+        os.remove(path)
+
+        if value is None:
+            return
+
+        ticket = value['ticket']
+
+        if _TestEnvironment.get_test_run(ticket).get_status() != (
+                TestRun.NOT_FOUND):
+            return
+
+        _LOG.warning('Ticket %s was interrupted while starting', ticket)
+        self._save_failure(
+            ticket, TestRun.UNAVAILABLE,
+            'Interrupted by a restart while starting')
+
+    def _reap_children(self):
+        """Saves runs whose process exited with an error as crashed."""
+
+        for ticket, child in self._children.items():
+            if child.exitcode is None:
+                continue
+
+            if child.exitcode and _TestEnvironment.get_test_run(
+                    ticket).get_stage() != TestRun.STAGE_DONE:
+                message = 'Run exited with code %s before finishing' % (
+                    child.exitcode)
+                _LOG.error('Ticket %s crashed: %s', ticket, message)
+                self._save_failure(ticket, TestRun.CRASHED, message)
+
+            # Only once saved, so a failed save is retried on the next pass.
+            del self._children[ticket]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+
+            # This is the only dispatcher, so it must outlive any one bad
+            # dispatch; otherwise every later submission waits forever.
+            try:
+                self._run_once()
+            except:  # Treat all errors the same. pylint: disable=bare-except
+                _LOG.exception('Admission queue dispatch failed; will retry')
+
+                with self._condition:
+                    if self._running:
+                        self._condition.wait(_ADMISSION_RETRY_SEC)
+
+    def _run_once(self):
+        self._reap_children()
+
+        with self._condition:
+            if not (self._running and self._entries):
+                if self._running:
+                    self._condition.wait(_ADMISSION_REAP_INTERVAL_SEC)
+
+                return
+
+            entry = self._entries[0]
+
+        config = self._catalog.get()
+        slot_pool = config.get_slot_pool()
+        self._slot_count = max(slot_pool.size(), 1)
+        busy_count = slot_pool.busy_count()
+
+        if busy_count >= slot_pool.size():
+            # Reaps runs that have exited, so locks they leaked by crashing
+            # read as stale rather than held by a zombie.
+            multiprocessing.active_children()
+            time.sleep(self._interval_sec)
+            return
+
+        pid = self._dispatch(entry, config)
+
+        if pid is not None:
+            self._wait_for_lease(slot_pool, busy_count, pid)
+
+    def _save_failure(self, ticket, status, payload):
+        test_run = TestRun()
+        test_run.set_payload(payload)
+        test_run.set_stage(TestRun.STAGE_DONE)
+        test_run.set_status(status)
+        _TestEnvironment(ticket, events=self._events).save(
+            test_run, record_span=False)
+
+    def _wait_for_lease(self, slot_pool, busy_count, pid):
+        """Waits for a forked run to lease a slot, so it isn't double-booked."""
+
+        deadline = time.time() + _ADMISSION_LEASE_WAIT_SEC
+
+        while time.time() < deadline:
+            if slot_pool.busy_count() > busy_count:
+                return
+
+            # Also reaps finished runs.
+            if pid not in [child.pid for child in
+                           multiprocessing.active_children()]:
+                return
+
+            time.sleep(self._interval_sec)
+
+    def _write_entry(self, project_name, ticket, patches):
+        submitted_sec = time.time()
+        path = os.path.join(
+            _QUEUE_PATH, '%020d-%s.json' % (
+                int(submitted_sec * 1000000), uuid.uuid4().hex))
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({
+                'patches': [
+                    {'contents': patch.contents, 'filename': patch.filename}
+                    for patch in patches],
+                'project': project_name,
+                'submitted_sec': submitted_sec,
+                'ticket': ticket,
+            }))
+
+        os.rename(tmp_path, path)
+        return _QueueEntry(ticket, project_name, patches, submitted_sec, path)
+
+
+class Catalog(object):
+    """Caches the project and runtime Config between requests.
+
+    get() only re-reads the config files after one changes on disk, so callers
+    can ask for the Config on every request. Projects and runtimes are built
+    from their config entries the first time each is used.
+    """
+
+    def __init__(self):
+        self._config = None
+        self._lock = threading.Lock()
+        self._stats = None
+
+    def get(self):
+        # Stat before loading: a change mid-load just causes another reload.
+        stats = (
+            _get_stat_key(_PROJECTS_CONFIG), _get_stat_key(_RUNTIMES_CONFIG))
+
+        with self._lock:
+            if self._config is None or stats != self._stats:
+                self._config = Config.load()
+                self._stats = stats
+                _LOG.info('Loaded project and runtime config')
+
+            return self._config
+
+
 class Config(object):
 
     def __init__(self, projects, runtimes):
@@ -277,64 +808,304 @@ class Config(object):
     def get_runtime(self, project_name):
         return self.runtimes.get(project_name)
 
+    def get_slot_pool(self):
+        return SlotPool(self.runtimes)
+
     @classmethod
     def load(cls):
         projects = _read_json(_PROJECTS_CONFIG)
         runtimes = _read_json(_RUNTIMES_CONFIG)
         return cls(
-            {k: _Project.from_config(k, v) for k, v in projects.iteritems()},
-            {k: _Runtime.from_config(k, v) for k, v in runtimes.iteritems()})
+            _LazyConfigMap(projects, _Project.from_config),
+            _LazyConfigMap(runtimes, _Runtime.from_config))
 
 
 class Error(Exception):
     """Base error class."""
 
 
+class DeviceError(Error):
+    """Raised when a device or the adb server fails a run's install or tests."""
+
+
+class QueueFullError(Error):
+    """Raised when the admission queue has no room for a submission."""
+
+
 class LockError(Error):
     """Raised when a lock operation fails."""
 
 
 class Lock(object):
-    """Persistent lock to prevent concurrent requests on one worker."""
+    """Persistent lock to prevent concurrent requests on one emulator slot.
 
-    _PATH = os.path.join(ROOT_PATH, '.lock')
+    The lock file holds the pid of the process that got the lock and its
+    ticket. A lock whose process has died is reclaimed, so a crashed run does
+    not take its slot out of service.
+    """
 
-    def __init__(self):
-        super(Lock, self).__init__()
-        assert False, 'Instantiation not supported'
+    def __init__(self, serial):
+        self.path = _LOCK_PATH_TEMPLATE % serial
+        self.serial = serial
 
-    @classmethod
-    def active(cls):
-        return os.path.exists(cls._PATH)
+    def active(self):
+        self._reclaim_if_stale()
+        return os.path.exists(self.path)
 
-    @classmethod
-    def get(cls, ticket):
-        if cls.active():
-            raise LockError('Lock already active')
+    def get(self, ticket):
+        contents = '%s\n%s' % (os.getpid(), ticket)
+        self._reclaim_if_stale()
 
-        contents = str(ticket)
+        # O_EXCL makes check-and-create atomic across forked test processes.
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise LockError('Lock already active')
 
-        with open(cls._PATH, 'w') as f:
-            f.write(contents)
+            raise
 
-        _LOG.info('Acquired execution lock with ticket ' + contents)
+        try:
+            os.write(fd, contents)
+        finally:
+            os.close(fd)
 
-    @classmethod
-    def release(cls):
-        if not cls.active():
+        _LOG.info(
+            'Acquired execution lock for slot %s with ticket %s', self.serial,
+            ticket)
+
+    def release(self):
+        if not self.active():
             raise LockError('Lock not active')
 
-        contents = str(cls.value())
-        os.remove(cls._PATH)
-        _LOG.info('Released execution lock with ticket ' + contents)
+        contents = str(self.value())
+        os.remove(self.path)
+        _LOG.info(
+            'Released execution lock for slot %s with ticket %s', self.serial,
+            contents)
 
-    @classmethod
-    def value(cls):
-        if not cls.active():
+    def value(self):
+        lines = self._read()
+        return lines[-1] if lines else None
+
+    def _get_pid(self):
+        lines = self._read()
+
+        # Locks written before pids were recorded hold only the ticket.
+        if not lines or len(lines) < 2 or not lines[0].isdigit():
             return None
 
-        with open(cls._PATH) as f:
-            return f.read().strip()
+        return int(lines[0])
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip().split('\n')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+
+            raise
+
+    def _reclaim_if_stale(self):
+        pid = self._get_pid()
+        if pid is None or _is_process_alive(pid):
+            return
+
+        # Only one process may reclaim at a time; otherwise a slow reclaimer
+        # could remove the lock a faster one has since handed to a new run.
+        guard_path = self.path + '.reclaim'
+        try:
+            os.close(os.open(guard_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return
+
+            raise
+
+        try:
+            if self._get_pid() == pid:
+                os.remove(self.path)
+                _LOG.warning(
+                    'Reclaimed execution lock for slot %s from dead process '
+                    '%s', self.serial, pid)
+        finally:
+            os.remove(guard_path)
+
+
+class SlotPool(object):
+    """Pool of emulator slots that test runs lease for exclusive use.
+
+    Each distinct emulator serial is one slot. Runtimes configured with the same
+    port share an emulator, so they are collapsed into a single slot.
+    """
+
+    def __init__(self, runtimes):
+        self._slots = {}
+
+        for runtime in sorted(runtimes.values(), key=lambda r: r.project_name):
+            self._slots.setdefault(runtime.serial, runtime)
+
+    def busy_count(self):
+        return len([r for r in self._slots.values() if r.lock.active()])
+
+    def full(self):
+        return self.busy_count() == self.size()
+
+    def get_runtimes(self):
+        return [self._slots[serial] for serial in sorted(self._slots)]
+
+    def lease(
+            self, ticket, preferred=None, interval_msec=1000,
+            timeout_sec=_SLOT_LEASE_TIMEOUT_SEC):
+        """Blocks until a slot is free, locks it, and returns its runtime.
+
+        The preferred runtime's slot is tried first. Raises LockError if no slot
+        frees up within timeout_sec.
+        """
+        start = datetime.datetime.utcnow()
+
+        while True:
+            for runtime in self._get_candidates(preferred):
+                try:
+                    runtime.lock.get(ticket)
+                    return runtime
+                except LockError:
+                    pass
+
+            now = datetime.datetime.utcnow()
+            delta_sec = (now - start).total_seconds()
+
+            if delta_sec > timeout_sec:
+                raise LockError(
+                    'No slot free for ticket %s after %ss' % (
+                        ticket, delta_sec))
+
+            _LOG.debug(
+                'All %s slots busy; waiting %sms for ticket %s', self.size(),
+                interval_msec, ticket)
+            time.sleep(interval_msec / 1000.0)
+
+    def release(self, runtime):
+        runtime.lock.release()
+
+    def size(self):
+        return len(self._slots)
+
+    def _get_candidates(self, preferred):
+        candidates = self.get_runtimes()
+
+        if preferred is not None and preferred.serial in self._slots:
+            preferred_slot = self._slots[preferred.serial]
+            candidates.remove(preferred_slot)
+            candidates.insert(0, preferred_slot)
+
+        return candidates
+
+
+class StagingPool(object):
+    """Keeps ready-staged project trees so test runs only have to claim one.
+
+    A background thread keeps up to size hardlink-farm trees per project in
+    staging/<project>/ready and empties the trash that finished runs discard
+    their trees into, keeping both staging and removal off the request path.
+    The thread also refreshes each golden project's cached revision. Each tree
+    is named for the golden revision it was staged from, and trees and cached
+    builds from any other revision are discarded rather than handed out. Result
+    cache keys and worktrees carry the revision too, so they stop matching.
+    """
+
+    def __init__(self, catalog, size=2, interval_sec=1):
+        self._catalog = catalog
+        self._interval_sec = interval_sec
+        self._size = size
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        _LOG.info(
+            'Staging pool started with %s trees per project', self._size)
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _empty_trash(self):
+        if not os.path.exists(_STAGING_TRASH_PATH):
+            return
+
+        for name in os.listdir(_STAGING_TRASH_PATH):
+            shutil.rmtree(
+                os.path.join(_STAGING_TRASH_PATH, name), ignore_errors=True)
+
+    def _fill(self, project):
+        ready_path = _get_staging_ready_path(project.name)
+        revision = project.get_cached_revision()
+        _makedirs(ready_path)
+        ready = 0
+
+        for name in os.listdir(ready_path):
+            if _get_staged_tree_revision(name) == revision:
+                ready += 1
+            else:
+                _discard_staged_tree(os.path.join(ready_path, name))
+
+        for _ in range(self._size - ready):
+            # Stage outside ready/ so a half-built tree is never claimed.
+            staging_path = os.path.join(
+                _STAGING_PATH, project.name, uuid.uuid4().hex)
+            _link_tree(project.path, staging_path)
+            os.rename(
+                staging_path,
+                os.path.join(ready_path, _get_staged_tree_name(revision)))
+
+    def _refresh(self, project):
+        if not project.refresh_revision():
+            return
+
+        revision = project.get_cached_revision()
+        _LOG.info(
+            'Project %s changed to revision %s; discarding staged trees and '
+            'cached builds of other revisions', project.name, revision)
+        _ApkCache.discard_other_revisions(project.name, revision)
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                for project in self._catalog.get().projects.values():
+                    self._refresh(project)
+                    self._fill(project)
+
+                self._empty_trash()
+            except:  # Treat all errors the same. pylint: disable=bare-except
+                _LOG.exception('Staging pool refill failed; will retry')
+
+            self._stopped.wait(self._interval_sec)
+
+
+class RunEvents(object):
+    """Carries test run updates from forked run processes to server.py.
+
+    Create in the server process before forking runs. Each save of a run's
+    result publishes (ticket, TestRun), so the server sees stage transitions
+    and progress without reading the result store.
+    """
+
+    def __init__(self):
+        self._queue = multiprocessing.Queue()
+
+    def get(self, timeout_sec=None):
+        """Gets the next (ticket, TestRun); raises Queue.Empty on timeout."""
+        return self._queue.get(timeout=timeout_sec)
+
+    def publish(self, ticket, test_run):
+        self._queue.put((ticket, test_run))
 
 
 class Patch(object):
@@ -349,20 +1120,38 @@ class TestRun(object):
     BUILD_FAILED = 'build_failed'
     BUILD_SUCCEEDED = 'build_succeeded'
     CONTENTS_MALFORMED = 'contents_malformed'
+    CRASHED = 'crashed'
+    DEVICE_FAILED = 'device_failed'
     NOT_FOUND = 'not_found'
     PROJECT_MISCONFIGURED = 'project_misconfigured'
+    QUEUED = 'queued'
     RUNTIME_MISCONFIGURED = 'runtime_misconfigured'
     RUNTIME_NOT_RUNNING = 'runtime_not_running'
     TESTS_FAILED = 'tests_failed'
     TESTS_RUNNING = 'tests_running'
     TESTS_SUCCEEDED = 'tests_succeeded'
     UNAVAILABLE = 'unavailable'
+    STAGE_BUILDING = 'building'
+    STAGE_DONE = 'done'
+    STAGE_INSTALLING = 'installing'
+    STAGE_STAGED = 'staged'
+    STAGE_TESTING = 'testing'
+    STAGES = frozenset((
+        STAGE_BUILDING,
+        STAGE_DONE,
+        STAGE_INSTALLING,
+        STAGE_STAGED,
+        STAGE_TESTING,
+    ))
     STATUSES = frozenset((
         BUILD_FAILED,
         BUILD_SUCCEEDED,
         CONTENTS_MALFORMED,
+        CRASHED,
+        DEVICE_FAILED,
         NOT_FOUND,
         PROJECT_MISCONFIGURED,
+        QUEUED,
         RUNTIME_MISCONFIGURED,
         RUNTIME_NOT_RUNNING,
         TESTS_FAILED,
@@ -372,18 +1161,84 @@ class TestRun(object):
     ))
 
     def __init__(self):
+        self._image_path = None
         self._payload = None
+        self._progress = None
+        self._queue = None
+        self._spans = []
+        self._stage = None
         self._status = None
 
+    def get_image(self):
+        """Gets the raw result image bytes, or None if there is no image."""
+
+        if not (self._image_path and os.path.exists(self._image_path)):
+            return None
+
+        with open(self._image_path, 'rb') as f:
+            return f.read()
+
+    def get_image_path(self):
+        return self._image_path
+
     def get_payload(self):
         return self._payload
 
+    def get_progress(self):
+        return self._progress
+
+    def get_queue(self):
+        return self._queue
+
+    def get_spans(self):
+        return self._spans
+
+    def get_stage(self):
+        return self._stage
+
     def get_status(self):
         return self._status
 
+    def get_timings(self):
+        """Gets dict of phase name -> seconds spent in it, from the spans."""
+
+        timings = {}
+
+        for span in _iter_spans(self._spans):
+            for phase, names in _PHASE_SPANS.iteritems():
+                if span['name'] in names and span['end_sec'] is not None:
+                    timings[phase] = timings.get(phase, 0) + (
+                        span['end_sec'] - span['start_sec'])
+
+        return dict(
+            (phase, round(sec, 3)) for phase, sec in timings.iteritems())
+
+    def set_image_path(self, value):
+        self._image_path = value
+
     def set_payload(self, value):
         self._payload = value
 
+    def set_progress(self, value):
+        """Sets the latest line of output from the run's current command."""
+        self._progress = value
+
+    def set_queue(self, value):
+        """Sets dict of queue position and estimated_start_sec, or None."""
+        self._queue = value
+
+    def set_spans(self, value):
+        """Sets list of timing span dicts; see _Spans."""
+        self._spans = value
+
+    def set_stage(self, value):
+        if value not in self.STAGES:
+            raise ValueError(
+                'Value %s invalid; choices are %s' % (
+                value, ', '.join(sorted(self.STAGES))))
+
+        self._stage = value
+
     def set_status(self, value):
         if value not in self.STATUSES:
             raise ValueError(
@@ -392,18 +1247,476 @@ class TestRun(object):
 
         self._status = value
 
-    def to_dict(self):
+    def to_dict(self, include_image=True):
+        """Gets a dict for JSON encoding.
+
+        Successful runs keep their image on disk rather than in the payload. If
+        include_image, it is base64-encoded into the payload for clients that
+        expect it there.
+        """
+
+        payload = self.get_payload()
+
+        if include_image and payload is None:
+            image = self.get_image()
+            if image is not None:
+                payload = base64.b64encode(image)
+
         return {
-            'payload': self.get_payload(),
+            'payload': payload,
+            'progress': self.get_progress(),
+            'queue': self.get_queue(),
+            'spans': self.get_spans(),
+            'stage': self.get_stage(),
             'status': self.get_status(),
+            'timings': self.get_timings(),
         }
 
 
+class ResultCache(object):
+    """Maps submissions to the ticket whose run answers them.
+
+    Lives in server.py's process. A submission's key is its project, the golden
+    project's revision, and the fingerprints of its patches. When a key matches
+    a finished run with a deterministic outcome, or a run that is still in
+    flight, the new ticket is aliased to that run's ticket instead of starting
+    another run. A ticket reserves its key before it is submitted, so identical
+    submissions that arrive together coalesce onto the first. Entries expire
+    with their results and the least recently used are evicted past
+    max_entries.
+    """
+
+    # Outcomes decided by the submission. DEVICE_FAILED is left out: it says
+    # nothing about the submission, and a retry may well succeed.
+    _CACHEABLE = frozenset([
+        TestRun.BUILD_FAILED,
+        TestRun.TESTS_FAILED,
+        TestRun.TESTS_SUCCEEDED,
+    ])
+    _IN_FLIGHT = frozenset([
+        TestRun.BUILD_SUCCEEDED,
+        TestRun.QUEUED,
+        TestRun.TESTS_RUNNING,
+    ])
+    DEFAULT_MAX_ENTRIES = 1000
+    # Runs write no result until they lease a slot, so a missing result is
+    # still in flight for up to the lease timeout.
+    _NOT_STARTED_GRACE_SEC = _SLOT_LEASE_TIMEOUT_SEC + 30
+
+    def __init__(
+            self, max_entries=DEFAULT_MAX_ENTRIES, ttl_sec=_RESULTS_TTL_SEC):
+        self._aliases = collections.OrderedDict()
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._ttl_sec = ttl_sec
+
+    @classmethod
+    def get_key(cls, project, patches):
+        return _get_fingerprint(json.dumps([
+            project.name, project.get_cached_revision(),
+            sorted([(p.filename, _get_fingerprint(p.contents))
+                    for p in patches])]))
+
+    def alias(self, ticket, source_ticket):
+        with self._lock:
+            self._put(self._aliases, ticket, (source_ticket, time.time()))
+
+    def discard(self, ticket):
+        """Drops entries answered by ticket, say once its result is removed."""
+
+        with self._lock:
+            for entries in (self._entries, self._aliases):
+                for key, (entry_ticket, _) in entries.items():
+                    if entry_ticket == ticket:
+                        del entries[key]
+
+    def lookup(self, key, get_test_run_fn=None):
+        """Gets the ticket that answers key, or None on a miss.
+
+        get_test_run_fn(ticket) gets a ticket's TestRun; by default it is read
+        from the result store.
+        """
+
+        get_test_run_fn = get_test_run_fn or _TestEnvironment.get_test_run
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        ticket, created_sec = entry
+        age_sec = time.time() - created_sec
+        status = None
+
+        if age_sec < self._ttl_sec:
+            status = get_test_run_fn(ticket).get_status()
+            in_flight = status in self._IN_FLIGHT or (
+                status == TestRun.NOT_FOUND and
+                age_sec < self._NOT_STARTED_GRACE_SEC)
+
+            if status in self._CACHEABLE or in_flight:
+                self._touch(key, entry)
+                return ticket
+
+        _LOG.info(
+            'Dropping result cache entry for ticket %s with status %s', ticket,
+            status)
+
+        # Unless another ticket has reserved the key since.
+        with self._lock:
+            if self._entries.get(key) == entry:
+                del self._entries[key]
+
+        return None
+
+    def reserve(self, key, ticket):
+        """Records that ticket runs key unless another ticket got there first.
+
+        Returns the ticket that runs key if it is not ticket, else None. Call
+        after a lookup() miss and before submitting ticket, so concurrent
+        identical submissions start one run. If the submission fails,
+        discard(ticket) drops the reservation.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] != ticket:
+                return entry[0]
+
+            self._put(self._entries, key, (ticket, time.time()))
+            return None
+
+    def resolve(self, ticket):
+        """Gets the ticket whose result should be served for ticket."""
+
+        with self._lock:
+            entry = self._aliases.get(ticket)
+
+        if entry is None or time.time() - entry[1] >= self._ttl_sec:
+            return ticket
+
+        return entry[0]
+
+    def _touch(self, key, entry):
+        # Marks the entry most recently used, unless it has been replaced.
+        with self._lock:
+            if self._entries.get(key) == entry:
+                self._put(self._entries, key, entry)
+
+    def _put(self, ordered_dict, key, value):
+        ordered_dict.pop(key, None)
+        ordered_dict[key] = value
+
+        while len(ordered_dict) > self._max_entries:
+            ordered_dict.popitem(last=False)
+
+
+class ResultReaper(object):
+    """Removes expired results, and the oldest past quota_bytes.
+
+    Lives in server.py's process, so runs never scan results/ themselves. At
+    start the existing results are listed from the ResultStore into a heap
+    ordered by age; after that each run is added once finished, so a pass only
+    looks at the oldest result. An added result is measured settle_sec later,
+    once its run has torn down its staged project.
+
+    Every sweep_sec the store is also listed for results never added, such as
+    those of runs that crashed or were killed and of standalone worker.py
+    runs. Each is tracked once finished, or once not updated for ttl_sec;
+    other unfinished runs are never removed. remove_fn(ticket), if given, is
+    called for each result removed.
+    """
+
+    def __init__(
+            self, quota_bytes=None, ttl_sec=_RESULTS_TTL_SEC, interval_sec=5,
+            remove_fn=None, store=None, settle_sec=_RESULTS_SETTLE_SEC,
+            sweep_sec=_RESULTS_SWEEP_INTERVAL_SEC):
+        self._heap = []
+        self._interval_sec = interval_sec
+        self._lock = threading.Lock()
+        self._pending = []
+        self._quota_bytes = quota_bytes
+        self._remove_fn = remove_fn
+        self._settle_sec = settle_sec
+        self._sizes = {}
+        self._stopped = threading.Event()
+        self._store = store or ResultStore()
+        self._sweep_sec = sweep_sec
+        self._swept_sec = time.time()
+        self._thread = None
+        self._total_bytes = 0
+        self._ttl_sec = ttl_sec
+
+    def add(self, ticket):
+        """Tracks a finished run's result; cheap, so safe on request paths."""
+
+        with self._lock:
+            self._pending.append((ticket, time.time()))
+
+    def get_usage(self):
+        """Gets (results, bytes) kept for finished runs."""
+
+        with self._lock:
+            return len(self._sizes), self._total_bytes
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        _LOG.info(
+            'Result reaper started with TTL %ssec and quota %s bytes',
+            self._ttl_sec, self._quota_bytes)
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _load(self):
+        for ticket, updated_sec in self._store.list_by_age():
+            self._track(ticket, updated_sec)
+
+    def _loop(self):
+        try:
+            self._load()
+        except:  # Treat all errors the same. pylint: disable=bare-except
+            _LOG.exception('Unable to load existing results')
+
+        while not self._stopped.is_set():
+            try:
+                self._reap()
+            except:  # Treat all errors the same. pylint: disable=bare-except
+                _LOG.exception('Result reaping failed; will retry')
+
+            self._stopped.wait(self._interval_sec)
+
+    def _over_quota(self):
+        return self._quota_bytes is not None and (
+            self._total_bytes > self._quota_bytes)
+
+    def _reap(self):
+        now_sec = time.time()
+
+        with self._lock:
+            settled = [
+                (ticket, added_sec) for ticket, added_sec in self._pending
+                if now_sec - added_sec >= self._settle_sec]
+            self._pending = [
+                (ticket, added_sec) for ticket, added_sec in self._pending
+                if now_sec - added_sec < self._settle_sec]
+
+        for ticket, added_sec in settled:
+            self._track(ticket, added_sec)
+
+        if now_sec - self._swept_sec >= self._sweep_sec:
+            self._sweep(now_sec)
+            self._swept_sec = now_sec
+
+        removed = []
+
+        with self._lock:
+            while self._heap:
+                updated_sec, ticket = self._heap[0]
+                expired = now_sec - updated_sec >= self._ttl_sec
+
+                if not (expired or self._over_quota()):
+                    break
+
+                heapq.heappop(self._heap)
+                self._total_bytes -= self._sizes.pop(ticket)
+                removed.append(ticket)
+                _LOG.info(
+                    'Result %s removed (%s; age: %ssec)', ticket,
+                    'expired' if expired else 'over quota',
+                    now_sec - updated_sec)
+
+        if not removed:
+            return
+
+        self._store.delete(removed)
+
+        if self._remove_fn:
+            for ticket in removed:
+                self._remove_fn(ticket)
+
+    def _sweep(self, now_sec):
+        with self._lock:
+            pending = set(ticket for ticket, _ in self._pending)
+
+        for ticket, updated_sec in self._store.list_by_age():
+            age_sec = now_sec - updated_sec
+
+            if (ticket in self._sizes or ticket in pending or
+                    age_sec < self._settle_sec):
+                continue
+
+            if age_sec < self._ttl_sec:
+                result = self._store.get(ticket)
+
+                if not result or result.get('stage') != TestRun.STAGE_DONE:
+                    continue
+
+            self._track(ticket, updated_sec)
+
+    def _track(self, ticket, updated_sec):
+        if ticket in self._sizes:
+            return
+
+        path = self._store.get_path(ticket)
+        exists = os.path.exists(path)
+
+        # Aliased tickets have no result of their own.
+        if not (exists or self._store.get(ticket)):
+            return
+
+        size = _get_tree_size(path) if exists else 0
+
+        # Only the reaper thread writes these, but get_usage() reads them from
+        # request threads.
+        with self._lock:
+            heapq.heappush(self._heap, (updated_sec, ticket))
+            self._sizes[ticket] = size
+            self._total_bytes += size
+
+
+class ResultStore(object):
+    """Stores test results, indexed by ticket.
+
+    Each result's metadata (the TestRun dict) is a row in an SQLite database
+    in WAL mode, so forked runs write while server.py reads without blocking
+    each other, and a write is atomic. A result's files (its log and image)
+    live in results/<shard>/<ticket>, where shard is the first two hex digits
+    of the ticket's md5, so no directory holds more than a fraction of the
+    tickets. Lookups and deletes cost the same however many tickets are kept.
+
+    Connections are opened per process and thread on first use; forked runs
+    never touch their parent's connection, and are never forked while a
+    connection is in use (see _STORE_FORK_LOCK).
+    """
+
+    # Deletes are batched under SQLite's limit on bound parameters.
+    _DELETE_BATCH_SIZE = 500
+    _SCHEMA = [
+        ('CREATE TABLE IF NOT EXISTS results ('
+         'ticket TEXT PRIMARY KEY, created_sec REAL NOT NULL, '
+         'updated_sec REAL NOT NULL, result TEXT NOT NULL)'),
+        ('CREATE INDEX IF NOT EXISTS results_updated_sec '
+         'ON results (updated_sec)'),
+    ]
+    _TIMEOUT_SEC = 30
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def delete(self, tickets):
+        """Deletes the results, files included, of the given tickets."""
+
+        tickets = [str(ticket) for ticket in tickets]
+
+        for i in range(0, len(tickets), self._DELETE_BATCH_SIZE):
+            batch = tickets[i:i + self._DELETE_BATCH_SIZE]
+
+            with _STORE_FORK_LOCK, self._get_connection() as connection:
+                connection.execute(
+                    'DELETE FROM results WHERE ticket IN (%s)' % ', '.join(
+                        '?' * len(batch)), batch)
+
+        # Files go after their rows, so a result is never found without them.
+        for ticket in tickets:
+            shutil.rmtree(self.get_path(ticket), ignore_errors=True)
+
+    def get(self, ticket):
+        """Gets the result dict saved for ticket, or None."""
+
+        with _STORE_FORK_LOCK:
+            row = self._get_connection().execute(
+                'SELECT result FROM results WHERE ticket = ?',
+                (str(ticket),)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def get_path(self, ticket):
+        """Gets the directory holding ticket's files."""
+
+        ticket = str(ticket)
+        return os.path.join(_RESULTS_PATH, _get_fingerprint(ticket)[:2], ticket)
+
+    def list_by_age(self, limit=None):
+        """Gets [(ticket, updated_sec)], least recently updated first."""
+
+        with _STORE_FORK_LOCK:
+            return self._get_connection().execute(
+                'SELECT ticket, updated_sec FROM results ORDER BY updated_sec '
+                'LIMIT ?', (-1 if limit is None else limit,)).fetchall()
+
+    def put(self, ticket, result):
+        """Saves result, a dict, for ticket, replacing any earlier result."""
+
+        ticket = str(ticket)
+        value = json.dumps(result)
+        now_sec = time.time()
+
+        with _STORE_FORK_LOCK, self._get_connection() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)',
+                (ticket, now_sec, now_sec, value))
+            connection.execute(
+                'UPDATE results SET updated_sec = ?, result = ? '
+                'WHERE ticket = ?', (now_sec, value, ticket))
+
+    def _get_connection(self):
+        # Keyed by path too, so set_root_path() moves the index.
+        key = (os.getpid(), os.path.join(_RESULTS_PATH, _RESULTS_INDEX_NAME))
+
+        if getattr(self._local, 'key', None) == key:
+            return self._local.connection
+
+        _makedirs(_RESULTS_PATH)
+        connection = sqlite3.connect(key[1], timeout=self._TIMEOUT_SEC)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # With WAL, commits stay atomic; only the last few may be lost on a
+        # power failure.
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        for statement in self._SCHEMA:
+            connection.execute(statement)
+
+        self._local.connection = connection
+        self._local.key = key
+        return connection
+
+
 def _build_all(projects):
     for project in projects.values():
         project.build()
 
 
+def _call_parallel(fns):
+    """Calls fns concurrently on threads; returns their results in order."""
+
+    results = [None] * len(fns)
+
+    def call(index, fn):
+        results[index] = fn()
+
+    threads = [
+        threading.Thread(target=call, args=(i, fn))
+        for i, fn in enumerate(fns)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
 def _clean(clean, projects, runtimes):
     # Emulators depend on projects and runtimes; do them first.
     if clean in (_CLEAN_ALL, _CLEAN_EMULATORS, _CLEAN_LOCAL):
@@ -415,6 +1728,12 @@ def _clean(clean, projects, runtimes):
     if clean in (_CLEAN_ALL, _CLEAN_LOCAL, _CLEAN_RUNTIMES):
         _clean_runtimes(runtimes)
 
+    if clean in (_CLEAN_ALL, _CLEAN_LOCAL, _CLEAN_WORKTREES):
+        _clean_worktrees()
+
+    if clean in (_CLEAN_ALL, _CLEAN_BUILDS, _CLEAN_LOCAL):
+        _clean_builds()
+
     # We can clean most accurately if we still have the SDK, so save cleaning it
     # up for the end.
     if clean in (_CLEAN_ALL, _CLEAN_RESOURCES):
@@ -425,9 +1744,15 @@ def _clean(clean, projects, runtimes):
         _clean_pyc()
 
 
-def _clean_emulators(projects, strict=False):
-    for project in projects.values():
-        project.uninstall(strict=strict)
+def _clean_builds():
+    if os.path.exists(_APK_CACHE_PATH):
+        shutil.rmtree(_APK_CACHE_PATH)
+        _LOG.info('Removed cached builds directory %s', _APK_CACHE_PATH)
+
+
+def _clean_emulators(projects, runtimes, strict=False):
+    for project, runtime in _get_project_runtime_iter(projects, runtimes):
+        project.uninstall(runtime.serial, strict=strict)
 
 
 def _clean_pyc():
@@ -446,6 +1771,14 @@ def _clean_results():
         shutil.rmtree(_RESULTS_PATH)
         _LOG.info('Removed results directory %s', _RESULTS_PATH)
 
+    if os.path.exists(_STAGING_PATH):
+        shutil.rmtree(_STAGING_PATH)
+        _LOG.info('Removed staging directory %s', _STAGING_PATH)
+
+    if os.path.exists(_QUEUE_PATH):
+        shutil.rmtree(_QUEUE_PATH)
+        _LOG.info('Removed queue directory %s', _QUEUE_PATH)
+
 
 def _clean_resources():
     if os.path.exists(_RESOURCES_PATH):
@@ -458,25 +1791,105 @@ def _clean_runtimes(runtimes):
         runtime.clean()
 
 
+def _claim_staged_tree(project_name, path, revision):
+    """Moves a tree pre-staged from revision to path; returns success.
+
+    Trees staged from any other revision are discarded.
+    """
+
+    ready_path = _get_staging_ready_path(project_name)
+    if not os.path.exists(ready_path):
+        return False
+
+    for name in os.listdir(ready_path):
+        if _get_staged_tree_revision(name) != revision:
+            _discard_staged_tree(os.path.join(ready_path, name))
+            continue
+
+        # rename() is atomic, so a tree claimed by a concurrent test process
+        # just fails here and we try the next one.
+        try:
+            os.rename(os.path.join(ready_path, name), path)
+            return True
+        except OSError:
+            pass
+
+    return False
+
+
+def _clean_worktrees():
+    if os.path.exists(_WORKTREES_PATH):
+        shutil.rmtree(_WORKTREES_PATH)
+        _LOG.info('Removed worktrees directory %s', _WORKTREES_PATH)
+
+
 def _die(message):
     _LOG.critical(message)
     sys.exit(1)
 
 
+def _discard_staged_tree(path):
+    # Another process may have claimed or discarded the tree first.
+    try:
+        _discard_tree(path)
+    except OSError:
+        pass
+
+
+def _discard_tree(path):
+    """Moves a tree to the trash for the StagingPool to delete later."""
+
+    if not os.path.exists(_STAGING_TRASH_PATH):
+        _makedirs(_STAGING_TRASH_PATH)
+
+    os.rename(path, os.path.join(_STAGING_TRASH_PATH, uuid.uuid4().hex))
+
+
+def _block_until_ready(runtimes, interval_msec=1000, timeout_sec=60*10):
+    """Waits for all runtimes to be ready, polling them together."""
+
+    start = datetime.datetime.utcnow()
+    pending = list(runtimes)
+
+    while True:
+        pending = [runtime for runtime in pending if not runtime.ready()]
+        if not pending:
+            return
+
+        now = datetime.datetime.utcnow()
+        delta_sec = (now - start).total_seconds()
+        names = ', '.join(runtime.project_name for runtime in pending)
+
+        if delta_sec > timeout_sec:
+            _die('Runtimes %s timed out at %ss; aborting' % (names, delta_sec))
+
+        _LOG.debug('Waiting %sms for runtimes %s', interval_msec, names)
+        time.sleep(interval_msec / 1000.0)
+
+
 def _ensure_emulators_running_and_ready(runtimes, headless=True):
-    # TODO(johncox): serial and slow; parallelize if we have many runtimes.
-    for runtime in runtimes.values():
+    # Runtimes that share a port share an emulator, so start one per slot.
+    starting = []
+
+    for runtime in SlotPool(runtimes).get_runtimes():
         if runtime.ready():
             _LOG.info(
-                    'Emulator for runtime %s already ready on port %s; reusing',
-                    runtime.project_name, runtime.port)
+                'Emulator for runtime %s already ready on port %s; reusing',
+                runtime.project_name, runtime.port)
         else:
             runtime.start(headless=headless)
             _LOG.info(
                 'Emulator for runtime %s not ready; waiting',
                 runtime.project_name)
-            runtime.block_until_ready()
-            _LOG.info('Runtime %s emulator ready', runtime.project_name)
+            starting.append(runtime)
+
+    _block_until_ready(starting)
+
+    for runtime in starting:
+        _LOG.info('Runtime %s emulator ready', runtime.project_name)
+
+        if not runtime.has_snapshot():
+            runtime.save_snapshot()
 
 
 def _ensure_projects_exist(projects):
@@ -523,10 +1936,49 @@ def _ensure_sdk_installed():
         _LOG.info('Using existing SDK at %s', _Sdk.PATH)
 
 
+def _fork_test(
+        config, project_name, ticket, patches=None, incremental=False,
+        events=None):
+    child = multiprocessing.Process(
+        target=run_test, args=(config, project_name, ticket),
+        kwargs={
+            'events': events, 'incremental': incremental, 'patches': patches})
+    child.daemon = True
+
+    with _STORE_FORK_LOCK:
+        child.start()
+
+    return child
+
+
+def _get_adb_client(timeout_sec=adb.DEFAULT_TIMEOUT_SEC):
+    host, port = _ADB_ADDRESS
+    return adb.Client(
+        host=host, port=port, start_server_fn=_start_adb_server,
+        timeout_sec=timeout_sec)
+
+
 def _get_fingerprint(value):
     return md5.new(value).hexdigest()
 
 
+def _get_monotonic_sec():
+    """Gets seconds on a clock that wall clock changes don't move.
+
+    Python 2 has no time.monotonic, so this calls clock_gettime() through
+    ctypes. Without it, os.times()'s elapsed real time is used: also
+    monotonic, but only as fine as the clock tick.
+    """
+
+    if _CLOCK_GETTIME is not None:
+        timespec = _Timespec()
+
+        if not _CLOCK_GETTIME(_CLOCK_MONOTONIC, ctypes.byref(timespec)):
+            return timespec.tv_sec + timespec.tv_nsec / 1e9
+
+    return os.times()[4]
+
+
 def _get_project_runtime_iter(projects, runtimes):
     """Gets iterator over (project, runtime) pairs ordered by project name."""
     assert len(projects) == len(runtimes)
@@ -536,13 +1988,136 @@ def _get_project_runtime_iter(projects, runtimes):
     return ((project, runtime) for project, runtime in zip(projects, runtimes))
 
 
+def _get_staged_tree_name(revision):
+    return '%s.%s' % (revision, uuid.uuid4().hex)
+
+
+def _get_staged_tree_revision(name):
+    return name.split('.', 1)[0]
+
+
+def _get_staging_ready_path(project_name):
+    return os.path.join(_STAGING_PATH, project_name, _STAGING_READY)
+
+
+def _get_stat_key(path):
+    """Gets a value that changes when path is modified or replaced."""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
 def _get_strict_handler(strict):
     return _die if strict else _LOG.info
 
 
-def _install_packages(projects):
-    for project in projects.values():
-        project.install()
+def _get_tree_size(path):
+    """Gets the bytes of files only path holds.
+
+    Hardlinked files, such as a link farm's, are skipped: removing path
+    frees none of their space.
+    """
+
+    size = 0
+
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(root, filename))
+            except OSError:
+                continue
+
+            if stat.st_nlink == 1:
+                size += stat.st_size
+
+    return size
+
+
+def _install_packages(projects, runtimes):
+    for project, runtime in _get_project_runtime_iter(projects, runtimes):
+        try:
+            project.install(runtime.serial)
+        except DeviceError as e:
+            _LOG.error(e)
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+def _is_test_failure(line):
+    return any(matcher.search(line) for matcher in _TEST_FAILURE_MATCHERS)
+
+
+def _iter_spans(spans):
+    """Yields each span dict in spans and, depth first, its children."""
+
+    for span in spans:
+        yield span
+
+        for child in _iter_spans(span['children']):
+            yield child
+
+
+def _link_tree(src, dst):
+    """Stages src at dst as real directories holding hardlinks to src's files.
+
+    Staging costs one link() per file instead of a copy, independent of file
+    size. Writers must replace rather than modify staged files; see
+    _Project.patch().
+    """
+
+    for root, dirs, files in os.walk(src):
+        _prune_staging_dirs(src, root, dirs, files)
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root)
+
+        for name in files:
+            from_path = os.path.join(root, name)
+            to_path = os.path.join(target_root, name)
+
+            if os.path.islink(from_path):
+                os.symlink(os.readlink(from_path), to_path)
+                continue
+
+            # Fall back to copying across filesystems.
+            try:
+                os.link(from_path, to_path)
+            except OSError:
+                shutil.copy2(from_path, to_path)
+
+
+def _makedirs(path):
+    """os.makedirs() that tolerates concurrent creation of the same path."""
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _prune_staging_dirs(src, root, dirs, files):
+    """Drops the dirs staging never links from an os.walk() step under src."""
+
+    pruned = set()
+
+    if root == src:
+        pruned |= _STAGING_PRUNE_ROOT_DIRS
+
+    if root == src or _GRADLE_BUILD_FILE in files:
+        pruned |= _STAGING_PRUNE_MODULE_DIRS
+
+    dirs[:] = sorted(d for d in dirs if d not in pruned)
 
 
 def _read_json(path):
@@ -555,27 +2130,90 @@ def _read_json(path):
                 path)
 
 
-def _run(command_line, cwd=None, env=None, proc_fn=None, strict=True):
+def _replace_apk_resources(base_apk, resources_apk, out_apk):
+    """Writes base_apk to out_apk with resources_apk's resources, unsigned."""
+
+    def is_resource(name):
+        return name == 'resources.arsc' or name.startswith('res/')
+
+    with zipfile.ZipFile(base_apk) as base, zipfile.ZipFile(
+            resources_apk) as resources, zipfile.ZipFile(out_apk, 'w') as out:
+        for info in base.infolist():
+            # Dropping META-INF removes the now-stale signature.
+            if not (is_resource(info.filename) or
+                    info.filename.startswith('META-INF/')):
+                out.writestr(info, base.read(info.filename))
+
+        for info in resources.infolist():
+            if is_resource(info.filename):
+                out.writestr(info, resources.read(info.filename))
+
+
+def _run(
+        command_line, cwd=None, env=None, proc_fn=None, strict=True,
+        line_fn=None, matchers=None):
+    """Runs a command, streaming its output.
+
+    Output lines are read as they are produced and passed to line_fn. If a line
+    matches any regex in matchers the command has decisively failed, so it and
+    any children it started are terminated rather than left to wind down.
+    Returns (returncode, lines), with stdout lines ahead of stderr lines.
+    """
+
     env = env if env is not None else {}
+    matchers = matchers if matchers is not None else []
 
-    result = []
     _LOG.debug('Running command: ' + ' '.join(command_line))
+    # A terminable command gets its own process group so terminating it also
+    # reaches children (e.g. gradlew's JVM) that hold its output pipes open.
+    preexec_fn = os.setsid if matchers else None
     proc = subprocess.Popen(
-        command_line, cwd=cwd, env=env, stderr=subprocess.PIPE,
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        command_line, cwd=cwd, env=env, preexec_fn=preexec_fn,
+        stderr=subprocess.PIPE, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
     if proc_fn:
         proc_fn(proc)
 
-    got_stdout, got_stderr = proc.communicate()
+    proc.stdin.close()
+    lines = Queue.Queue()
+    stdout = []
+    stderr = []
+    readers = [
+        _start_line_reader(proc.stdout, stdout, lines),
+        _start_line_reader(proc.stderr, stderr, lines)]
+    open_readers = len(readers)
 
-    if got_stdout:
-        for line in got_stdout.split('\n'):
-            result.append(line)
+    try:
+        while open_readers:
+            line = lines.get()
+
+            if line is None:
+                open_readers -= 1
+                continue
+
+            if line_fn:
+                line_fn(line)
+
+            if proc.poll() is None and [m for m in matchers if m.search(line)]:
+                _LOG.info(
+                    'Stopping command "%s" after decisive failure: %s',
+                    ' '.join(command_line), line)
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except OSError:  # Exited since we polled.
+                    pass
+
+        for reader in readers:
+            reader.join()
+
+        proc.wait()
+    finally:
+        # line_fn may raise, e.g. when streaming to a closed socket.
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
 
-    if got_stderr:
-        for line in got_stderr.split('\n'):
-            result.append(line)
+    result = stdout + stderr
 
     if proc.returncode != 0 and strict:
         _die(
@@ -585,15 +2223,69 @@ def _run(command_line, cwd=None, env=None, proc_fn=None, strict=True):
     return proc.returncode, result
 
 
+def _gradlew(path, tasks, serial=None, line_fn=None):
+    # --daemon keeps a warm gradle daemon per project across runs, which skips
+    # JVM startup and most configuration time.
+    return _run(
+        [os.path.join(path, 'gradlew'), _GRADLEW_DAEMON_FLAG] + tasks, cwd=path,
+        env=_Sdk.get_shell_env(serial=serial), strict=False, line_fn=line_fn,
+        matchers=_GRADLEW_FAILURE_MATCHERS)
+
+
+def _sign_debug_apk(path):
+    """Signs an APK in place with the debug key gradle uses."""
+
+    return _run([
+        'jarsigner', '-sigalg', 'SHA1withRSA', '-digestalg', 'SHA1',
+        '-keystore', _DEBUG_KEYSTORE_PATH, '-storepass',
+        _DEBUG_KEYSTORE_PASSWORD, '-keypass', _DEBUG_KEYSTORE_PASSWORD, path,
+        _DEBUG_KEY_ALIAS], env={'PATH': os.environ.get('PATH', os.defpath)},
+        strict=False)
+
+
+def _start_adb_server():
+    _run([_Sdk.get_adb(), 'start-server'], strict=False)
+
+
+def _start_line_reader(stream, lines, queue):
+    """Reads stream in a thread, saving lines and sending them to queue.
+
+    Lines keep any trailing '\\r' (adb shell emits them) but not '\\n'. None is
+    sent to queue at EOF.
+    """
+
+    def read():
+        for line in iter(stream.readline, ''):
+            line = line[:-1] if line.endswith('\n') else line
+            lines.append(line)
+            queue.put(line)
+
+        queue.put(None)
+
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
 def _stop(runtimes):
     for runtime in runtimes.values():
         runtime.stop()
 
 
-def _test(name, project, runtime, strict=False):
-    """Run a project's tests, either under worker.py or under a web caller."""
+def _test(
+        name, project, runtime, strict=False, progress_fn=None, stage_fn=None,
+        image_path=None, spans=None):
+    """Run a project's tests, either under worker.py or under a web caller.
+
+    If given, progress_fn is called with each line of build and test output,
+    stage_fn with each TestRun.STAGE_* the run enters, and the install and test
+    steps are recorded in spans. Device and adb failures are reported as
+    TestRun.DEVICE_FAILED rather than as build or test failures.
+    """
 
     handler = _get_strict_handler(strict)
+    spans = spans or _Spans()
     test_run = TestRun()
 
     if not project:
@@ -611,7 +2303,15 @@ def _test(name, project, runtime, strict=False):
         test_run.set_status(TestRun.RUNTIME_NOT_RUNNING)
         return test_run
 
-    build_succeeded, build_result = project.install()
+    try:
+        with spans.span('install'):
+            build_succeeded, build_result = project.install(
+                runtime.serial, progress_fn=progress_fn, stage_fn=stage_fn,
+                spans=spans)
+    except DeviceError as e:
+        test_run.set_status(TestRun.DEVICE_FAILED)
+        test_run.set_payload(str(e))
+        return test_run
 
     if not build_succeeded:
         test_run.set_status(TestRun.BUILD_FAILED)
@@ -619,17 +2319,149 @@ def _test(name, project, runtime, strict=False):
         return test_run
 
     test_run.set_status(TestRun.BUILD_SUCCEEDED)
-    test_succeeded, test_result = project.test()
+
+    if stage_fn:
+        stage_fn(TestRun.STAGE_TESTING)
+
+    try:
+        with spans.span('test'):
+            test_succeeded, test_result = project.test(
+                runtime.serial, progress_fn=progress_fn, image_path=image_path,
+                spans=spans)
+    except DeviceError as e:
+        test_run.set_status(TestRun.DEVICE_FAILED)
+        test_run.set_payload(str(e))
+        return test_run
 
     if not test_succeeded:
         test_run.set_status(TestRun.TESTS_FAILED)
         test_run.set_payload('\n'.join(test_result))
         return test_run
 
-    test_run.set_status(TestRun.TESTS_SUCCEEDED)
-    test_run.set_payload(test_result)
-    _LOG.info('Tests succeeded for project %s', name)
-    return test_run
+    test_run.set_status(TestRun.TESTS_SUCCEEDED)
+    test_run.set_image_path(test_result)
+    _LOG.info('Tests succeeded for project %s', name)
+    return test_run
+
+
+_QueueEntry = collections.namedtuple(
+    '_QueueEntry',
+    ['ticket', 'project_name', 'patches', 'submitted_sec', 'path'])
+
+
+class _ApkCache(object):
+    """Debug and test APKs from a full build, reused by the resource fast path.
+
+    Entries are keyed by project name and golden project revision. They are only
+    written from builds whose patches touched nothing but resources, so their
+    compiled code matches the golden project's. Each entry also keeps the R.txt
+    symbols its resources produced; a fast path build is only valid if its
+    resources produce the same symbols, since compiled code inlines resource
+    ids.
+    """
+
+    _APP_APK = 'app.apk'
+    _META = 'meta.json'
+    _SYMBOLS = 'R.txt'
+    _TEST_APK = 'test.apk'
+
+    def __init__(self, project_name, revision):
+        self.path = os.path.join(_APK_CACHE_PATH, project_name, revision)
+        self.app_apk = os.path.join(self.path, self._APP_APK)
+        self.symbols = os.path.join(self.path, self._SYMBOLS)
+        self.test_apk = os.path.join(self.path, self._TEST_APK)
+
+    @classmethod
+    def discard_other_revisions(cls, project_name, revision):
+        path = os.path.join(_APK_CACHE_PATH, project_name)
+        if not os.path.exists(path):
+            return
+
+        for name in os.listdir(path):
+            # Names with a dot are entries still being built; see put().
+            if name != revision and '.' not in name:
+                _discard_staged_tree(os.path.join(path, name))
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, self._META))
+
+    def get_module(self):
+        return _read_json(os.path.join(self.path, self._META))['module']
+
+    def put(self, app_apk, test_apk, symbols, module):
+        # Build the entry aside and rename it in so readers never see a partial
+        # entry; if a concurrent run won the race, keep its entry.
+        staging_path = '%s.%s' % (self.path, uuid.uuid4().hex)
+        os.makedirs(staging_path)
+        shutil.copyfile(app_apk, os.path.join(staging_path, self._APP_APK))
+        shutil.copyfile(symbols, os.path.join(staging_path, self._SYMBOLS))
+        shutil.copyfile(test_apk, os.path.join(staging_path, self._TEST_APK))
+
+        with open(os.path.join(staging_path, self._META), 'w') as f:
+            f.write(json.dumps({'module': module}))
+
+        try:
+            os.rename(staging_path, self.path)
+            _LOG.info('Cached build saved to %s', self.path)
+        except OSError:
+            shutil.rmtree(staging_path)
+
+
+class _LazyConfigMap(collections.Mapping):
+    """Read-only map of name to the object built from its config entry.
+
+    Each object is built on first access and reused after that.
+    """
+
+    def __init__(self, entries, from_config):
+        self._built = {}
+        self._entries = entries
+        self._from_config = from_config
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        if key not in self._built:
+            self._built[key] = self._from_config(key, self._entries[key])
+
+        return self._built[key]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Progress(object):
+    """Publishes a running command's output lines to a test run's status.
+
+    Saves are rate-limited so chatty commands don't rewrite the result on
+    every line. Stage changes are saved immediately.
+    """
+
+    def __init__(self, test_env, test_run, interval_sec=_PROGRESS_INTERVAL_SEC):
+        self._interval_sec = interval_sec
+        self._last_save_sec = 0
+        self._test_env = test_env
+        self._test_run = test_run
+
+    def __call__(self, line):
+        line = line.strip()
+        now_sec = time.time()
+
+        if not line or now_sec - self._last_save_sec < self._interval_sec:
+            return
+
+        self._last_save_sec = now_sec
+        self._test_run.set_progress(line)
+        # Line saves are frequent and timed by their command's span anyway.
+        self._test_env.save(self._test_run, record_span=False)
+
+    def set_stage(self, stage):
+        self._test_run.set_stage(stage)
+        self._test_env.save(self._test_run)
 
 
 class _Project(object):
@@ -640,8 +2472,12 @@ class _Project(object):
         self.name = name
         self.package = package
         self.path = path
+        # Revision of the golden project a test project was staged from.
+        self.src_revision = None
         self.test_class = test_class
         self.test_package = test_package
+        self._patched_files = []
+        self._revision = None
 
     @classmethod
     def from_config(cls, key, value):
@@ -652,9 +2488,7 @@ class _Project(object):
 
     def build(self, strict=False):
         handler = _get_strict_handler(strict)
-        code, result = _run(
-            [self._get_gradlew(), 'build'], cwd=self.path,
-            env=_Sdk.get_shell_env(), strict=False)
+        code, result = _gradlew(self.path, ['build'])
 
         if code:
             handler(
@@ -668,41 +2502,104 @@ class _Project(object):
     def exists(self):
         return os.path.exists(self.path)
 
-    def install(self):
-        """Install packages under worker.py and external callers."""
+    def get_cached_revision(self):
+        """Like get_revision(), but computed once until refresh_revision().
 
-        _, result = _run(
-            [self._get_gradlew(), 'installDebug'], cwd=self.path,
-            env=_Sdk.get_shell_env(), strict=False)
+        server.py's StagingPool refreshes its projects' revisions in the
+        background, so request handlers and the runs they fork read the
+        revision without walking the golden tree.
+        """
 
-        if self._gradlew_failed(result):
-            message = (
-                'Unable to build and install debug package from Project %s; '
-                'error:\n%s') % (self.name, '\n'.join(result))
-            _LOG.error(message)
-            return False, result
+        if self._revision is None:
+            self._revision = self.get_revision()
 
-        else:
-            _LOG.info('Installed debug package from Project %s', self.name)
+        return self._revision
+
+    def get_revision(self):
+        """Gets a fingerprint of file names, sizes, and mtimes."""
+
+        parts = []
+
+        for root, dirs, files in os.walk(self.path):
+            _prune_staging_dirs(self.path, root, dirs, files)
+
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                stat = os.lstat(path)
+                parts.append('%s:%s:%s' % (
+                    os.path.relpath(path, self.path), stat.st_size,
+                    stat.st_mtime))
 
-        _, result = _run(
-            [self._get_gradlew(), 'installDebugTest'], cwd=self.path,
-            env=_Sdk.get_shell_env(), strict=False)
+        return _get_fingerprint('\n'.join(parts))
+
+    def refresh_revision(self):
+        """Recomputes the cached revision; returns True if it changed."""
+
+        revision = self.get_revision()
+        changed = self._revision is not None and revision != self._revision
+        self._revision = revision
+        return changed
+
+    def install(
+            self, serial, progress_fn=None, stage_fn=None, spans=None):
+        """Install packages under worker.py and external callers.
+
+        Both the debug and test debug APKs are built by one gradle invocation,
+        then pushed to the device in parallel. If every patch is a resource
+        file and a cached build exists, gradle is skipped: only resources are
+        repackaged into the cached APK, which is re-signed. Each command is
+        recorded in spans if given. progress_fn, if given, is called with each
+        line of gradle output, and stage_fn with TestRun.STAGE_BUILDING and
+        TestRun.STAGE_INSTALLING. Raises DeviceError if the device or the adb
+        server fails an install.
+        """
+
+        spans = spans or _Spans()
+        resources_module = self._get_patched_resources_module()
+
+        if stage_fn:
+            stage_fn(TestRun.STAGE_BUILDING)
+
+        if resources_module is not None:
+            installed, result = self._install_resources_only(
+                serial, resources_module, stage_fn=stage_fn,
+                spans=spans)
+
+            if installed:
+                return True, result
+
+        with spans.span('gradle_assemble') as span:
+            span.exit_code, result = _gradlew(
+                self.path, _GRADLEW_ASSEMBLE_TASKS, line_fn=progress_fn)
+            span.set_output(result)
 
         if self._gradlew_failed(result):
             message = (
-                'Unable to build and install debug test package from Project '
+                'Unable to build debug and test debug packages from Project '
                 '%s; error:\n%s') % (self.name, '\n'.join(result))
             _LOG.error(message)
             return False, result
 
         else:
-            _LOG.info('Installed debug test package from Project %s', self.name)
+            _LOG.info(
+                'Built debug and test debug packages from Project %s',
+                self.name)
 
-        return (
-            True,
-            [('Debug and test debug packages installed from Project '
-              '%s') % self.name])
+        apks = self._get_apks()
+        if not apks:
+            message = (
+                'Unable to find debug and test debug packages for Project %s '
+                'after build') % self.name
+            _LOG.error(message)
+            return False, [message]
+
+        installed, result = self._install_apks(
+            serial, apks, stage_fn=stage_fn, spans=spans)
+
+        if installed and resources_module is not None:
+            self._cache_apks(apks, resources_module)
+
+        return installed, result
 
     def patch(self, patch):
         """Apply a patch to the project's filesystem."""
@@ -710,20 +2607,43 @@ class _Project(object):
         if not os.path.exists(patch.filename):
             _die('Unable to apply patch; no file named ' + patch.filename)
 
+        # Replace rather than truncate: staged files are hardlinks to the golden
+        # project, and writing through one would patch the golden copy.
+        os.remove(patch.filename)
         with open(patch.filename, 'w') as f:
             f.write(patch.contents)
 
+        self._patched_files.append(patch.filename)
+
         _LOG.debug(
             'Patched file %s with contents fingerprint %s',
             patch.filename, _get_fingerprint(patch.contents))
 
-    def test(self):
-        """Runs tests under worker.py and external callers."""
+    def test(self, serial, progress_fn=None, image_path=None, spans=None):
+        """Runs tests under worker.py and external callers.
+
+        On success, returns (True, path) where path is image_path (default:
+        inside the project) holding the result image streamed off the device.
+        The instrumentation and image pull are recorded in spans if given.
+        Raises DeviceError if the device or the adb server fails either.
+        """
+
+        spans = spans or _Spans()
 
-        _, result = _run([
-            _Sdk.get_adb(), 'shell', 'am', 'instrument', '-w', '-e', 'class',
-            self.test_class,
-            '%s/android.test.InstrumentationTestRunner' % self.test_package])
+        try:
+            with spans.span('instrument') as span:
+                result = _get_adb_client().shell(
+                    serial,
+                    'am instrument -w -e class %s '
+                    '%s/android.test.InstrumentationTestRunner' % (
+                        self.test_class, self.test_package),
+                    line_fn=progress_fn, stop_fn=_is_test_failure,
+                    timeout_sec=_ADB_INSTRUMENT_TIMEOUT_SEC)
+                span.set_output(result)
+        except (adb.Error, socket.error) as e:
+            _LOG.error(
+                'Unable to run tests for project %s; error: %s', self.name, e)
+            raise DeviceError('Unable to run tests: %s' % e)
 
         if self._tests_failed(result):
             message = 'Tests failed for project %s; result:\n%s' % (
@@ -734,15 +2654,24 @@ class _Project(object):
         else:
             _LOG.info('Tests passed for project %s', self.name)
 
-        return True, self._get_b64encoded_image()
+        image_path = image_path or os.path.join(self.path, _RESULT_IMAGE_NAME)
+
+        try:
+            with spans.span('pull_image') as span:
+                span.output_bytes = self._pull_image(serial, image_path)
+
+            return True, image_path
+        except (adb.Error, socket.error) as e:
+            _LOG.error(
+                'Unable to pull result image for project %s; error: %s',
+                self.name, e)
+            raise DeviceError('Unable to pull result image: %s' % e)
 
-    def uninstall(self, strict=False):
+    def uninstall(self, serial, strict=False):
         """Uninstall packages under worker.py only."""
 
         handler = _get_strict_handler(strict)
-        _, result = _run(
-            [self._get_gradlew(), 'uninstallDebugTest'], cwd=self.path,
-            env=_Sdk.get_shell_env(), strict=False)
+        _, result = _gradlew(self.path, ['uninstallDebugTest'], serial=serial)
 
         if self._gradlew_failed(result):
             handler(
@@ -752,9 +2681,7 @@ class _Project(object):
             _LOG.info(
                 'Uninstalled debug test package from Project %s', self.name)
 
-        _, result = _run(
-            [self._get_gradlew(), 'uninstallDebug'], cwd=self.path,
-            env=_Sdk.get_shell_env(), strict=False)
+        _, result = _gradlew(self.path, ['uninstallDebug'], serial=serial)
 
         if self._gradlew_failed(result):
             handler(
@@ -762,24 +2689,262 @@ class _Project(object):
         else:
             _LOG.info('Uninstalled debug package from Project %s', self.name)
 
-    def _get_b64encoded_image(self):
-        local_path = os.path.join(self.path, _RESULT_IMAGE_NAME)
-        _run([
-            _Sdk.get_adb(), 'pull',
-            os.path.join('/sdcard/Robotium-screenshots/', _RESULT_IMAGE_NAME),
-            os.path.join(self.path, _RESULT_IMAGE_NAME)])
+    def _adb_install_failed(self, result):
+        return not [
+            line for line in result
+            if line.strip() == _ADB_INSTALL_SUCCESS_NEEDLE]
+
+    def _cache_apks(self, apks, resources_module):
+        cache = self._get_apk_cache()
+        if cache.exists():
+            return
+
+        app_apk, test_apk = apks
+        # apks are <module>/build/outputs/apk/<name>.apk.
+        module = os.path.relpath(
+            os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+                app_apk)))), self.path)
+
+        # Patches to another module's resources were compiled into these APKs.
+        if module != resources_module:
+            return
+
+        out_path = self._get_resource_build_path()
+        code, result, _ = self._package_resources(module, out_path)
+
+        if code:
+            _LOG.warning(
+                'Unable to compute resource symbols for Project %s; build not '
+                'cached. Error:\n%s', self.name, '\n'.join(result))
+            return
+
+        cache.put(
+            app_apk, test_apk, os.path.join(out_path, 'R.txt'), module)
+
+    def _get_apk_cache(self):
+        return _ApkCache(
+            self.name, self.src_revision or self.get_cached_revision())
+
+    def _get_apks(self):
+        """Gets (debug apk path, test debug apk path) or None if not built."""
+
+        app_apk = None
+        test_apk = None
+
+        paths = glob.glob(os.path.join(
+            self.path, '*', 'build', 'outputs', 'apk', '*debug*.apk'))
+
+        # Prefer zipaligned packages when the build emits both variants.
+        for path in sorted(paths, key=lambda p: ('unaligned' in p, p)):
+            name = os.path.basename(path).lower()
+
+            if 'test' in name:
+                test_apk = test_apk or path
+            else:
+                app_apk = app_apk or path
 
-        with open(local_path) as f:
-            return base64.b64encode(f.read())
+        if not (app_apk and test_apk):
+            return None
+
+        return app_apk, test_apk
+
+    def _get_patched_resources_module(self):
+        """Gets the module every patched file is a resource of, or None.
+
+        Resources are files under <module>/src/main/res/; only they are
+        packaged by aapt, so any other patch needs a full build.
+        """
+
+        resources_dirs = ['src', 'main', _RESOURCE_DIR]
+        modules = set()
+
+        for path in self._patched_files:
+            parts = os.path.relpath(
+                os.path.join(self.path, path), self.path).split(os.sep)
+            # Dirs only; the last part is the file name.
+            starts = [
+                i for i in range(len(parts) - len(resources_dirs))
+                if parts[i:i + len(resources_dirs)] == resources_dirs]
+
+            if not starts or parts[0] == os.pardir:
+                return None
 
-    def _get_gradlew(self):
-        return os.path.join(self.path, 'gradlew')
+            modules.add(os.path.join(*parts[:starts[0]]) if starts[0] else '.')
+
+        return modules.pop() if len(modules) == 1 else None
+
+    def _get_resource_build_path(self):
+        path = os.path.join(self.path, _RESOURCE_BUILD_DIR)
+        _makedirs(path)
+        return path
 
     def _gradlew_failed(self, result):
         return _GRADLEW_INSTALL_SUCCESS_NEEDLE not in result
 
+    def _install_apks(self, serial, apks, stage_fn=None, spans=None):
+        client = _get_adb_client()
+        spans = spans or _Spans()
+
+        if stage_fn:
+            stage_fn(TestRun.STAGE_INSTALLING)
+
+        def install(apk, parent):
+            # Installs run on their own threads, so name their parent span.
+            with spans.span(os.path.basename(apk), parent=parent) as span:
+                try:
+                    result = client.install(serial, apk)
+                except (adb.Error, socket.error) as e:
+                    span.set_output([str(e)])
+                    return e, None
+
+                span.set_output(result)
+                return None, result
+
+        with spans.span('adb_install') as parent:
+            results = _call_parallel([
+                lambda apk=apk: install(apk, parent) for apk in apks])
+
+        for apk, (error, result) in zip(apks, results):
+            if error is not None:
+                message = (
+                    'Unable to install package %s from Project %s; error: '
+                    '%s') % (apk, self.name, error)
+                _LOG.error(message)
+                raise DeviceError(message)
+
+            if self._adb_install_failed(result):
+                message = (
+                    'Unable to install package %s from Project %s; '
+                    'error:\n%s') % (apk, self.name, '\n'.join(result))
+                _LOG.error(message)
+                return False, result
+
+        _LOG.info(
+            'Installed debug and test debug packages from Project %s',
+            self.name)
+
+        return (
+            True,
+            [('Debug and test debug packages installed from Project '
+              '%s') % self.name])
+
+    def _install_resources_only(
+            self, serial, resources_module, stage_fn=None, spans=None):
+        """Repackages resources into the cached build and installs it.
+
+        Returns (False, result) whenever the fast path does not apply, in which
+        case the caller does a full build.
+        """
+
+        cache = self._get_apk_cache()
+        if not cache.exists():
+            _LOG.info(
+                'No cached build for Project %s; doing full build', self.name)
+            return False, []
+
+        module = cache.get_module()
+        if module != resources_module:
+            _LOG.info(
+                'Patched resources are not in module %s of Project %s; doing '
+                'full build', module, self.name)
+            return False, []
+
+        spans = spans or _Spans()
+        out_path = self._get_resource_build_path()
+
+        with spans.span('aapt') as span:
+            code, result, resources_apk = self._package_resources(
+                module, out_path)
+            span.exit_code = code
+            span.set_output(result)
+
+        if code:
+            _LOG.info(
+                'Unable to package resources for Project %s; doing full build',
+                self.name)
+            return False, result
+
+        with open(os.path.join(out_path, 'R.txt')) as new, open(
+                cache.symbols) as cached:
+            if new.read() != cached.read():
+                _LOG.info(
+                    ('Resource ids changed for Project %s; doing full build so '
+                     'code is recompiled'), self.name)
+                return False, []
+
+        app_apk = os.path.join(out_path, 'app-debug-unaligned.apk')
+        _replace_apk_resources(cache.app_apk, resources_apk, app_apk)
+
+        with spans.span('jarsigner') as span:
+            code, result = _sign_debug_apk(app_apk)
+            span.exit_code = code
+            span.set_output(result)
+
+        if code:
+            _LOG.warning(
+                'Unable to sign debug package for Project %s; error:\n%s',
+                self.name, '\n'.join(result))
+            return False, result
+
+        zipalign = _Sdk.find_build_tool('zipalign')
+        if zipalign:
+            aligned_apk = os.path.join(out_path, 'app-debug.apk')
+
+            with spans.span('zipalign') as span:
+                code, result = _run(
+                    [zipalign, '-f', '4', app_apk, aligned_apk], strict=False)
+                span.exit_code = code
+                span.set_output(result)
+
+            if not code:
+                app_apk = aligned_apk
+
+        _LOG.info(
+            'Repackaged resources into cached build for Project %s', self.name)
+        return self._install_apks(
+            serial, (app_apk, cache.test_apk), stage_fn=stage_fn, spans=spans)
+
+    def _package_resources(self, module, out_path):
+        """Runs aapt on a module's resources.
+
+        Returns (code, result, path of the resources package). The package's
+        R.txt symbols are written to out_path.
+        """
+
+        aapt = _Sdk.find_build_tool('aapt')
+        android_jar = _Sdk.find_android_jar()
+
+        if not (aapt and android_jar):
+            return 1, ['Unable to find aapt or android.jar in SDK'], None
+
+        src_path = os.path.join(self.path, module, 'src', 'main')
+        resources_apk = os.path.join(out_path, 'resources.ap_')
+        code, result = _run([
+            aapt, 'package', '-f', '-M',
+            os.path.join(src_path, 'AndroidManifest.xml'), '-S',
+            os.path.join(src_path, _RESOURCE_DIR), '-I', android_jar, '-F',
+            resources_apk, '--output-text-symbols', out_path], strict=False)
+        return code, result, resources_apk
+
+    def _pull_image(self, serial, path):
+        """Streams the result image off the device into path; returns bytes."""
+
+        size = 0
+        tmp_path = path + '.tmp'
+
+        with open(tmp_path, 'wb') as f:
+            for chunk in _get_adb_client().read(
+                    serial, os.path.join(
+                        '/sdcard/Robotium-screenshots/', _RESULT_IMAGE_NAME)):
+                f.write(chunk)
+                size += len(chunk)
+
+        os.rename(tmp_path, path)
+        _LOG.info('Result image saved to ' + path)
+        return size
+
     def _tests_failed(self, result):
-        return _TEST_FAILURE_NEEDLE in result
+        return any(_is_test_failure(line) for line in result)
 
 
 class _Runtime(object):
@@ -802,21 +2967,17 @@ class _Runtime(object):
             str(value['port']), os.path.join(_RUNTIMES_PATH, key,
             value['sdcard']), value['sdcardSize'])
 
-    def block_until_ready(self, interval_msec=1000, timeout_sec=60*10):
-        start = datetime.datetime.utcnow()
-
-        while not self.ready():
-            now = datetime.datetime.utcnow()
-            delta_sec = (now - start).total_seconds()
+    @property
+    def lock(self):
+        return Lock(self.serial)
 
-            if delta_sec > timeout_sec:
-                _die(
-                    'Runtime %s timed out at %ss; aborting' % (
-                        self.project_name, delta_sec))
+    @property
+    def serial(self):
+        return self._emulator_name_get()
 
-            _LOG.debug(
-                'Waiting %sms for runtime %s', interval_msec, self.project_name)
-            time.sleep(interval_msec / 1000.0)
+    def block_until_ready(self, interval_msec=1000, timeout_sec=60*10):
+        _block_until_ready(
+            [self], interval_msec=interval_msec, timeout_sec=timeout_sec)
 
     def clean(self):
         self._avd_delete()
@@ -832,9 +2993,36 @@ class _Runtime(object):
         return (
             self._dir_exists() and self._sdcard_exists() and self._avd_exists())
 
+    def has_snapshot(self):
+        return os.path.exists(self._snapshot_marker_path_get())
+
     def ready(self):
         return self._emulator_ready()
 
+    def save_snapshot(self, strict=False):
+        """Saves the running, booted emulator's state for later quick boots."""
+
+        handler = _get_strict_handler(strict)
+        code, result = _run([
+            _Sdk.get_adb(), '-s', self.serial, 'emu', 'avd', 'snapshot', 'save',
+            _SNAPSHOT_NAME], strict=False)
+        failed = [
+            line for line in result
+            if line.startswith(_EMULATOR_CONSOLE_ERROR_PREFIX)]
+
+        if code or failed:
+            handler(
+                'Unable to save snapshot for runtime %s; result: %s' % (
+                    self.project_name, '\n'.join(result)))
+            return
+
+        with open(self._snapshot_marker_path_get(), 'w') as f:
+            f.write(_SNAPSHOT_NAME)
+
+        _LOG.info(
+            'Saved snapshot %s for runtime %s', _SNAPSHOT_NAME,
+            self.project_name)
+
     def start(self, headless=True):
         self._emulator_start(headless=headless)
 
@@ -850,9 +3038,10 @@ class _Runtime(object):
             handler('Unable to create AVD at %s; already exists' % path)
             return
 
+        # --snapshot gives the AVD storage for the booted-state snapshot.
         code, result = _run([
             _Sdk.get_android(), 'create', 'avd', '-n', name, '-t', 'android-19',
-            '--abi', 'default/armeabi-v7a', '-p', path],
+            '--abi', 'default/armeabi-v7a', '-p', path, '--snapshot'],
             proc_fn=self._avd_create_proc_fn)
 
         if code:
@@ -962,20 +3151,23 @@ class _Runtime(object):
         if not self._emulator_running():
             return False
 
-        code, result = _run(
-            [_Sdk.get_adb(), 'shell', 'getprop', _BOOT_ANIMATION_PROPERTY],
-            strict=False)
-
-        if not code and result[0] == _BOOT_ANIMATION_STOPPED:
-            return True
+        try:
+            result = _get_adb_client(timeout_sec=_ADB_PROBE_TIMEOUT_SEC).shell(
+                self.serial, 'getprop ' + _BOOT_ANIMATION_PROPERTY)
+        except (adb.Error, socket.error):
+            return False
 
-        return False
+        return bool(result) and result[0] == _BOOT_ANIMATION_STOPPED
 
     def _emulator_running(self):
-        _, result = _run([_Sdk.get_adb(), 'devices'])
+        try:
+            devices = _get_adb_client(
+                timeout_sec=_ADB_PROBE_TIMEOUT_SEC).devices()
+        except (adb.Error, socket.error):
+            return False
 
-        for line in result:
-            if line.startswith(self._emulator_name_get()):
+        for serial, _ in devices:
+            if serial == self.serial:
                 return True
 
         return False
@@ -985,10 +3177,16 @@ class _Runtime(object):
 
         def emulator(project_name, headless=True):
             headless_args = ['-no-audio', '-no-window'] if headless else []
+            # Restore the booted snapshot if we have one; otherwise cold boot
+            # and leave saving to save_snapshot() once boot completes.
+            snapshot_args = (
+                ['-snapshot', _SNAPSHOT_NAME, '-no-snapshot-save']
+                if self.has_snapshot() else ['-no-snapshot-load'])
             code, result = _run([
                 _Sdk.get_emulator(), '-avd', os.path.basename(self.avd),
                 '-sdcard', self.sdcard, '-port', self.port,
-                '-force-32bit'] + headless_args, env=_Sdk.get_shell_env())
+                '-force-32bit'] + headless_args + snapshot_args,
+                env=_Sdk.get_shell_env())
 
             if code:
                 _die(
@@ -1012,10 +3210,12 @@ class _Runtime(object):
                     self.project_name))
             return
 
-        _run([
-            _Sdk.get_adb(), '-s', self._emulator_name_get(), 'emu', 'kill'])
+        _run([_Sdk.get_adb(), '-s', self.serial, 'emu', 'kill'])
         _LOG.info('Emulator for runtime %s stopped', self.project_name)
 
+    def _snapshot_marker_path_get(self):
+        return os.path.join(self._dir_get(), '.snapshot')
+
     def _sdcard_create(self, strict=False):
         handler = _get_strict_handler(strict)
 
@@ -1049,7 +3249,7 @@ class _Runtime(object):
 
 class _Sdk(object):
 
-    PATH = os.path.join(_RESOURCES_PATH, 'sdk')
+    PATH = _SDK_PATH
     _VERSION = 'adt-bundle-linux-x86_64-20140702'
     _URL = 'https://dl.google.com/android/adt/%s.zip' % _VERSION
 
@@ -1064,6 +3264,29 @@ class _Sdk(object):
         shutil.rmtree(cls.PATH)
         _LOG.info('Android SDK deleted from %s', cls.PATH)
 
+    @classmethod
+    def find_android_jar(cls):
+        """Gets path of the newest platform's android.jar, or None."""
+
+        paths = glob.glob(os.path.join(
+            cls.PATH, 'platforms', 'android-*', 'android.jar'))
+        if not paths:
+            return None
+
+        return max(paths, key=lambda p: version.LooseVersion(
+            os.path.basename(os.path.dirname(p)).split('-', 1)[1]))
+
+    @classmethod
+    def find_build_tool(cls, name):
+        """Gets path of a tool in the newest build-tools, or None."""
+
+        paths = glob.glob(os.path.join(cls.PATH, 'build-tools', '*', name))
+        if not paths:
+            return None
+
+        return max(paths, key=lambda p: version.LooseVersion(
+            os.path.basename(os.path.dirname(p))))
+
     @classmethod
     def get_adb(cls):
         return cls._get_tool('adb', directory='platform-tools')
@@ -1077,17 +3300,23 @@ class _Sdk(object):
         return cls._get_tool('emulator')
 
     @classmethod
-    def get_shell_env(cls):
+    def get_shell_env(cls, serial=None):
         display = os.environ.get('DISPLAY')
         if not display:
             _die('Could not get shell variable DISPLAY')
 
-        return {
+        env = {
             _ANDROID_HOME: cls.PATH,
             _ANDROID_SDK_HOME: os.path.expanduser('~'),
             _DISPLAY: display,
         }
 
+        # Routes gradle's device tasks (installDebug, etc.) to one emulator.
+        if serial is not None:
+            env[_ANDROID_SERIAL] = serial
+
+        return env
+
     @classmethod
     def get_mksdcard(cls):
         return cls._get_tool('mksdcard')
@@ -1158,12 +3387,109 @@ class _Sdk(object):
             proc_fn=cls._accept_licenses)
 
 
+class _Span(object):
+    """A named, timed step of a run. Use in a with statement.
+
+    Callers set exit_code and output_bytes where they apply; both stay None
+    otherwise, e.g. for adb shell commands, whose exit codes aren't reported.
+    """
+
+    def __init__(self, spans, name, parent):
+        self.children = []
+        self.end_sec = None
+        self.exit_code = None
+        self.name = name
+        self.output_bytes = None
+        self.parent = parent
+        self.start_sec = None
+        self._spans = spans
+
+    def __enter__(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        self._spans._open(self)
+        return self
+
+    def __exit__(self, unused_type, unused_value, unused_traceback):
+        # Treat as module-protected. pylint: disable=protected-access
+        self._spans._close(self)
+
+    def set_output(self, lines):
+        self.output_bytes = sum(len(line) + 1 for line in lines)
+
+    def to_dict(self):
+        return {
+            'children': [child.to_dict() for child in self.children],
+            'end_sec': self.end_sec,
+            'exit_code': self.exit_code,
+            'name': self.name,
+            'output_bytes': self.output_bytes,
+            'start_sec': self.start_sec,
+        }
+
+
+class _Spans(object):
+    """Records a run's nested timing spans.
+
+    A span made with span(name) nests under the span open in the same thread,
+    or under parent if given, so work fanned out to threads stays attributed
+    to its caller. start_sec and end_sec are monotonic seconds since the
+    recorder was made; end_sec is None while a span is open.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin_sec = _get_monotonic_sec()
+        self._roots = []
+
+    def span(self, name, parent=None):
+        return _Span(self, name, parent)
+
+    def to_list(self):
+        """Gets the top-level spans as dicts, for JSON encoding."""
+
+        with self._lock:
+            return [span.to_dict() for span in self._roots]
+
+    def _close(self, span):
+        self._get_stack().pop()
+        span.end_sec = self._get_elapsed_sec()
+
+    def _get_elapsed_sec(self):
+        return round(_get_monotonic_sec() - self._origin_sec, 3)
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+
+        return self._local.stack
+
+    def _open(self, span):
+        stack = self._get_stack()
+        span.parent = span.parent or (stack[-1] if stack else None)
+        span.start_sec = self._get_elapsed_sec()
+
+        with self._lock:
+            if span.parent:
+                span.parent.children.append(span)
+            else:
+                self._roots.append(span)
+
+        stack.append(span)
+
+
 class _TestEnvironment(object):
     """An environment for test execution.
 
     Manages creation of filesystem for result storage, scratch space for copying
     and patching over the golden project, and log redirection.
 
+    When incremental, the scratch space is instead a persistent working tree for
+    the project and emulator slot that keeps its gradle state between runs.
+    Patched files are listed in a marker file while a run is in flight and are
+    restored from the golden project (and verified by fingerprint) on
+    tear_down(), or on the next set up if a run died before reverting.
+
     Lifecycle is:
 
         * Initialize environment.
@@ -1175,32 +3501,47 @@ class _TestEnvironment(object):
     """
 
     _OUT = 'out'
+    _STORE = ResultStore()
 
-    def __init__(self, ticket):
+    def __init__(self, ticket, events=None, incremental=False):
+        self._events = events
         self._handler = None
+        self.incremental = incremental
         self.path = self._get_path(ticket)
+        self._patched = []
         self._projects_set_up = False
         self.out_path = os.path.join(self.path, self._OUT)
+        self.spans = _Spans()
         self.src_project = None
         self.test_project = None
         self.ticket = ticket
 
     @classmethod
     def get_test_run(cls, ticket):
-        root_path = cls._get_path(ticket)
-        json_path = cls._get_result_json_path(ticket)
         test_run = TestRun()
 
-        if not (os.path.exists(root_path) and os.path.exists(json_path)):
+        try:
+            result = cls._STORE.get(ticket)
+        except:  # Treat all errors the same. pylint: disable=bare-except
+            _LOG.exception('Unable to read result of ticket %s', ticket)
+            result = None
+
+        if result is None:
             test_run.set_status(TestRun.NOT_FOUND)
             test_run.set_payload('No test results found')
             return test_run
 
+        test_run.set_image_path(cls._get_image_path(ticket))
+
         try:
-            with open(json_path) as f:
-                result = json.loads(f.read())
-                test_run.set_payload(result['payload'])
-                test_run.set_status(result['status'])
+            test_run.set_payload(result['payload'])
+            test_run.set_progress(result.get('progress'))
+            test_run.set_spans(result.get('spans', []))
+
+            if result.get('stage'):
+                test_run.set_stage(result['stage'])
+
+            test_run.set_status(result['status'])
         except:  # Treat all errors the same. pylint: disable=bare-except
             test_run.set_status(TestRun.CONTENTS_MALFORMED)
             test_run.set_payload('Test result malformed')
@@ -1209,61 +3550,72 @@ class _TestEnvironment(object):
 
     @classmethod
     def _get_path(cls, ticket):
-        return os.path.join(_RESULTS_PATH, str(ticket))
+        return cls._STORE.get_path(ticket)
 
     @classmethod
-    def _get_result_json_path(cls, ticket):
-        return os.path.join(cls._get_path(ticket), cls._OUT, _RESULT_JSON_NAME)
+    def _get_image_path(cls, ticket):
+        return os.path.join(cls._get_path(ticket), cls._OUT, _RESULT_IMAGE_NAME)
 
-    def save(self, test_run):
-        json_path = os.path.join(self.out_path, _RESULT_JSON_NAME)
-        with open(json_path, 'w') as f:
-            f.write(json.dumps(test_run.to_dict()))
+    def get_image_path(self):
+        return self._get_image_path(self.ticket)
 
-        _LOG.info('Result saved to ' + json_path)
+    def save(self, test_run, record_span=True):
+        """Saves test_run with the spans recorded so far.
+
+        If record_span, the save is itself recorded as a span, which is only
+        persisted by the next save.
+        """
+
+        test_run.set_spans(self.spans.to_list())
+        value = test_run.to_dict(include_image=False)
+
+        if record_span:
+            with self.spans.span('save'):
+                self._STORE.put(self.ticket, value)
+        else:
+            self._STORE.put(self.ticket, value)
+
+        if self._events is not None:
+            self._events.publish(self.ticket, test_run)
+
+        _LOG.info('Result saved for ticket %s', self.ticket)
 
     def set_up(self):
         """Sets up everything but projects."""
 
         self._configure_filesystem()
         self._configure_logging()
-        self._clean_old()
 
-    def set_up_projects(self, patches, src_project):
+    def set_up_projects(self, patches, src_project, serial):
         """Sets up projects and applies patches."""
 
-        self._configure_projects(src_project)
-        self._copy_project()
+        self._configure_projects(src_project, serial)
+
+        if self.incremental:
+            with self.spans.span('prepare_worktree'):
+                self._prepare_worktree()
+        else:
+            with self.spans.span('copy_project'):
+                self._copy_project()
+
+        test_patches = [self._get_test_patch(patch) for patch in patches]
+        self._patched = [patch.filename for patch in test_patches]
 
-        for patch in patches:
-            self.test_project.patch(self._get_test_patch(patch))
+        if self.incremental:
+            self._write_worktree_patched(self._patched)
+
+        with self.spans.span('patch'):
+            for patch in test_patches:
+                self.test_project.patch(patch)
 
         self._projects_set_up = True
 
     def tear_down(self):
         """Tears down both set_up() and set_up_projects()."""
 
-        self._copy_result()
         self._remove_test_project()
         self._revert_logging()
 
-    def _clean_old(self):
-        """Cleans old test invocations from the filesystem.
-
-        The _TestEnvironment code path is hit on each web worker test
-        invocation, so we do cleanup here to keep the test results on the
-        filesystem from filling disk.
-        """
-        now_sec = time.time()
-        for path in os.listdir(_RESULTS_PATH):
-            result_dir = os.path.join(_RESULTS_PATH, path)
-            delta_sec = now_sec - os.path.getmtime(result_dir)
-            if delta_sec >= _RESULTS_TTL_SEC:
-                shutil.rmtree(result_dir)
-                _LOG.info(
-                    ('Result directory %s too old (delta: %ssec; TTL: %ssec); '
-                     'removed'), result_dir, delta_sec, _RESULTS_TTL_SEC)
-
     def _configure_logging(self):
         """Also send log info to test project dir."""
 
@@ -1271,44 +3623,39 @@ class _TestEnvironment(object):
         self._handler.setLevel(_LOG.level)
         _LOG.addHandler(self._handler)
 
-    def _configure_projects(self, src_project):
+    def _configure_projects(self, src_project, serial):
         relative_editor_file = src_project.editor_file.split(
             self._get_project_name_infix(src_project.name))[1]
         test_project_path = os.path.join(self.path, src_project.name)
 
+        if self.incremental:
+            test_project_path = os.path.join(
+                _WORKTREES_PATH, src_project.name, serial)
+
         self.src_project = src_project
         self.test_project = _Project(
             src_project.name,
             os.path.join(test_project_path, relative_editor_file),
             src_project.package, test_project_path, src_project.test_class,
             src_project.test_package)
+        # Staged trees are claimed only from this revision, so it is the one
+        # the test project holds; see _claim_staged_tree().
+        self.test_project.src_revision = src_project.get_cached_revision()
 
     def _copy_project(self):
-        shutil.copytree(self.src_project.path, self.test_project.path)
-        git_path = os.path.join(self.test_project.path, '.git')
-        gradle_path = os.path.join(self.test_project.path, '.gradle')
-
-        # Clean up files not needed for test builds/runs.
-        for prune_dir in [git_path, gradle_path]:
-            if os.path.exists(prune_dir):
-                shutil.rmtree(prune_dir)
+        source = 'pre-staged tree'
 
-        _LOG.info(
-            'Project %s staged into %s',
-            self.test_project.name, self.test_project.path)
+        claimed = _claim_staged_tree(
+            self.src_project.name, self.test_project.path,
+            self.test_project.src_revision)
 
-    def _copy_result(self):
-        if not self._projects_set_up:
-            return
+        if not claimed:
+            source = 'new link farm'
+            _link_tree(self.src_project.path, self.test_project.path)
 
-        copy_from = os.path.join(self.test_project.path, _RESULT_IMAGE_NAME)
-        # When build/test fails there may not be a result image.
-        if not os.path.exists(copy_from):
-            _LOG.info('No result image found at ' + copy_from)
-        else:
-            copy_to = os.path.join(self.out_path, _RESULT_IMAGE_NAME)
-            shutil.copyfile(copy_from, copy_to)
-            _LOG.info('Result image saved to ' + copy_to)
+        _LOG.info(
+            'Project %s staged into %s from %s',
+            self.test_project.name, self.test_project.path, source)
 
     def _configure_filesystem(self):
         os.makedirs(self.path)
@@ -1324,13 +3671,71 @@ class _TestEnvironment(object):
         return Patch(
             os.path.join(self.test_project.path, suffix), patch.contents)
 
+    def _get_src_path(self, test_path):
+        return os.path.join(
+            self.src_project.path,
+            os.path.relpath(test_path, self.test_project.path))
+
+    def _get_worktree_patched_path(self):
+        return os.path.join(self.test_project.path, _WORKTREE_PATCHED_NAME)
+
+    def _get_worktree_revision_path(self):
+        return os.path.join(self.test_project.path, _WORKTREE_REVISION_NAME)
+
+    def _prepare_worktree(self):
+        path = self.test_project.path
+        revision = self.test_project.src_revision
+
+        if os.path.exists(path) and self._read_worktree_revision() != revision:
+            _LOG.info(
+                'Project %s worktree at %s is not at golden revision %s; '
+                'removing worktree', self.test_project.name, path, revision)
+            shutil.rmtree(path)
+
+        if not os.path.exists(path):
+            shutil.copytree(
+                self.src_project.path, path,
+                ignore=shutil.ignore_patterns('.git'))
+            # Written last, so a partial copy is rebuilt by the next run.
+            with open(self._get_worktree_revision_path(), 'w') as f:
+                f.write(revision)
+
+            _LOG.info(
+                'Project %s worktree created at %s', self.test_project.name,
+                path)
+        else:
+            _LOG.info(
+                'Project %s reusing worktree at %s', self.test_project.name,
+                path)
+
+        # A previous run died before tear_down; undo its patches first.
+        patched_path = self._get_worktree_patched_path()
+        if os.path.exists(patched_path):
+            with open(patched_path) as f:
+                stale = json.loads(f.read())
+
+            if not self._revert_worktree(stale):
+                return self._prepare_worktree()
+
+    def _read_worktree_revision(self):
+        path = self._get_worktree_revision_path()
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            return f.read()
+
     def _remove_test_project(self):
         if not self._projects_set_up:
             return
 
+        if self.incremental:
+            self._revert_worktree(self._patched)
+            return
+
         # Entire test filesystem tree may have been removed already due to age.
         if os.path.exists(self.test_project.path):
-            shutil.rmtree(self.test_project.path)
+            _discard_tree(self.test_project.path)
             _LOG.info(
                 'Project %s unstaged from %s ',
                 self.test_project.name, self.test_project.path)
@@ -1341,6 +3746,45 @@ class _TestEnvironment(object):
 
         self._handler = None
 
+    def _revert_worktree(self, patched):
+        """Restores patched files from the golden project.
+
+        Returns True if every patched file was restored. Otherwise the worktree
+        is removed so the next run rebuilds it from scratch, and False is
+        returned. A golden project that has moved on since the worktree was
+        made is caught by _prepare_worktree(), which checks its revision.
+        """
+
+        for test_path in patched:
+            # patch() only replaces existing files, so each has a golden copy.
+            try:
+                shutil.copyfile(self._get_src_path(test_path), test_path)
+            except:  # Treat all errors the same. pylint: disable=bare-except
+                _LOG.exception(
+                    'Unable to revert %s in worktree %s; removing worktree',
+                    test_path, self.test_project.path)
+                shutil.rmtree(self.test_project.path, ignore_errors=True)
+                return False
+
+        patched_path = self._get_worktree_patched_path()
+        if os.path.exists(patched_path):
+            os.remove(patched_path)
+
+        _LOG.info(
+            'Project %s worktree at %s reverted', self.test_project.name,
+            self.test_project.path)
+        return True
+
+    def _write_worktree_patched(self, patched):
+        with open(self._get_worktree_patched_path(), 'w') as f:
+            f.write(json.dumps(patched))
+
+
+class _Timespec(ctypes.Structure):
+    """struct timespec, as filled in by clock_gettime()."""
+
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
 
 if __name__ == '__main__':
     main(_PARSER.parse_args())
@@ -0,0 +1,463 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for worker.py's staging, queueing and result state, on temp roots.
+
+Run from this directory with python -m unittest discover -p '*_test.py'.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import fakes
+import worker
+
+
+class _FakeCatalog(object):
+    """Catalog whose one slot is always free, or always busy if full."""
+
+    def __init__(self, full=False):
+        self._full = full
+
+    def get(self):
+        return self
+
+    def get_slot_pool(self):
+        return self
+
+    def busy_count(self):
+        return int(self._full)
+
+    def size(self):
+        return 1
+
+
+class _RootTestCase(unittest.TestCase):
+    """Points worker.py at a temp root for each test."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        worker.set_root_path(self.tmp)
+
+    def tearDown(self):
+        worker.set_root_path(worker.ROOT_PATH)
+        shutil.rmtree(self.tmp)
+
+    def wait_for_status(self, ticket, timeout_sec=5):
+        # Treat as module-protected. pylint: disable=protected-access
+        deadline = time.time() + timeout_sec
+
+        while time.time() < deadline:
+            status = worker._TestEnvironment.get_test_run(ticket).get_status()
+
+            if status != worker.TestRun.NOT_FOUND:
+                return status
+
+            time.sleep(0.05)
+
+        return worker.TestRun.NOT_FOUND
+
+
+class AdmissionQueueTest(_RootTestCase):
+
+    def setUp(self):
+        super(AdmissionQueueTest, self).setUp()
+        # Treat as module-protected. pylint: disable=protected-access
+        self.fork_test = worker._fork_test
+        self.queue = worker.AdmissionQueue(_FakeCatalog(), interval_sec=0.01)
+
+    def tearDown(self):
+        self.queue.stop()
+        worker._fork_test = self.fork_test
+        super(AdmissionQueueTest, self).tearDown()
+
+    def test_failed_fork_saves_unavailable_and_keeps_dispatching(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        forked = []
+
+        def fork_test(unused_config, unused_project_name, ticket, **kwargs):
+            forked.append(ticket)
+            raise OSError('fork failed')
+
+        worker._fork_test = fork_test
+        self.queue.start()
+        self.queue.submit('Project', 'first', [])
+        self.queue.submit('Project', 'second', [])
+
+        self.assertEqual(
+            worker.TestRun.UNAVAILABLE, self.wait_for_status('first'))
+        self.assertEqual(
+            worker.TestRun.UNAVAILABLE, self.wait_for_status('second'))
+        self.assertEqual(['first', 'second'], forked)
+        self.assertEqual([], os.listdir(worker._QUEUE_PATH))
+
+    def test_restart_replays_journal_in_order(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        forked = []
+
+        def fork_test(unused_config, unused_project_name, ticket, **kwargs):
+            forked.append((ticket, [
+                (patch.filename, patch.contents)
+                for patch in kwargs['patches']]))
+            return _FakeChild()
+
+        # Its slot is never free, so the submissions are still journaled when
+        # it stops, as if the server had crashed.
+        crashed = worker.AdmissionQueue(_FakeCatalog(full=True))
+        crashed.start()
+        crashed.submit('Project', 'first', [worker.Patch('a.xml', 'a')])
+        crashed.submit('Project', 'second', [])
+        crashed.stop()
+        worker._fork_test = fork_test
+        self.queue.start()
+        deadline = time.time() + 5
+
+        while len(forked) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(
+            [('first', [('a.xml', 'a')]), ('second', [])], forked)
+        self.assertEqual([], os.listdir(worker._QUEUE_PATH))
+
+    def test_restart_fails_run_interrupted_while_dispatching(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        forked = []
+
+        def fork_test(unused_config, unused_project_name, ticket, **kwargs):
+            forked.append(ticket)
+            return _FakeChild()
+
+        crashed = worker.AdmissionQueue(_FakeCatalog(full=True))
+        crashed.start()
+        crashed.submit('Project', 'ticket', [])
+        crashed.stop()
+        # As if the server crashed after setting the entry aside to fork it.
+        path, = [
+            os.path.join(worker._QUEUE_PATH, name)
+            for name in os.listdir(worker._QUEUE_PATH)]
+        os.rename(path, path + worker._QUEUE_DISPATCHED_SUFFIX)
+        worker._fork_test = fork_test
+        self.queue.start()
+
+        self.assertEqual(
+            worker.TestRun.UNAVAILABLE, self.wait_for_status('ticket'))
+        self.assertEqual([], forked)
+        self.assertEqual([], os.listdir(worker._QUEUE_PATH))
+
+
+class _FakeChild(object):
+    """Forked run that has already exited cleanly."""
+
+    exitcode = 0
+    pid = -1
+
+
+class LockTest(_RootTestCase):
+
+    def setUp(self):
+        super(LockTest, self).setUp()
+        self.lock = worker.Lock('emulator-5554')
+
+    def test_get_reclaims_lock_of_dead_process(self):
+        self._write(_get_dead_pid())
+
+        self.lock.get('new')
+
+        self.assertEqual('new', self.lock.value())
+        self.assertFalse(os.path.exists(self.lock.path + '.reclaim'))
+
+    def test_get_leaves_lock_of_live_process(self):
+        self._write(os.getpid())
+
+        with self.assertRaises(worker.LockError):
+            self.lock.get('new')
+
+        self.assertEqual('old', self.lock.value())
+
+    def test_get_leaves_lock_another_process_is_reclaiming(self):
+        self._write(_get_dead_pid())
+        open(self.lock.path + '.reclaim', 'w').close()
+
+        with self.assertRaises(worker.LockError):
+            self.lock.get('new')
+
+        self.assertEqual('old', self.lock.value())
+
+    def _write(self, pid):
+        with open(self.lock.path, 'w') as f:
+            f.write('%s\nold' % pid)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.statuses = {}
+        self.cache = worker.ResultCache(max_entries=2)
+
+    def test_alias_resolves_until_discarded_or_expired(self):
+        self.cache.alias('copy', 'source')
+
+        self.assertEqual('source', self.cache.resolve('copy'))
+        self.assertEqual('other', self.cache.resolve('other'))
+
+        self.cache.discard('source')
+
+        self.assertEqual('copy', self.cache.resolve('copy'))
+
+        expiring = worker.ResultCache(ttl_sec=0)
+        expiring.alias('copy', 'source')
+
+        self.assertEqual('copy', expiring.resolve('copy'))
+
+    def test_lookup_drops_outcomes_a_retry_could_change(self):
+        self.cache.reserve('key', 'ticket')
+        self.statuses['ticket'] = worker.TestRun.DEVICE_FAILED
+
+        self.assertIsNone(self._lookup('key'))
+        self.assertIsNone(self.cache.reserve('key', 'retry'))
+
+    def test_lookup_keeps_recently_used_entries_past_max_entries(self):
+        for ticket in ('first', 'second'):
+            self.cache.reserve(ticket, ticket)
+            self.statuses[ticket] = worker.TestRun.TESTS_SUCCEEDED
+
+        self.assertEqual('first', self._lookup('first'))
+        self.cache.reserve('third', 'third')
+
+        self.assertEqual('first', self._lookup('first'))
+        self.assertIsNone(self._lookup('second'))
+        self.assertEqual('third', self._lookup('third'))
+
+    def test_reserve_coalesces_onto_first_ticket(self):
+        self.assertIsNone(self.cache.reserve('key', 'first'))
+        self.assertEqual('first', self.cache.reserve('key', 'second'))
+        self.assertIsNone(self.cache.reserve('key', 'first'))
+
+    def _lookup(self, key):
+        def get_test_run(ticket):
+            test_run = worker.TestRun()
+            test_run.set_status(
+                self.statuses.get(ticket, worker.TestRun.NOT_FOUND))
+            return test_run
+
+        return self.cache.lookup(key, get_test_run_fn=get_test_run)
+
+
+class ResultReaperTest(_RootTestCase):
+
+    def setUp(self):
+        super(ResultReaperTest, self).setUp()
+        self.removed = []
+        self.store = worker.ResultStore()
+
+    def test_add_tracks_result_once_settled(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        reaper = self._get_reaper(settle_sec=60)
+        self._put('ticket', 100)
+        reaper.add('ticket')
+        reaper._reap()
+
+        self.assertEqual((0, 0), reaper.get_usage())
+
+        reaper._settle_sec = 0
+        reaper._reap()
+
+        self.assertEqual((1, 100), reaper.get_usage())
+
+    def test_expired_results_are_removed_under_quota(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        reaper = self._get_reaper(ttl_sec=0)
+        self._put('ticket', 100)
+        reaper._load()
+        reaper._reap()
+
+        self.assertEqual(['ticket'], self.removed)
+        self.assertIsNone(self.store.get('ticket'))
+        self.assertEqual((0, 0), reaper.get_usage())
+
+    def test_quota_removes_oldest_results_first(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        reaper = self._get_reaper(quota_bytes=250)
+
+        for ticket in ('oldest', 'older', 'newest'):
+            self._put(ticket, 100)
+            # Results are aged by the clock; keep their times distinct.
+            time.sleep(0.01)
+
+        reaper._load()
+        reaper._reap()
+
+        self.assertEqual(['oldest'], self.removed)
+        self.assertFalse(os.path.exists(self.store.get_path('oldest')))
+        self.assertEqual((2, 200), reaper.get_usage())
+
+        reaper._quota_bytes = 50
+        reaper._reap()
+
+        self.assertEqual(['oldest', 'older', 'newest'], self.removed)
+        self.assertEqual([], self.store.list_by_age())
+
+    def _get_reaper(self, **kwargs):
+        kwargs.setdefault('settle_sec', 0)
+        return worker.ResultReaper(
+            remove_fn=self.removed.append, store=self.store, **kwargs)
+
+    def _put(self, ticket, size):
+        self.store.put(ticket, {'stage': worker.TestRun.STAGE_DONE})
+        path = self.store.get_path(ticket)
+        os.makedirs(path)
+
+        with open(os.path.join(path, 'log'), 'w') as f:
+            f.write('x' * size)
+
+
+class ResultStoreTest(_RootTestCase):
+
+    def setUp(self):
+        super(ResultStoreTest, self).setUp()
+        self.store = worker.ResultStore()
+
+    def test_delete_spans_batches_and_removes_files(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        self.store._DELETE_BATCH_SIZE = 2
+        tickets = ['ticket%s' % i for i in range(5)]
+
+        for ticket in tickets + ['kept']:
+            self.store.put(ticket, {'ticket': ticket})
+            os.makedirs(self.store.get_path(ticket))
+
+        self.store.delete(tickets)
+
+        self.assertEqual(
+            ['kept'], [ticket for ticket, _ in self.store.list_by_age()])
+        for ticket in tickets:
+            self.assertIsNone(self.store.get(ticket))
+            self.assertFalse(os.path.exists(self.store.get_path(ticket)))
+
+    def test_get_path_shards_by_ticket_fingerprint(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        path = self.store.get_path(1234)
+
+        self.assertEqual(
+            os.path.join(
+                worker._RESULTS_PATH, worker._get_fingerprint('1234')[:2],
+                '1234'),
+            path)
+
+    def test_put_replaces_result_and_keeps_age_order(self):
+        self.store.put('first', {'status': 'queued'})
+        time.sleep(0.01)
+        self.store.put('second', {'status': 'queued'})
+        time.sleep(0.01)
+        self.store.put('first', {'status': 'done'})
+
+        self.assertEqual({'status': 'done'}, self.store.get('first'))
+        self.assertEqual(
+            ['second', 'first'],
+            [ticket for ticket, _ in self.store.list_by_age()])
+        self.assertEqual(
+            ['second'],
+            [ticket for ticket, _ in self.store.list_by_age(limit=1)])
+
+
+class StagingTest(_RootTestCase):
+
+    def setUp(self):
+        super(StagingTest, self).setUp()
+        self.src = os.path.join(self.tmp, 'src')
+        fakes.write_project(self.src)
+
+    def test_link_tree_prunes_gradle_state_but_keeps_nested_build_sources(
+            self):
+        # Treat as module-protected. pylint: disable=protected-access
+        source = os.path.join(
+            'app', 'src', 'main', 'java', 'com', 'example', 'build',
+            'Config.java')
+        pruned = [
+            os.path.join('.gradle', 'state'),
+            os.path.join('app', 'build', 'outputs', 'app.apk'),
+            os.path.join('build', 'state'),
+        ]
+
+        for name in [source] + pruned:
+            self._write(name)
+
+        dst = os.path.join(self.tmp, 'dst')
+        worker._link_tree(self.src, dst)
+
+        self.assertTrue(os.path.exists(os.path.join(dst, source)))
+        for name in pruned:
+            self.assertFalse(os.path.exists(os.path.join(dst, name)))
+
+    def test_refresh_discards_trees_and_builds_of_old_revision(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        project = self._get_project()
+        pool = worker.StagingPool(None, size=1)
+        pool._refresh(project)
+        pool._fill(project)
+        old_build = os.path.join(
+            worker._APK_CACHE_PATH, 'Src', project.get_cached_revision())
+        os.makedirs(old_build)
+
+        self._write(os.path.join('app', 'src', 'main', 'java', 'Added.java'))
+        pool._refresh(project)
+        pool._fill(project)
+
+        self.assertEqual(project.get_revision(), project.get_cached_revision())
+        self.assertFalse(os.path.exists(old_build))
+        self.assertEqual(
+            [project.get_cached_revision()],
+            [worker._get_staged_tree_revision(name) for name in os.listdir(
+                worker._get_staging_ready_path('Src'))])
+
+    def test_revision_covers_nested_build_sources(self):
+        project = self._get_project()
+        revision = project.get_revision()
+
+        self._write(os.path.join(
+            'app', 'src', 'main', 'java', 'com', 'example', 'build',
+            'Util.java'))
+
+        self.assertNotEqual(revision, project.get_revision())
+
+    def _get_project(self):
+        # Treat as module-protected. pylint: disable=protected-access
+        return worker._Project('Src', None, 'com.example', self.src, None, None)
+
+    def _write(self, name):
+        path = os.path.join(self.src, name)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'w') as f:
+            f.write(name)
+
+
+def _get_dead_pid():
+    pid = os.fork()
+
+    # Exit without running the parent's cleanup, such as unittest's.
+    if not pid:
+        os._exit(0)  # pylint: disable=protected-access
+
+    os.waitpid(pid, 0)
+    return pid
+
+
+if __name__ == '__main__':
+    unittest.main()